@@ -0,0 +1,84 @@
+"""
+Compare the time and memory it takes to load episodes with the slotted
+Episode against the previous HasBeenModified-based episode.
+
+    $ python -m benchmarks.episode
+"""
+import gc
+import time
+import tracemalloc
+
+from riley.models import Episode, HasBeenModified
+
+NUMBER_OF_EPISODES = 200000
+
+
+class LegacyEpisode(HasBeenModified):
+    # The Episode class before it got slots, for comparison
+    published_format = '%Y-%m-%d %H:%M:%S'
+
+    def __init__(self, podcast, guid, title, link, media_href, published,
+                 downloaded):
+        super().__init__()
+        self.podcast = podcast
+        self.guid = guid
+        self.title = title
+        self.link = link
+        self.media_href = media_href
+        self.published = published
+        self.downloaded = Episode.to_bool(downloaded)
+
+    @property
+    def published(self):
+        published = self._published
+        if isinstance(published, str):
+            published = time.strptime(published, self.published_format)
+            self.__dict__['_published'] = published
+        return published
+
+    @published.setter
+    def published(self, value):
+        if hasattr(self, '_published'):
+            self._published = None
+        if isinstance(value, (time.struct_time, str)):
+            self._published = value
+        else:
+            raise TypeError
+
+
+def make_rows():
+    return [('guid-%d' % i, 'Episode %d' % i, 'http://example.com/%d' % i,
+             'http://example.com/%d.mp3' % i,
+             time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(i * 3600)),
+             'False') for i in range(NUMBER_OF_EPISODES)]
+
+
+def measure(cls, rows):
+    """
+    :return: Seconds to create the episodes and the bytes they use.
+    """
+    gc.collect()
+    start = time.perf_counter()
+    episodes = [cls(None, *row) for row in rows]
+    seconds = time.perf_counter() - start
+    del episodes
+    gc.collect()
+    tracemalloc.start()
+    episodes = [cls(None, *row) for row in rows]
+    size, _peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del episodes
+    return seconds, size
+
+
+def main():
+    rows = make_rows()
+    print('%d episodes' % NUMBER_OF_EPISODES)
+    print('%-8s %10s %10s' % ('', 'seconds', 'MiB'))
+    for name, cls in [('legacy', LegacyEpisode), ('slotted', Episode)]:
+        seconds, size = measure(cls, rows)
+        print('%-8s %10.3f %10.1f' % (name, seconds, size / 1024 / 1024))
+
+
+if __name__ == '__main__':
+    main()
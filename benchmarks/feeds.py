@@ -0,0 +1,66 @@
+"""
+Compare the time and peak memory it takes feedparser and the streaming parser
+to parse a large feed.
+
+    $ python -m benchmarks.feeds
+"""
+import gc
+import time
+import tracemalloc
+
+from riley import feeds
+
+NUMBER_OF_ITEMS = 5000
+
+ITEM = """
+    <item>
+        <title>Episode {0}</title>
+        <link>http://example.com/{0}/</link>
+        <pubDate>{1}</pubDate>
+        <guid isPermaLink="false">http://example.com/?p={0}</guid>
+        <description><![CDATA[{2}]]></description>
+        <content:encoded><![CDATA[<p>{2}</p>]]></content:encoded>
+        <enclosure url="http://example.com/{0}.mp3" length="1" type="audio/mpeg"/>
+        <itunes:summary>{2}</itunes:summary>
+    </item>"""
+
+
+def make_feed():
+    text = 'Notes about the episode. ' * 80
+    items = ''.join(ITEM.format(
+        i, time.strftime('%a, %d %b %Y %H:%M:%S +0000', time.gmtime(i * 3600)),
+        text) for i in reversed(range(NUMBER_OF_ITEMS)))
+    return ("""<?xml version="1.0" encoding="UTF-8"?>
+<rss version="2.0" xmlns:content="http://purl.org/rss/1.0/modules/content/"
+    xmlns:itunes="http://www.itunes.com/dtds/podcast-1.0.dtd">
+<channel><title>Example</title>%s</channel></rss>""" % items).encode()
+
+
+def measure(data, parser):
+    """
+    :return: Seconds to parse the feed and the peak number of bytes used.
+    """
+    gc.collect()
+    start = time.perf_counter()
+    feeds.parse(data, parser)
+    seconds = time.perf_counter() - start
+    gc.collect()
+    tracemalloc.start()
+    feed = feeds.parse(data, parser)
+    _size, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    assert len(feed.entries) == NUMBER_OF_ITEMS
+    return seconds, peak
+
+
+def main():
+    data = make_feed()
+    print('%d items, %.1f MiB' % (NUMBER_OF_ITEMS, len(data) / 1024 / 1024))
+    print('%-10s %10s %10s' % ('', 'seconds', 'peak MiB'))
+    for parser in ['feedparser', 'streaming']:
+        seconds, peak = measure(data, parser)
+        print('%-10s %10.3f %10.1f' % (parser, seconds, peak / 1024 / 1024))
+
+
+if __name__ == '__main__':
+    main()
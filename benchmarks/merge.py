@@ -0,0 +1,64 @@
+"""
+Measure how long it takes to merge a fetched feed into a podcast's episode
+history, for growing history sizes.
+
+    $ python -m benchmarks.merge
+"""
+import time
+import timeit
+
+from riley.commands import FetchEpisodes
+from riley.models import Podcast, Episode
+
+HISTORY_SIZES = [100, 1000, 3000, 10000]
+FEED_SIZE = 300
+
+
+class SyntheticEpisodeStorage:
+    def __init__(self, size):
+        self.size = size
+
+    def get_episodes(self, podcast):
+        return [make_episode(podcast, i) for i in range(self.size)]
+
+
+def make_episode(podcast, i):
+    published = time.gmtime(1262304000 + i * 86400)
+    return Episode(podcast, 'guid-%d' % i, 'Episode %d' % i,
+                   'http://example.com/%d' % i,
+                   'http://example.com/%d.mp3' % i, published, False)
+
+
+def linear_merge(podcast, episodes):
+    # The scan which EpisodeList.__contains__ used before the GUID index
+    for episode in episodes:
+        if not any(True for e in podcast.episodes if e.guid == episode.guid):
+            list.append(podcast.episodes, episode)
+
+
+def measure(merge, history_size, number=5):
+    def setup():
+        podcast = Podcast('bench', 'feed', SyntheticEpisodeStorage(
+            history_size))
+        # The feed contains the latest episodes, of which a few are new
+        feed = [make_episode(podcast, i) for i in range(
+            history_size - FEED_SIZE + 5, history_size + 5)]
+        podcast.episodes
+        return podcast, feed
+    total = 0
+    for _ in range(number):
+        podcast, feed = setup()
+        total += timeit.timeit(lambda: merge(podcast, feed), number=1)
+    return total / number
+
+
+def main():
+    print('%8s %12s %12s' % ('history', 'indexed ms', 'linear ms'))
+    for size in HISTORY_SIZES:
+        indexed = measure(FetchEpisodes.merge, size)
+        linear = measure(linear_merge, size)
+        print('%8d %12.3f %12.3f' % (size, indexed * 1000, linear * 1000))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,237 @@
+"""
+Measure the time, throughput and peak memory of fetching, listing and
+downloading for synthetic podcasts and histories of growing sizes. The feeds
+and media files are served by a local HTTP server, and the results are
+printed as a table or, with --json, as JSON to track over time.
+
+    $ python -m benchmarks.suite
+    $ python -m benchmarks.suite --scale large --json > results.json
+"""
+import argparse
+import contextlib
+import gc
+import io
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from benchmarks.server import Server
+from riley import download, storage
+from riley.commands import FetchEpisodes, ListEpisodes, DownloadBest
+from riley.storage import FileStorage
+
+# Number of podcasts and number of episodes per podcast
+SCALES = {
+    'small': (10, 100),
+    'medium': (100, 1000),
+    'large': (1000, 10000),
+}
+DEFAULT_SCALES = ['small', 'medium']
+# The feeds contain the latest episodes, of which a few aren't stored yet
+FEED_SIZE = 100
+NEW_EPISODES = 5
+MEDIA_SIZE = 1024 * 1024
+NUMBER_OF_DOWNLOADS = 20
+JOBS = 8
+
+ITEM = """
+    <item>
+        <title>Episode {0}</title>
+        <link>http://example.com/{1}/{0}/</link>
+        <pubDate>{2}</pubDate>
+        <guid isPermaLink="false">{1}-{0}</guid>
+        <enclosure url="{3}/media/{1}-{0}.mp3" length="{4}" type="audio/mpeg"/>
+    </item>"""
+
+
+class SyntheticFiles:
+    """
+    Feeds are made when they're first requested, and every media file has
+    the same content.
+    """
+
+    def __init__(self, url, episodes):
+        self.url = url
+        self.episodes = episodes
+        self.media = os.urandom(MEDIA_SIZE)
+        self.feeds = {}
+
+    def get(self, path):
+        if path.startswith('/media/'):
+            return self.media
+        if path.startswith('/feeds/'):
+            name = path[len('/feeds/'):-len('.xml')]
+            if name not in self.feeds:
+                self.feeds[name] = make_feed(self.url, name, self.episodes)
+            return self.feeds[name]
+        return None
+
+
+def published(i):
+    return 1262304000 + i * 3600
+
+
+def make_feed(url, name, episodes):
+    items = ''.join(ITEM.format(
+        i, name, time.strftime('%a, %d %b %Y %H:%M:%S +0000',
+                               time.gmtime(published(i))), url, MEDIA_SIZE)
+        for i in reversed(range(max(episodes - FEED_SIZE, 0), episodes)))
+    return ("""<?xml version="1.0" encoding="UTF-8"?>
+<rss version="2.0"><channel><title>%s</title>%s</channel></rss>""" % (
+        name, items)).encode()
+
+
+def write_data(data_dir, url, podcasts, episodes):
+    """
+    Write a config and histories in which the newest episodes of each feed
+    are missing.
+    """
+    if os.path.exists(data_dir):
+        shutil.rmtree(data_dir)
+    os.makedirs(data_dir)
+    names = ['podcast%d' % i for i in range(podcasts)]
+    with open(os.path.join(data_dir, 'config.yml'), 'w') as f:
+        f.write('storage: %s\nfsync: false\npodcasts:\n' %
+                os.path.join(data_dir, 'downloads'))
+        for name in names:
+            f.write('    %s:\n        feed: %s/feeds/%s.xml\n'
+                    '        priority: 5\n' % (name, url, name))
+    for name in names:
+        path = os.path.join(data_dir, '%s_history.csv' % name)
+        with open(path, 'w') as f:
+            f.write('guid,title,link,media_href,published,downloaded\n')
+            for i in range(episodes - NEW_EPISODES):
+                f.write('%s-%d,Episode %d,http://example.com/%s/%d/,'
+                        '%s/media/%s-%d.mp3,%d,False\n' % (
+                            name, i, i, name, i, url, name, i, published(i)))
+    FileStorage._config_cache.clear()
+
+
+def measure(setup, run):
+    """
+    Run once to time it and once more under tracemalloc for the peak memory.
+
+    :return: Seconds and the peak number of bytes allocated.
+    """
+    seconds = 0
+    peak = 0
+    for traced in (False, True):
+        setup()
+        gc.collect()
+        if traced:
+            tracemalloc.start()
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            run()
+        if traced:
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+        else:
+            seconds = time.perf_counter() - start
+    return seconds, peak
+
+
+def run_scale(data_dir, server, podcasts, episodes):
+    """
+    :return: The results of each benchmark.
+    :rtype: list
+    """
+    url = server.url
+
+    def reset():
+        write_data(data_dir, url, podcasts, episodes)
+
+    def clear_cache():
+        FileStorage._config_cache.clear()
+
+    def download_files():
+        to_dir = os.path.join(data_dir, 'files')
+        for i in range(NUMBER_OF_DOWNLOADS):
+            download.download('%s/media/bench-%d.mp3' % (url, i), to_dir)
+
+    reset()
+    # (name, setup, run, number of items, unit of items)
+    benchmarks = [
+        ('get_podcasts', clear_cache,
+         lambda: FileStorage().get_podcasts(), podcasts, 'podcasts'),
+        ('fetch', reset, lambda: FetchEpisodes().handle(jobs=JOBS),
+         podcasts, 'feeds'),
+        ('list', clear_cache, lambda: ListEpisodes().handle(number=100),
+         100, 'episodes'),
+        ('download_best', reset,
+         lambda: DownloadBest().handle(10, jobs=JOBS), 10, 'episodes'),
+        ('download', lambda: shutil.rmtree(
+            os.path.join(data_dir, 'files'), ignore_errors=True),
+         download_files, NUMBER_OF_DOWNLOADS * MEDIA_SIZE, 'bytes'),
+    ]
+    results = []
+    for name, setup, run, items, unit in benchmarks:
+        seconds, peak = measure(setup, run)
+        results.append({
+            'benchmark': name,
+            'podcasts': podcasts,
+            'episodes': episodes,
+            'seconds': seconds,
+            'throughput': items / seconds,
+            'unit': '%s/s' % unit,
+            'peak_bytes': peak,
+        })
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument(
+        '--scale', choices=sorted(SCALES), action='append',
+        help='podcasts and episodes to run with; by default small and '
+             'medium')
+    parser.add_argument(
+        '--json', action='store_true', help='print the results as JSON')
+    args = parser.parse_args()
+
+    results = []
+    with tempfile.TemporaryDirectory() as temp_dir:
+        data_dir = os.path.join(temp_dir, 'riley')
+        storage.user_data_dir = lambda appname, appauthor: data_dir
+        for scale in args.scale or DEFAULT_SCALES:
+            podcasts, episodes = SCALES[scale]
+            files = SyntheticFiles(None, episodes)
+            with Server(files) as server:
+                files.url = server.url
+                download.configure_session(JOBS)
+                results.extend(run_scale(data_dir, server, podcasts,
+                                         episodes))
+            if not args.json:
+                print_results([r for r in results if
+                               (r['podcasts'], r['episodes']) ==
+                               (podcasts, episodes)])
+
+    if args.json:
+        json.dump({
+            'time': int(time.time()),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'results': results,
+        }, sys.stdout, indent=2)
+        print()
+
+
+def print_results(results):
+    print('%d podcasts, %d episodes each' % (
+        results[0]['podcasts'], results[0]['episodes']))
+    print('%-14s %10s %20s %10s' % ('', 'seconds', 'throughput', 'peak MiB'))
+    for r in results:
+        print('%-14s %10.3f %20s %10.1f' % (
+            r['benchmark'], r['seconds'],
+            '%.1f %s' % (r['throughput'], r['unit']),
+            r['peak_bytes'] / 1024 / 1024))
+    print()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,14 +1,55 @@
 import argparse
+import calendar
+import cProfile
 import heapq
 import os
 import sys
+import time
 from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from itertools import chain
+from operator import attrgetter
+from urllib.parse import urlparse
 
-import feedparser
-from riley import download
+from riley import scoring
+from riley.lazy import lazy_import, preload
 from riley.models import Podcast, Episode
-from riley.storage import AbstractFileStorage, FileStorage, FileEpisodeStorage
+from riley.storage import AbstractFileStorage, CachedFileStorage, \
+    FileStorage, SQLiteStorage
+from riley.timings import timings
+
+# Only the commands that fetch or download pay for importing these
+daemon = lazy_import('riley.daemon')
+feedparser = lazy_import('feedparser')
+download = lazy_import('riley.download')
+feeds = lazy_import('riley.feeds')
+pipeline = lazy_import('riley.pipeline')
+schedule = lazy_import('riley.schedule')
+transfers = lazy_import('riley.transfers')
+
+# Seconds between writes of podcasts saved during a long running command
+SAVE_INTERVAL = 60
+
+# Storage used by all commands while they're run by the daemon
+shared_storage = None
+
+
+def get_storage(cached=False):
+    """
+    :param cached: Keep the podcasts and episodes of a file storage in
+        memory, for a long running process.
+    :type cached: bool
+    :return: The storage selected with the 'backend' setting in config.yml.
+    :rtype: riley.storage.Storage
+    """
+    if shared_storage is not None:
+        return shared_storage
+    file_storage = FileStorage()
+    if file_storage.get_config().get('backend') == 'sqlite':
+        return SQLiteStorage()
+    if cached:
+        return CachedFileStorage()
+    return file_storage
 
 
 class BaseCommand:
@@ -20,6 +61,13 @@ class BaseCommand:
             prog='%s %s' % (prog_name, subcommand),
             description=self.help or None)
         self.add_arguments(parser)
+        parser.add_argument(
+            '--timings', action='store_true',
+            help='print the time spent in each phase of the command')
+        parser.add_argument(
+            '--profile', metavar='FILE',
+            help='profile the command and save the stats to FILE, which can '
+                 'be read with pstats; only the main thread is profiled')
         return parser
 
     def add_arguments(self, parser):
@@ -28,7 +76,24 @@ class BaseCommand:
     def execute(self, argv):
         parser = self.create_parser(os.path.basename(argv[0]), argv[1])
         options = vars(parser.parse_args(argv[2:]))
-        self.handle(**options)
+        show_timings = options.pop('timings')
+        profile_path = options.pop('profile')
+        profiler = cProfile.Profile() if profile_path is not None else None
+        if show_timings:
+            timings.start()
+        start = time.perf_counter()
+        try:
+            if profiler is not None:
+                profiler.runcall(self.handle, **options)
+            else:
+                self.handle(**options)
+        finally:
+            if show_timings:
+                timings.add('total', time.perf_counter() - start)
+                timings.stop()
+                timings.report()
+            if profiler is not None:
+                profiler.dump_stats(profile_path)
 
     def handle(self, *args, **options):
         raise NotImplementedError(
@@ -46,7 +111,7 @@ class ListPodcasts(BaseCommand):
     help = 'Print a list of podcasts.'
 
     def handle(self):
-        for podcast in FileStorage().get_podcasts().values():
+        for podcast in get_storage().get_podcasts().values():
             try:
                 print(podcast.name, podcast.feed)
             except BrokenPipeError:
@@ -63,9 +128,9 @@ class Insert(BaseCommand):
             'url', metavar='url', type=str, help='podcast feed URL')
 
     def handle(self, name, url):
-        file_storage = FileStorage()
-        if name not in file_storage.get_podcasts():
-            file_storage.save_podcast(Podcast(name, url, FileEpisodeStorage()))
+        storage = get_storage()
+        if name not in storage.get_podcasts():
+            storage.save_podcast(Podcast(name, url, storage.episode_storage))
         else:
             sys.exit("The name '%s' is already registered." % name)
 
@@ -77,15 +142,25 @@ class ListEpisodes(BaseCommand):
         parser.add_argument(
             'podcast_name', metavar='podcast', type=str, nargs='?',
             help='podcast name')
+        parser.add_argument(
+            '-n', '--number', type=int,
+            help='only print this many of the latest episodes')
+        parser.add_argument(
+            '--since', type=lambda s: time.strptime(s, '%Y-%m-%d'),
+            help='only print episodes published on this date (YYYY-MM-DD) '
+                 'or later')
 
-    def handle(self, podcast_name=None):
+    def handle(self, podcast_name=None, number=None, since=None):
+        storage = get_storage()
         if podcast_name is not None:
-            episodes = FileStorage().get_podcasts()[podcast_name].episodes
+            # Read the history only as far as needed
+            podcast = storage.get_podcasts()[podcast_name]
+            episodes = storage.episode_storage.iter_episodes(
+                podcast, number, since)
         else:
-            episodes = []
-            for podcast in FileStorage().get_podcasts().values():
-                episodes.extend(podcast.episodes)
-            episodes.sort(key=lambda e: e.published, reverse=True)
+            # Merge the podcasts' histories lazily, so that the first episodes
+            # are printed without reading every history
+            episodes = storage.iter_latest_episodes(number, since)
         for episode in episodes:
             try:
                 print(episode.title, episode.media_href)
@@ -100,36 +175,273 @@ class FetchEpisodes(BaseCommand):
         parser.add_argument(
             'podcast_name', metavar='podcast', type=str, nargs='?',
             help='podcast name')
+        parser.add_argument(
+            '-j', '--jobs', type=int, default=1,
+            help='number of feeds to fetch concurrently')
+        parser.add_argument(
+            '--full', action='store_true',
+            help='check every entry of the feeds, for feeds that reorder '
+                 'their entries')
+        parser.add_argument(
+            '--parser', choices=feeds.PARSERS, default='auto',
+            help='how to parse the feeds; by default large feeds are parsed '
+                 'by the streaming parser')
+        parser.add_argument(
+            '--due', action='store_true',
+            help='only fetch the feeds that are due, going by how often '
+                 'their podcasts publish episodes')
 
-    def handle(self, podcast_name=None):
-        file_storage = FileStorage()
+    def handle(self, podcast_name=None, jobs=1, full=False, parser='auto',
+               due=False):
+        storage = get_storage()
 
         if podcast_name is None:
-            podcasts = file_storage.get_podcasts().values()
+            podcasts = storage.get_podcasts().values()
         else:
-            podcasts = [file_storage.get_podcasts()[podcast_name]]
-
-        for podcast in podcasts:
-            print(podcast.name)
-            feed = feedparser.parse(podcast.feed)
-            episodes = []
-            for entry in feed.entries:
-                enclosures = getattr(entry, 'enclosures', [])
-                if len(enclosures) == 0:
+            podcasts = [storage.get_podcasts()[podcast_name]]
+        if due:
+            now = time.time()
+            fetch_schedule = storage.get_schedule()
+            podcasts = [podcast for podcast in podcasts if schedule.is_due(
+                fetch_schedule.get(podcast.name), now)]
+
+        download.configure_session(jobs)
+        preload(feeds)
+
+        # The feeds are downloaded and parsed by the workers, while the results
+        # are merged and saved in the main thread in the podcasts' order
+        unchanged = 0
+        fetched = {}
+        with ThreadPoolExecutor(max_workers=max(jobs, 1)) as executor, \
+                storage.batch(interval=SAVE_INTERVAL):
+            futures = [(podcast, executor.submit(self.fetch, podcast,
+                                                 parser=parser))
+                       for podcast in podcasts]
+            for podcast, future in futures:
+                print(podcast.name)
+                try:
+                    feed = future.result()
+                except Exception as e:
+                    print("Could not fetch '%s': %s" % (podcast.name, e),
+                          file=sys.stderr)
                     continue
-                # Use an empty string when no link is available
-                link = getattr(entry, 'link', '')
-                media_href = entry.enclosures[0].href
-                episodes.append(
-                    Episode(podcast, entry.guid, entry.title, link, media_href,
-                            entry.published_parsed, False))
-            for episode in episodes:
-                if episode not in podcast.episodes:
-                    podcast.episodes.append(episode)
-            FileEpisodeStorage().save_episodes(podcast)
-
-
-class DownloadEpisodes(BaseCommand):
+                if feed.get('status') == 304:
+                    # Nothing has been published since the last fetch
+                    unchanged += 1
+                else:
+                    self.update(storage, podcast, feed, full)
+                fetched[podcast.name] = [
+                    time.time(), self.get_polling_interval(
+                        storage, podcast, feed)]
+        if fetched:
+            storage.update_schedule(fetched)
+        if unchanged > 0:
+            print('%d of %d feeds unchanged.' % (unchanged, len(futures)))
+
+    @staticmethod
+    def fetch(podcast, parser='auto'):
+        """
+        Download and parse a podcast's feed. The feed isn't downloaded again
+        if the server says it hasn't changed since the last fetch.
+
+        :type podcast: riley.models.Podcast
+        :param parser: One of feeds.PARSERS.
+        :type parser: str
+        :rtype: feedparser.FeedParserDict
+        """
+        if urlparse(podcast.feed).scheme not in ('http', 'https'):
+            if not os.path.isfile(podcast.feed):
+                # Other URLs are opened by feedparser itself
+                with timings.phase('fetch feed', podcast.name):
+                    return feedparser.parse(podcast.feed)
+            with timings.phase('fetch feed', podcast.name), \
+                    open(podcast.feed, 'rb') as f:
+                data = f.read()
+            with timings.phase('parse feed', podcast.name):
+                return feeds.parse(data, parser)
+        headers = {}
+        if podcast.etag is not None:
+            headers['If-None-Match'] = podcast.etag
+        if podcast.last_modified is not None:
+            headers['If-Modified-Since'] = podcast.last_modified
+        with timings.phase('fetch feed', podcast.name):
+            response = download.get_session().get(
+                podcast.feed, headers=headers, timeout=download.TIMEOUT)
+        if response.status_code == 304:
+            return feedparser.FeedParserDict(status=304,
+                                             headers=response.headers)
+        response.raise_for_status()
+        with timings.phase('parse feed', podcast.name):
+            feed = feeds.parse(response.content, parser,
+                               response_headers=response.headers)
+        # Set the same keys as feedparser does when it downloads a feed
+        feed['status'] = response.status_code
+        feed['etag'] = response.headers.get('etag')
+        feed['modified'] = response.headers.get('last-modified')
+        return feed
+
+    @classmethod
+    def update(cls, storage, podcast, feed, full=False):
+        """
+        Add the feed's new episodes to the podcast and save it.
+
+        :type storage: riley.storage.Storage
+        :type podcast: riley.models.Podcast
+        :type feed: feedparser.FeedParserDict
+        :param full: Check every entry of the feed.
+        :type full: bool
+        :return: The new episodes.
+        :rtype: list
+        """
+        podcast.etag = feed.get('etag')
+        podcast.last_modified = feed.get('modified')
+        with timings.phase('merge', podcast.name):
+            high_water_mark = None
+            if not full and cls.is_newest_first(feed):
+                high_water_mark = cls.get_high_water_mark(
+                    storage, podcast, len(feed.entries))
+            episodes = cls.get_episodes(podcast, feed, high_water_mark)
+            if len(episodes) > 0:
+                episodes = cls.merge(podcast, episodes)
+        storage.save_podcast(podcast)
+        return episodes
+
+    @staticmethod
+    def get_polling_interval(storage, podcast, feed):
+        """
+        :type storage: riley.storage.Storage
+        :type podcast: riley.models.Podcast
+        :type feed: feedparser.FeedParserDict
+        :return: Seconds to wait before fetching the feed again.
+        :rtype: float
+        """
+        if podcast.episodes_modified:
+            # The new episodes may not have been written yet
+            episodes = heapq.nlargest(schedule.CADENCE_EPISODES,
+                                      podcast.episodes,
+                                      key=attrgetter('timestamp'))
+        else:
+            episodes = storage.episode_storage.iter_episodes(
+                podcast, schedule.CADENCE_EPISODES)
+        return schedule.polling_interval(
+            [episode.timestamp for episode in episodes],
+            schedule.feed_ttl(feed))
+
+    @staticmethod
+    def is_newest_first(feed):
+        """
+        :type feed: feedparser.FeedParserDict
+        :return: Whether the feed's entries are listed from the latest, which
+            most feeds do.
+        """
+        published = [getattr(entry, 'published_parsed', None)
+                     for entry in feed.entries]
+        published = [p for p in published if p is not None]
+        return len(published) < 2 or published[0] >= published[-1]
+
+    @staticmethod
+    def get_high_water_mark(storage, podcast, number):
+        """
+        Read only the podcast's latest stored episodes, to tell where the new
+        entries of its feed end.
+
+        :param number: Number of episodes to read, which is the number of
+            entries in the feed.
+        :return: Timestamp of the latest stored episode, or None if there are
+            no episodes, and the GUIDs of the `number` latest episodes.
+        :rtype: tuple
+        """
+        episodes = list(storage.episode_storage.iter_episodes(
+            podcast, limit=number))
+        if len(episodes) == 0:
+            return None, set()
+        return episodes[0].timestamp, {episode.guid for episode in episodes}
+
+    @staticmethod
+    def get_episodes(podcast, feed, high_water_mark=None):
+        """
+        :type podcast: riley.models.Podcast
+        :type feed: feedparser.FeedParserDict
+        :param high_water_mark: Skip the entries with known GUIDs, and stop at
+            the first entry that is older than the latest stored episode.
+        :type high_water_mark: tuple
+        :return: List of episodes found in the feed.
+        """
+        latest, known_guids = high_water_mark or (None, set())
+        episodes = []
+        for entry in feed.entries:
+            if getattr(entry, 'guid', None) in known_guids:
+                continue
+            enclosures = getattr(entry, 'enclosures', [])
+            if len(enclosures) == 0:
+                continue
+            published = getattr(entry, 'published_parsed', None)
+            if latest is not None and published is not None and \
+                    calendar.timegm(published) < latest:
+                # The feed lists its entries from the latest, so the rest of
+                # them are older too
+                break
+            # Use an empty string when no link is available
+            link = getattr(entry, 'link', '')
+            media_href = entry.enclosures[0].href
+            episodes.append(
+                Episode(podcast, entry.guid, entry.title, link, media_href,
+                        entry.published_parsed, False))
+        return episodes
+
+    @staticmethod
+    def merge(podcast, episodes):
+        """
+        Add the episodes that aren't stored yet. This loads the podcast's
+        episodes.
+
+        :type podcast: riley.models.Podcast
+        :type episodes: list
+        :return: The added episodes.
+        :rtype: list
+        """
+        added = []
+        for episode in episodes:
+            if episode not in podcast.episodes:
+                podcast.episodes.append(episode)
+                added.append(episode)
+        return added
+
+
+class BaseDownloadCommand(BaseCommand):
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '-j', '--jobs', type=int, default=1,
+            help='number of episodes to download concurrently')
+        parser.add_argument(
+            '--per-host', type=int, default=4,
+            help='maximum number of concurrent downloads from the same host')
+
+    def download_episodes(self, storage, episodes, jobs=1, per_host=4,
+                          on_start=None):
+        """
+        Download the episodes and mark each one as downloaded as soon as its
+        own transfer has completed. The podcasts are written to disc
+        periodically and when all downloads are done. Exits with an error if
+        any of the downloads failed.
+        """
+        def on_done(episode):
+            episode.downloaded = True
+            storage.save_podcast(episode.podcast)
+
+        # All transfers reuse the connections of the shared session
+        download.configure_session(jobs)
+        download_directory = storage.get_config()['storage']
+        queue = transfers.DownloadQueue(download.download, jobs, per_host)
+        with storage.batch(interval=SAVE_INTERVAL):
+            failed = queue.run(
+                episodes, download_directory, on_done, on_start)
+        if failed:
+            sys.exit('%d of the episodes could not be downloaded.'
+                     % len(failed))
+
+
+class DownloadEpisodes(BaseDownloadCommand):
     help = 'Download episodes.'
 
     def add_arguments(self, parser):
@@ -138,10 +450,11 @@ class DownloadEpisodes(BaseCommand):
             type=str, nargs='*',
             help='podcast name followed by an episode range; this pattern can '
                  'be repeated multiple times')
+        super().add_arguments(parser)
 
-    def handle(self, podcasts_and_episodes):
-        file_storage = FileStorage()
-        podcasts = file_storage.get_podcasts()
+    def handle(self, podcasts_and_episodes, jobs=1, per_host=4):
+        storage = get_storage()
+        podcasts = storage.get_podcasts()
 
         podcasts_and_episodes_to_download = OrderedDict()
         podcast = None
@@ -192,12 +505,7 @@ class DownloadEpisodes(BaseCommand):
             episodes = chain.from_iterable(
                 podcast.episodes for podcast in podcasts.values())
 
-        download_directory = file_storage.get_config()['storage']
-        for episode in episodes:
-            download.download(episode.media_href, download_directory,
-                              episode.published)
-            episode.downloaded = True
-            FileStorage().save_podcast(episode.podcast)
+        self.download_episodes(storage, episodes, jobs, per_host)
 
     @staticmethod
     def get_indices(string):
@@ -233,30 +541,152 @@ class DownloadEpisodes(BaseCommand):
         return list(episode_indices_to_download)
 
 
-class DownloadBest(BaseCommand):
+class DownloadBest(BaseDownloadCommand):
     help = 'Download the best and latest episodes.'
 
     def add_arguments(self, parser):
         parser.add_argument(
             'number_of_episodes', metavar='number of episodes', type=int,
             help='the number of episodes')
+        super().add_arguments(parser)
 
-    def handle(self, number_of_episodes):
-        file_storage = FileStorage()
-        podcasts = file_storage.get_podcasts()
+    def handle(self, number_of_episodes, jobs=1, per_host=4):
+        storage = get_storage()
+        podcasts = storage.get_podcasts()
 
-        episodes = []
-        for podcast in podcasts.values():
-            episodes.extend(podcast.episodes)
+        candidates = storage.get_download_candidates(number_of_episodes)
+        best = scoring.best_candidates(
+            candidates, podcasts, number_of_episodes)
+        # Only the histories of the podcasts with a picked episode are loaded
+        episodes = [podcasts[name].episodes.get_by_guid(guid)
+                    for name, guid in best]
+        episodes = [episode for episode in episodes if episode is not None]
 
-        episodes = heapq.nlargest(
-            number_of_episodes, episodes, key=lambda e: e.score)
+        def on_start(episode):
+            print("Downloading '{}' from '{}'.".format(
+                episode.title, episode.podcast.name))
 
-        download_directory = file_storage.get_config()['storage']
-        for episode in episodes:
+        self.download_episodes(storage, episodes, jobs, per_host,
+                               on_start)
+
+
+class Sync(BaseCommand):
+    help = 'Fetch the feeds and download their new episodes, starting the ' \
+           'downloads while other feeds are still being fetched.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '-n', '--number', type=int,
+            help='maximum number of episodes to download')
+        parser.add_argument(
+            '-j', '--jobs', type=int, default=4,
+            help='number of feeds and episodes to fetch and download '
+                 'concurrently')
+        parser.add_argument(
+            '--per-host', type=int, default=4,
+            help='maximum number of concurrent downloads from the same host')
+        parser.add_argument(
+            '--parser', choices=feeds.PARSERS, default='auto',
+            help='how to parse the feeds; by default large feeds are parsed '
+                 'by the streaming parser')
+
+    def handle(self, number=None, jobs=4, per_host=4, parser='auto'):
+        storage = get_storage()
+        podcasts = storage.get_podcasts().values()
+
+        def fetch(podcast):
+            return FetchEpisodes.fetch(podcast, parser=parser)
+
+        def update(podcast, feed):
+            if feed.get('status') == 304:
+                return []
+            # The first fetch of a podcast only records its back catalogue
+            first = not any(storage.episode_storage.iter_episodes(
+                podcast, limit=1))
+            episodes = FetchEpisodes.update(storage, podcast, feed)
+            return [] if first else episodes
+
+        def on_start(episode):
             print("Downloading '{}' from '{}'.".format(
                 episode.title, episode.podcast.name))
-            download.download(episode.media_href, download_directory,
-                              episode.published)
+
+        def on_done(episode):
             episode.downloaded = True
-            FileStorage().save_podcast(episode.podcast)
+            storage.save_podcast(episode.podcast)
+
+        download.configure_session(jobs)
+        preload(feeds)
+        sync = pipeline.Pipeline(fetch, update, download.download,
+                                 storage.get_config()['storage'], jobs,
+                                 per_host, number, on_done, on_start)
+        with storage.batch(interval=SAVE_INTERVAL):
+            failed = sync.run(podcasts)
+        if failed:
+            sys.exit('%d of the episodes could not be downloaded.'
+                     % len(failed))
+
+
+class Serve(BaseCommand):
+    help = 'Keep the podcasts and episodes in memory and run the list, ' \
+           'podcasts, fetch and download commands for the CLI, which uses ' \
+           'this daemon when it is running.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '-i', '--interval', type=float, default=900,
+            help='seconds between checks for feeds that are due to be '
+                 'fetched; 0 to not fetch them')
+        parser.add_argument(
+            '-j', '--jobs', type=int, default=4,
+            help='number of feeds to fetch concurrently')
+
+    def handle(self, interval=900, jobs=4):
+        path = daemon.get_socket_path()
+        try:
+            server = daemon.Daemon(path, get_storage(cached=True),
+                                   interval or None, jobs)
+        except OSError as e:
+            sys.exit(str(e))
+        print("Serving at '%s'." % path)
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+
+
+class MigrateToSQLite(BaseCommand):
+    help = 'Copy the podcasts and their episodes into an SQLite database and ' \
+           'use it from now on.'
+
+    def handle(self):
+        file_storage = FileStorage()
+        sqlite_storage = SQLiteStorage()
+        with sqlite_storage.batch():
+            for podcast in file_storage.get_podcasts().values():
+                print(podcast.name)
+                copy = Podcast(podcast.name, podcast.feed,
+                               sqlite_storage.episode_storage, podcast.priority,
+                               podcast.etag, podcast.last_modified)
+                for episode in podcast.episodes:
+                    if episode not in copy.episodes:
+                        copy.episodes.append(Episode.from_tuple(
+                            copy, episode.str_attributes()))
+                sqlite_storage.save_podcast(copy)
+        with file_storage.lock():
+            config = file_storage.get_config()
+            config['backend'] = 'sqlite'
+            file_storage._save_config_data(config)
+
+
+class Upgrade(BaseCommand):
+    help = 'Rewrite the episode histories in the current storage format.'
+
+    def handle(self):
+        storage = get_storage()
+        with storage.batch():
+            for podcast in storage.get_podcasts().values():
+                print(podcast.name)
+                podcast.episodes.modified = True
+                storage.save_podcast(podcast)
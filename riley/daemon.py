@@ -0,0 +1,206 @@
+import io
+import json
+import os
+import socket
+import socketserver
+import sys
+import threading
+import time
+import traceback
+from contextlib import redirect_stderr, redirect_stdout
+
+from riley import commands
+from riley.main import ManagementUtility
+from riley.storage import AbstractFileStorage
+
+# Seconds that the daemon may take to take a command, and that a client
+# may take to send one
+TIMEOUT = 5
+# Seconds that a command waits for the one that the daemon is running before
+# it's run without the daemon
+BUSY_TIMEOUT = 1
+
+
+def get_socket_path():
+    return os.path.join(AbstractFileStorage()._user_data_dir_path,
+                        'riley.sock')
+
+
+def call(argv, path=None):
+    """
+    Run a command in the daemon and print its output.
+
+    :type argv: list
+    :param path: Path to the daemon's socket.
+    :type path: str
+    :return: The command's exit status, or None if the daemon isn't running,
+        is busy with another command or doesn't take the command in time.
+    :rtype: int
+    """
+    if not hasattr(socket, 'AF_UNIX'):
+        return None
+    if path is None:
+        path = get_socket_path()
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    client.settimeout(TIMEOUT)
+    try:
+        client.connect(path)
+    except (FileNotFoundError, ConnectionRefusedError, socket.timeout):
+        client.close()
+        return None
+    with client, client.makefile('rwb') as f:
+        try:
+            f.write(json.dumps({'argv': argv}).encode() + b'\n')
+            f.flush()
+            # The daemon answers as soon as it starts running the command
+            accepted = json.loads(f.readline().decode())['accepted']
+        except socket.timeout:
+            return None
+        if not accepted:
+            return None
+        # Downloads may take long, but the daemon's requests time out when a
+        # server stalls
+        client.settimeout(None)
+        response = json.loads(f.readline().decode())
+    sys.stdout.write(response['stdout'])
+    sys.stderr.write(response['stderr'])
+    return response['status']
+
+
+class _Handler(socketserver.StreamRequestHandler):
+    timeout = TIMEOUT
+
+    def handle(self):
+        try:
+            line = self.rfile.readline()
+        except socket.timeout:
+            # The client never sent its command
+            return
+        if not line:
+            # Only checking whether the daemon is running
+            return
+        request = json.loads(line.decode())
+        if not self.server.running.acquire(timeout=BUSY_TIMEOUT):
+            # The client runs the command itself instead of waiting
+            self._send({'accepted': False})
+            return
+        try:
+            self._send({'accepted': True})
+            stdout, stderr, status = self.server.run(request['argv'])
+        finally:
+            self.server.running.release()
+        self._send({'stdout': stdout, 'stderr': stderr, 'status': status})
+
+    def _send(self, message):
+        self.wfile.write(json.dumps(message).encode() + b'\n')
+        self.wfile.flush()
+
+
+class Daemon(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """
+    Runs the commands sent by the CLI over a Unix socket, with one storage
+    which keeps the podcasts and episodes in memory between them. Every
+    `interval` seconds, the feeds that are due are fetched.
+
+    The commands run one at a time. Each connection is handled in a thread
+    of its own, so that a command sent while another one is running is
+    turned away quickly and the CLI runs it instead.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, path, storage, interval=None, jobs=4):
+        """
+        :param path: Path to the socket.
+        :type path: str
+        :type storage: riley.storage.Storage
+        :param interval: Seconds between checks for feeds that are due, or
+            None to not fetch them.
+        :type interval: float
+        :param jobs: Number of feeds to fetch concurrently.
+        :type jobs: int
+        """
+        self.storage = storage
+        self.interval = interval
+        self.jobs = jobs
+        # Held while a command runs
+        self.running = threading.RLock()
+        self._next_fetch = None
+        self._fetch_thread = None
+        if interval is not None:
+            self._next_fetch = time.monotonic() + interval
+        if is_running(path):
+            raise OSError("riley is already served at '%s'" % path)
+        if os.path.exists(path):
+            # Left behind by a daemon that didn't exit cleanly
+            os.remove(path)
+        super().__init__(path, _Handler)
+
+    def run(self, argv):
+        """
+        Run a command with its output captured, after the command that is
+        running has finished.
+
+        :type argv: list
+        :return: What the command printed to stdout and stderr, and its exit
+            status.
+        :rtype: tuple
+        """
+        stdout, stderr = io.StringIO(), io.StringIO()
+        status = 0
+        with self.running:
+            commands.shared_storage = self.storage
+            try:
+                with redirect_stdout(stdout), redirect_stderr(stderr):
+                    try:
+                        ManagementUtility().get_command(argv[1]).execute(argv)
+                    except SystemExit as e:
+                        if isinstance(e.code, str):
+                            print(e.code, file=sys.stderr)
+                            status = 1
+                        else:
+                            status = e.code or 0
+                    except Exception:
+                        traceback.print_exc()
+                        status = 1
+            finally:
+                commands.shared_storage = None
+        return stdout.getvalue(), stderr.getvalue(), status
+
+    def service_actions(self):
+        if self._next_fetch is None or time.monotonic() < self._next_fetch:
+            return
+        # The fetch runs in a thread of its own, so that connections are
+        # still answered in the meantime
+        self._next_fetch = None
+        self._fetch_thread = threading.Thread(target=self._fetch_due,
+                                              daemon=True)
+        self._fetch_thread.start()
+
+    def _fetch_due(self):
+        with self.running:
+            _stdout, stderr, _status = self.run(
+                ['riley', 'fetch', '--due', '--jobs', str(self.jobs)])
+            # While no other command has redirected stderr
+            sys.stderr.write(stderr)
+        self._next_fetch = time.monotonic() + self.interval
+
+    def server_close(self):
+        super().server_close()
+        if os.path.exists(self.server_address):
+            os.remove(self.server_address)
+
+
+def is_running(path):
+    """
+    :return: Whether a daemon is listening on the socket.
+    :rtype: bool
+    """
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        client.connect(path)
+    except OSError:
+        return False
+    finally:
+        client.close()
+    return True
@@ -1,53 +1,311 @@
 import cgi
+import io
+import json
 import os
+import re
+import sys
+import threading
 import time
 from functools import partial
 from urllib.parse import urlparse
 
 import requests
-from clint.textui.progress import Bar
+from clint.textui import progress as clint_progress
+from riley.timings import timings
+from urllib3.exceptions import ProtocolError, ReadTimeoutError
 
 
-def download(url, to_dir, datetime=None):
+# Reading the raw response raises urllib3's exceptions instead of requests'
+RETRIABLE_ERRORS = (requests.ConnectionError, requests.Timeout,
+                    requests.exceptions.ChunkedEncodingError, ProtocolError,
+                    ReadTimeoutError)
+
+# Size of the first read from a response and the size reads may grow to
+CHUNK_SIZE = 64 * 1024
+MAX_CHUNK_SIZE = 1024 * 1024
+# Minimum number of seconds between progress bar redraws
+PROGRESS_INTERVAL = 0.1
+# Seconds to wait for a server to accept a connection or to send more data,
+# so that a stalled server doesn't block the other commands in the daemon
+TIMEOUT = 30
+
+USER_AGENT = 'Riley/1.0'
+DEFAULT_POOL_SIZE = 10
+
+_session = None
+_session_lock = threading.Lock()
+
+
+def configure_session(pool_size=DEFAULT_POOL_SIZE):
+    """
+    Replace the shared session with one that keeps up to `pool_size`
+    connections alive per host. Commands call this with their concurrency
+    before making any requests.
+
+    :type pool_size: int
+    :rtype: requests.Session
+    """
+    global _session
+    pool_size = max(pool_size, DEFAULT_POOL_SIZE)
+    session = requests.Session()
+    session.headers['User-Agent'] = USER_AGENT
+    adapter = requests.adapters.HTTPAdapter(
+        pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    with _session_lock:
+        if _session is not None:
+            _session.close()
+        _session = session
+    return session
+
+
+def get_session():
+    """
+    :return: The session shared by all feed and media requests, so that
+        connections to the same host are reused.
+    :rtype: requests.Session
+    """
+    with _session_lock:
+        session = _session
+    if session is None:
+        session = configure_session()
+    return session
+
+
+def download(url, to_dir, datetime=None, progress=None, retries=2,
+             session=None, chunk_size=CHUNK_SIZE):
     """
+    Download a file to a directory. The data is first written to a '.part'
+    file, from which an interrupted download is resumed on retry.
+
     :type url: str
     :type to_dir: str
     :type datetime: time.struct_time
+    :param progress: Shared progress to report to instead of showing a
+        progress bar for this file.
+    :type progress: riley.transfers.AggregateProgress
+    :param retries: Number of times to resume after a connection error.
+    :type retries: int
+    :param session: Session to use instead of the shared one.
+    :type session: requests.Session
+    :param chunk_size: Size of the first read from the response.
+    :type chunk_size: int
     """
+    if session is None:
+        session = get_session()
     os.makedirs(to_dir, exist_ok=True)
-    response = requests.get(url, stream=True)
+    start = time.perf_counter()
+    for attempt in range(retries + 1):
+        try:
+            save_path = _download_to_part_file(
+                session, url, to_dir, progress, chunk_size)
+        except RETRIABLE_ERRORS:
+            if attempt == retries:
+                raise
+        else:
+            break
+    if timings.enabled:
+        timings.add_transfer(url, os.path.getsize(save_path),
+                             time.perf_counter() - start)
+    if datetime is not None:
+        unix_timestamp = int(time.mktime(datetime))
+        os.utime(save_path, (unix_timestamp, unix_timestamp))
+
+
+def _download_to_part_file(session, url, to_dir, progress, chunk_size):
+    """
+    :return: Path to the completed file.
+    """
+    response = session.get(url, stream=True, timeout=TIMEOUT)
+    # An error page mustn't be saved as the episode
+    response.raise_for_status()
     save_path = os.path.join(to_dir, get_file_name(response))
-    with open(save_path, 'wb') as f:
+    part_path = save_path + '.part'
+    meta_path = part_path + '.json'
+
+    offset, validators = _resumable_size(part_path, meta_path, response)
+    content_length = response.headers.get('content-length')
+    if offset is not None and content_length is not None and \
+            offset == int(content_length):
+        # Everything was downloaded but the file was never renamed
+        response.close()
+    else:
+        if offset is not None:
+            response.close()
+            response = session.get(url, stream=True, timeout=TIMEOUT, headers={
+                'Range': 'bytes=%d-' % offset,
+                # Only get the rest if the file is still the same
+                'If-Range': validators['etag'] or validators['last_modified'],
+            })
+            if response.status_code == 416:
+                # The partial file is longer than the file on the server
+                response.close()
+                response = session.get(url, stream=True, timeout=TIMEOUT)
+            response.raise_for_status()
+            if _content_range_start(response) != offset:
+                # The server sent the whole file instead
+                offset = None
+        if offset is None:
+            offset = 0
+            _save_validators(meta_path, response)
+        _write(response, part_path, offset, progress, chunk_size)
+    os.replace(part_path, save_path)
+    if os.path.exists(meta_path):
+        os.remove(meta_path)
+    return save_path
+
+
+def _write(response, part_path, offset, progress, chunk_size):
+    with open(part_path, 'ab' if offset > 0 else 'wb') as f:
         content_length = response.headers.get('content-length')
-        if content_length is None:
-            download = partial(_download, response)
+        if progress is not None:
+            if content_length is not None:
+                progress.add_expected(int(content_length))
+            download = partial(_download_with_progress, response, progress,
+                               chunk_size)
+        elif content_length is None:
+            download = partial(_download, response, chunk_size)
         else:
             length = int(content_length)
-            download = partial(_download_with_progressbar, response, length)
+            download = partial(_download_with_progressbar, response, length,
+                               chunk_size)
         for block in download():
             f.write(block)
-    if datetime is not None:
-        unix_timestamp = int(time.mktime(datetime))
-        os.utime(save_path, (unix_timestamp, unix_timestamp))
 
 
-def _download(response):
+def _resumable_size(part_path, meta_path, response):
+    """
+    Validate a partially downloaded file against the server's response.
+
+    :return: Number of bytes to resume from, or None to start over, and the
+        validators saved when the download started.
     """
+    if not os.path.exists(part_path) or not os.path.exists(meta_path):
+        return None, None
+    with open(meta_path) as f:
+        try:
+            validators = json.load(f)
+        except ValueError:
+            return None, None
+    if validators != _validators(response):
+        return None, None
+    if validators['etag'] is None and validators['last_modified'] is None:
+        # There is nothing to tell if the file has changed on the server
+        return None, None
+    size = os.path.getsize(part_path)
+    content_length = validators['content_length']
+    if size == 0 or (content_length is not None and size > content_length):
+        return None, None
+    return size, validators
+
+
+def _validators(response):
+    content_length = response.headers.get('content-length')
+    return {
+        'etag': response.headers.get('etag'),
+        'last_modified': response.headers.get('last-modified'),
+        'content_length': int(content_length) if content_length else None,
+    }
+
+
+def _save_validators(meta_path, response):
+    with open(meta_path, 'w') as f:
+        json.dump(_validators(response), f)
+
+
+def _content_range_start(response):
+    """
+    :return: First byte position of a partial response or None.
+    """
+    if response.status_code != 206:
+        return None
+    content_range = response.headers.get('content-range', '')
+    match = re.match(r'bytes (\d+)-\d+/', content_range)
+    if match is None:
+        return None
+    return int(match.group(1))
+
+
+def _iter_blocks(response, chunk_size=CHUNK_SIZE):
+    """
+    Read the response body in blocks. Unless the body is compressed, it is
+    read straight into a reusable buffer, whose used part grows from
+    `chunk_size` up to MAX_CHUNK_SIZE as long as the reads fill it.
+
+    The yielded memoryviews are only valid until the next block is read.
+
     :type response: requests.Response
+    :type chunk_size: int
     """
-    for i, block in enumerate(response.iter_content(1024), 1):
-        yield block
+    raw = response.raw
+    content_encoding = response.headers.get('content-encoding', 'identity')
+    if not isinstance(raw, io.IOBase) or content_encoding != 'identity':
+        yield from response.iter_content(chunk_size)
+        return
+    buffer = memoryview(bytearray(max(chunk_size, MAX_CHUNK_SIZE)))
+    size = chunk_size
+    while True:
+        read = raw.readinto(buffer[:size])
+        if not read:
+            return
+        yield buffer[:read]
+        if read == size and size < MAX_CHUNK_SIZE:
+            size = min(size * 2, MAX_CHUNK_SIZE)
+
+
+def _download(response, chunk_size=CHUNK_SIZE):
+    """
+    :type response: requests.Response
+    :type chunk_size: int
+    """
+    yield from _iter_blocks(response, chunk_size)
 
 
-def _download_with_progressbar(response, content_length):
+def _download_with_progressbar(response, content_length,
+                               chunk_size=CHUNK_SIZE):
     """
     :type response: requests.Response
     :type content_length: int
+    :type chunk_size: int
     """
-    with Bar(expected_size=content_length) as bar:
-        for i, block in enumerate(response.iter_content(1024), 1):
+    with progress_bar(content_length) as bar:
+        downloaded = 0
+        last_shown = time.monotonic()
+        for block in _iter_blocks(response, chunk_size):
             yield block
-            bar.show(min(i * 1024, content_length))
+            downloaded += len(block)
+            now = time.monotonic()
+            if now - last_shown >= PROGRESS_INTERVAL:
+                bar.show(min(downloaded, content_length))
+                last_shown = now
+        bar.show(min(downloaded, content_length))
+
+
+def progress_bar(expected_size):
+    """
+    clint draws its progress bars on the stderr it found when it was
+    imported, so the bar is hidden when stderr has been redirected since, as
+    it is while the daemon runs a command.
+
+    :type expected_size: int
+    :rtype: clint.textui.progress.Bar
+    """
+    hide = None
+    if sys.stderr is not clint_progress.STREAM:
+        hide = True
+    return clint_progress.Bar(expected_size=expected_size, hide=hide)
+
+
+def _download_with_progress(response, progress, chunk_size=CHUNK_SIZE):
+    """
+    :type response: requests.Response
+    :type progress: riley.transfers.AggregateProgress
+    :type chunk_size: int
+    """
+    for block in _iter_blocks(response, chunk_size):
+        yield block
+        progress.advance(len(block))
 
 
 def get_file_name(response):
@@ -0,0 +1,196 @@
+import calendar
+import io
+import re
+import time
+from email.utils import mktime_tz, parsedate_tz
+from xml.etree import ElementTree
+
+import feedparser
+
+
+# Feeds of this size or larger are parsed by the streaming parser in 'auto'
+STREAMING_THRESHOLD = 1024 * 1024
+PARSERS = ('auto', 'feedparser', 'streaming')
+
+ATOM_NAMESPACE = 'http://www.w3.org/2005/Atom'
+RSS1_NAMESPACE = 'http://purl.org/rss/1.0/'
+RDF_NAMESPACE = 'http://www.w3.org/1999/02/22-rdf-syntax-ns#'
+DC_NAMESPACE = 'http://purl.org/dc/elements/1.1/'
+
+_iso_date = re.compile(
+    r'(\d{4})-(\d\d)-(\d\d)(?:[T ](\d\d):(\d\d)(?::(\d\d)(?:\.\d+)?)?)?'
+    r'\s*(Z|[+-]\d\d:?\d\d)?$')
+
+
+class MalformedFeed(Exception):
+    pass
+
+
+def parse(data, parser='auto', response_headers=None):
+    """
+    Parse a feed with feedparser or, for large feeds, with the streaming
+    parser, which falls back to feedparser if the feed is malformed.
+
+    :type data: bytes
+    :param parser: 'feedparser', 'streaming' or 'auto'.
+    :type parser: str
+    :type response_headers: dict
+    :rtype: feedparser.FeedParserDict
+    """
+    if parser == 'auto':
+        parser = 'streaming' if len(data) >= STREAMING_THRESHOLD \
+            else 'feedparser'
+    if parser == 'streaming':
+        channel = feedparser.FeedParserDict()
+        try:
+            entries = list(iter_entries(io.BytesIO(data), channel))
+        except MalformedFeed:
+            pass
+        else:
+            return feedparser.FeedParserDict(
+                feed=channel, entries=entries, bozo=0,
+                headers=response_headers or {})
+    return feedparser.parse(data, response_headers=response_headers)
+
+
+def iter_entries(stream, channel=None):
+    """
+    Read the entries of an RSS or Atom feed one at a time, without building
+    the whole document. Only the fields that episodes are made of are
+    extracted, so that the entries have the same guid, title, link,
+    enclosures (only the first) and published_parsed as feedparser's.
+
+    :type stream: io.BufferedIOBase
+    :param channel: Dictionary to which an RSS channel's ttl is added, like
+        feedparser's feed.
+    :type channel: dict
+    :raise MalformedFeed: If the feed isn't well-formed RSS or Atom.
+    :rtype: collections.Iterator[feedparser.FeedParserDict]
+    """
+    parents = []
+    try:
+        for event, element in ElementTree.iterparse(
+                stream, events=('start', 'end')):
+            if event == 'start':
+                if not parents and \
+                        _local_name(element.tag) not in ('rss', 'RDF', 'feed'):
+                    raise MalformedFeed('Not an RSS or Atom feed')
+                parents.append(element)
+                continue
+            parents.pop()
+            tag = element.tag
+            if tag == 'ttl' and channel is not None and parents and \
+                    parents[-1].tag == 'channel' and _text(element):
+                channel['ttl'] = _text(element)
+            if tag in ('item', '{%s}item' % RSS1_NAMESPACE):
+                yield _rss_entry(element)
+            elif tag == '{%s}entry' % ATOM_NAMESPACE:
+                yield _atom_entry(element)
+            else:
+                continue
+            # Forget the entry once it has been read
+            if parents:
+                parents[-1].remove(element)
+    except ElementTree.ParseError as e:
+        raise MalformedFeed(str(e))
+
+
+def _local_name(tag):
+    return tag.rpartition('}')[2]
+
+
+def _text(element):
+    if element is None or element.text is None:
+        return None
+    return element.text.strip()
+
+
+def _find(element, *tags):
+    for tag in tags:
+        child = element.find(tag)
+        if child is not None:
+            return child
+    return None
+
+
+def _rss_entry(item):
+    entry = feedparser.FeedParserDict()
+    rss1 = '{%s}' % RSS1_NAMESPACE
+    title = _text(_find(item, 'title', rss1 + 'title'))
+    if title is not None:
+        entry['title'] = title
+    link = _text(_find(item, 'link', rss1 + 'link'))
+    if link:
+        entry['link'] = link
+    guid = item.find('guid')
+    if guid is None and item.get('{%s}about' % RDF_NAMESPACE):
+        entry['guid'] = item.get('{%s}about' % RDF_NAMESPACE)
+    elif _text(guid):
+        entry['guid'] = _text(guid)
+        if 'link' not in entry and \
+                guid.get('isPermaLink', 'true').lower() == 'true':
+            entry['link'] = entry['guid']
+    enclosure = item.find('enclosure')
+    if enclosure is not None and enclosure.get('url'):
+        entry['links'] = [_enclosure(enclosure.get('url'))]
+    published = _text(_find(item, 'pubDate', '{%s}date' % DC_NAMESPACE))
+    if published:
+        entry['published_parsed'] = parse_date(published)
+    return entry
+
+
+def _atom_entry(element):
+    atom = '{%s}' % ATOM_NAMESPACE
+    entry = feedparser.FeedParserDict()
+    title = _text(element.find(atom + 'title'))
+    if title is not None:
+        entry['title'] = title
+    guid = _text(element.find(atom + 'id'))
+    if guid:
+        entry['guid'] = guid
+    for link in element.findall(atom + 'link'):
+        rel = link.get('rel', 'alternate')
+        href = link.get('href')
+        if not href:
+            continue
+        if rel == 'alternate' and 'link' not in entry:
+            entry['link'] = href
+        elif rel == 'enclosure' and 'links' not in entry:
+            entry['links'] = [_enclosure(href)]
+    published = _text(element.find(atom + 'published'))
+    if published:
+        entry['published_parsed'] = parse_date(published)
+    return entry
+
+
+def _enclosure(href):
+    # feedparser makes the enclosures out of the links
+    return feedparser.FeedParserDict(rel='enclosure', href=href)
+
+
+def parse_date(value):
+    """
+    Parse an RFC 822 date, as in RSS, or an ISO 8601 date, as in Atom.
+
+    :type value: str
+    :return: The date in UTC, like feedparser's dates.
+    :rtype: time.struct_time
+    :raise MalformedFeed: If the date is in neither format.
+    """
+    parsed = parsedate_tz(value)
+    if parsed is not None:
+        if parsed[9] is None:
+            # Dates without a time zone are taken to be in UTC
+            parsed = parsed[:9] + (0,)
+        return time.gmtime(mktime_tz(parsed))
+    match = _iso_date.match(value)
+    if match is None:
+        raise MalformedFeed('Unknown date format: %s' % value)
+    year, month, day, hour, minute, second, zone = match.groups()
+    timestamp = calendar.timegm((
+        int(year), int(month), int(day), int(hour or 0), int(minute or 0),
+        int(second or 0), 0, 0, 0))
+    if zone and zone != 'Z':
+        offset = int(zone[1:3]) * 3600 + int(zone[-2:]) * 60
+        timestamp -= offset if zone[0] == '+' else -offset
+    return time.gmtime(timestamp)
@@ -0,0 +1,35 @@
+import importlib.util
+import sys
+
+
+def lazy_import(name):
+    """
+    Import a module the first time one of its attributes is used, so that
+    commands which don't need a heavy dependency don't pay for importing it.
+
+    :type name: str
+    :rtype: types.ModuleType
+    """
+    if name in sys.modules:
+        return sys.modules[name]
+    spec = importlib.util.find_spec(name)
+    if spec is None:
+        raise ImportError('No module named %r' % name, name=name)
+    loader = importlib.util.LazyLoader(spec.loader)
+    spec.loader = loader
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    loader.exec_module(module)
+    parent, _, child = name.rpartition('.')
+    if parent:
+        setattr(sys.modules[parent], child, module)
+    return module
+
+
+def preload(*modules):
+    """
+    Load lazily imported modules before threads use them, since loading a
+    module on attribute access isn't thread-safe before Python 3.12.
+    """
+    for module in modules:
+        getattr(module, '__name__')
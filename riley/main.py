@@ -1,19 +1,41 @@
 #!/usr/bin/env python3
+import os
 import sys
-from riley.commands import ListPodcasts, FetchEpisodes, ListEpisodes, Insert, \
-    DownloadEpisodes, WhereIsConfig, DownloadBest
+from importlib import import_module
+
+from riley.lazy import lazy_import
+
+daemon = lazy_import('riley.daemon')
 
 
 class ManagementUtility:
+    # The command classes are imported when they are run, so that a command
+    # doesn't pay for importing the dependencies of the other commands
     subcommands = {
-        'list': ListEpisodes,
-        'insert': Insert,
-        'podcasts': ListPodcasts,
-        'fetch': FetchEpisodes,
-        'download': DownloadEpisodes,
-        'download-best': DownloadBest,
-        'config': WhereIsConfig,
+        'list': 'riley.commands.ListEpisodes',
+        'insert': 'riley.commands.Insert',
+        'podcasts': 'riley.commands.ListPodcasts',
+        'fetch': 'riley.commands.FetchEpisodes',
+        'download': 'riley.commands.DownloadEpisodes',
+        'download-best': 'riley.commands.DownloadBest',
+        'config': 'riley.commands.WhereIsConfig',
+        'migrate': 'riley.commands.MigrateToSQLite',
+        'upgrade': 'riley.commands.Upgrade',
+        'sync': 'riley.commands.Sync',
+        'serve': 'riley.commands.Serve',
     }
+    # Commands which are run by the daemon when it's running
+    daemon_subcommands = {'list', 'podcasts', 'fetch', 'download',
+                          'download-best'}
+
+    def get_command(self, subcommand):
+        """
+        :raise KeyError: If there's no such subcommand.
+        :rtype: riley.commands.BaseCommand
+        """
+        module_name, _, class_name = \
+            self.subcommands[subcommand].rpartition('.')
+        return getattr(import_module(module_name), class_name)()
 
     def execute(self, argv):
         if len(argv) > 1:
@@ -22,11 +44,28 @@ class ManagementUtility:
             subcommand = 'list'
             argv += ['list']
         try:
-            command = self.subcommands[subcommand]()
-        except AttributeError:
+            command = self.get_command(subcommand)
+        except KeyError:
             sys.exit('%s is not a valid subcommand.' % subcommand)
+        if subcommand in self.daemon_subcommands and \
+                not self._is_profiled(command, argv):
+            # Let the daemon run the command if it's running
+            status = daemon.call(argv)
+            if status is not None:
+                if status != 0:
+                    sys.exit(status)
+                return
         command.execute(argv)
 
+    @staticmethod
+    def _is_profiled(command, argv):
+        """
+        A command that is profiled runs in this process, so that the profile
+        is of this command and saved relative to the working directory.
+        """
+        parser = command.create_parser(os.path.basename(argv[0]), argv[1])
+        return parser.parse_args(argv[2:]).profile is not None
+
 
 def main():
     ManagementUtility().execute(sys.argv)
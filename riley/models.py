@@ -1,5 +1,9 @@
+import calendar
 import math
 import time
+from operator import attrgetter
+
+from riley.timings import timings
 
 
 class HasBeenModified:
@@ -21,21 +25,33 @@ class Podcast(HasBeenModified):
 
     score_const = 30 / math.log(6)
 
-    def __init__(self, name, feed, episode_storage, priority=5):
+    def __init__(self, name, feed, episode_storage, priority=5, etag=None,
+                 last_modified=None):
         super(Podcast, self).__init__()
         self.name = name
         self.feed = feed
         self.priority = priority
+        # HTTP validators from the last time the feed was fetched
+        self.etag = etag
+        self.last_modified = last_modified
         self._episode_storage = episode_storage
 
     @property
     def episodes(self):
         if not hasattr(self, '_episodes'):
-            self._episodes = EpisodeList(
-                self._episode_storage.get_episodes(self))
+            with timings.phase('load episodes', self.name):
+                self._episodes = EpisodeList(
+                    self._episode_storage.get_episodes(self))
             delattr(self, '_episode_storage')
         return self._episodes
 
+    @property
+    def episodes_modified(self):
+        """
+        Whether the episodes have been modified, without loading them.
+        """
+        return hasattr(self, '_episodes') and self._episodes.modified
+
     @property
     def score(self):
         if hasattr(self, '_score'):
@@ -50,53 +66,245 @@ class Podcast(HasBeenModified):
 
 
 class EpisodeList(list, HasBeenModified):
+    """
+    List of episodes which also keeps an index of the episodes' GUIDs, so
+    that membership tests and lookups by GUID are done in constant time.
+
+    Since it was last saved, the list also remembers which episodes have been
+    added or changed and which GUIDs have been removed, so that a storage can
+    write only those.
+    """
+
     def __init__(self, list_):
         list.__init__(self, list_)
         HasBeenModified.__init__(self)
+        self._guid_index = {}
+        self.added = []
+        self.changed = set()
+        self.removed_guids = set()
+        self._reindex()
+
+    def _reindex(self):
+        self._guid_index.clear()
+        for episode in self:
+            self._guid_index.setdefault(episode.guid, episode)
+
+    def _add(self, episodes):
+        for episode in episodes:
+            self._guid_index.setdefault(episode.guid, episode)
+        self.added.extend(episodes)
+        self.modified = True
 
     def append(self, x):
         super().append(x)
+        self._add([x])
+
+    def extend(self, iterable):
+        episodes = list(iterable)
+        super().extend(episodes)
+        self._add(episodes)
+
+    def insert(self, i, x):
+        super().insert(i, x)
+        self._add([x])
+
+    def __iadd__(self, other):
+        self.extend(other)
+        return self
+
+    # Removing episodes is rare, so the index is simply rebuilt
+
+    def _replaced(self, before):
+        """
+        Update the index and the tracked changes after episodes have been
+        removed or replaced.
+        """
+        old_guids = set(self._guid_index)
+        self._reindex()
+        self.removed_guids.update(old_guids.difference(self._guid_index))
+        ids_before = set(map(id, before))
+        ids_now = set(map(id, self))
+        self.added[:] = [e for e in self.added if id(e) in ids_now]
+        self.added.extend(e for e in self if id(e) not in ids_before)
+        self.changed.intersection_update(self)
         self.modified = True
 
+    def __setitem__(self, key, value):
+        before = list(self)
+        super().__setitem__(key, value)
+        self._replaced(before)
+
+    def __delitem__(self, key):
+        before = list(self)
+        super().__delitem__(key)
+        self._replaced(before)
+
+    def pop(self, i=-1):
+        before = list(self)
+        episode = super().pop(i)
+        self._replaced(before)
+        return episode
+
+    def remove(self, x):
+        before = list(self)
+        super().remove(x)
+        self._replaced(before)
+
+    def clear(self):
+        before = list(self)
+        super().clear()
+        self._replaced(before)
+
     def __contains__(self, episode):
-        return any(True for e in self if e.guid == episode.guid)
+        return episode.guid in self._guid_index
 
+    def get_by_guid(self, guid, default=None):
+        """
+        :return: The first episode with the GUID.
+        """
+        return self._guid_index.get(guid, default)
+
+    def guid_changed(self, episode, guid):
+        """
+        Update the index before an episode in the list changes its GUID.
+        """
+        old_guid = episode.guid
+        if self._guid_index.get(old_guid) is episode:
+            del self._guid_index[old_guid]
+            # Another episode may share the old GUID
+            for e in self:
+                if e is not episode and e.guid == old_guid:
+                    self._guid_index[old_guid] = e
+                    break
+            else:
+                self.removed_guids.add(old_guid)
+        elif not any(e is episode for e in self):
+            return
+        self._guid_index.setdefault(guid, episode)
+        # The episode is stored again under its new GUID
+        self.added.append(episode)
+
+    def episode_changed(self, episode):
+        self.changed.add(episode)
+        self.modified = True
+
+    def sort_latest_first(self):
+        """
+        Put the episodes in the order that storages return them in, latest
+        first. The order isn't stored, so it's not tracked as a change.
+        """
+        super().sort(key=attrgetter('timestamp'), reverse=True)
+        self._reindex()
+
+    def mark_saved(self):
+        """
+        Forget the tracked changes once they have been written.
+        """
+        self.added.clear()
+        self.changed.clear()
+        self.removed_guids.clear()
+        self.modified = False
+
+
+class Episode:
+    """
+    An episode keeps its attributes in slots and assigns them directly in
+    __init__, so that loading a large history doesn't pay for a __dict__ per
+    episode or for the change tracking. Later assignments are tracked like in
+    HasBeenModified.
+    """
+
+    __slots__ = ('podcast', 'guid', 'title', 'link', 'media_href',
+                 '_published', 'downloaded', 'modified')
 
-class Episode(HasBeenModified):
     columns = ['guid', 'title', 'link', 'media_href', 'published', 'downloaded']
+    published_format = '%Y-%m-%d %H:%M:%S'
 
     def __init__(self, podcast, guid, title, link, media_href, published,
                  downloaded):
-        super(Episode, self).__init__()
-        self.podcast = podcast
-        self.guid = guid
-        self.title = title
-        self.link = link
-        self.media_href = media_href
-        self.published = published
-        self.downloaded = self.to_bool(downloaded)
+        if not isinstance(published, (time.struct_time, str, int)):
+            raise TypeError
+        if downloaded.__class__ is not bool:
+            downloaded = self.to_bool(downloaded)
+        set_ = object.__setattr__
+        set_(self, 'podcast', podcast)
+        set_(self, 'guid', guid)
+        set_(self, 'title', title)
+        set_(self, 'link', link)
+        set_(self, 'media_href', media_href)
+        set_(self, '_published', published)
+        set_(self, 'downloaded', downloaded)
+        set_(self, 'modified', False)
+
+    def __setattr__(self, key, value):
+        if key != 'modified' and getattr(self, key) != value:
+            object.__setattr__(self, 'modified', True)
+            self.modified_attr(key, value)
+        object.__setattr__(self, key, value)
+
+    @staticmethod
+    def parse_published(value):
+        """
+        Parse a publish time from a storage, where it's kept as seconds since
+        the epoch. Histories written by older versions have formatted dates,
+        which are much slower to parse.
+
+        :type value: str
+        :rtype: int or time.struct_time
+        """
+        try:
+            return int(value)
+        except ValueError:
+            return time.strptime(value, Episode.published_format)
 
     @property
     def published(self):
-        return self._published
+        published = self._published
+        if published.__class__ is str:
+            # Strings from the storage are parsed on first access, since many
+            # episodes are never looked at
+            published = self.parse_published(published)
+            object.__setattr__(self, '_published', published)
+        if published.__class__ is int:
+            return time.gmtime(published)
+        return published
 
     @published.setter
     def published(self, value):
-        if hasattr(self, '_published'):
-            self._published = None
-        if isinstance(value, time.struct_time):
-            self._published = value
-        elif isinstance(value, str):
-            self._published = time.strptime(value, '%Y-%m-%d %H:%M:%S')
-        else:
+        if not isinstance(value, (time.struct_time, str, int)):
             raise TypeError
+        object.__setattr__(self, '_published', value)
+
+    @property
+    def timestamp(self):
+        """
+        Publish time in seconds since the epoch, which is how it's stored and
+        what episodes are sorted and scored by.
+
+        :rtype: int
+        """
+        published = self._published
+        if published.__class__ is str:
+            published = self.parse_published(published)
+            object.__setattr__(self, '_published', published)
+        if published.__class__ is int:
+            return published
+        # Feeds' publish times are in UTC
+        return calendar.timegm(published)
 
     @property
     def score(self):
         if self.downloaded:
             return 0
-        episode_score = time.mktime(self.published) / 60 / 60 / 24
-        podcast_score = self.podcast.score
+        return self.calculate_score(self.timestamp, self.podcast.score)
+
+    @staticmethod
+    def calculate_score(timestamp, podcast_score):
+        """
+        Score of an episode that hasn't been downloaded. An episode gains one
+        point for each day later it was published.
+        """
+        episode_score = timestamp / 60 / 60 / 24
         return episode_score + podcast_score
 
     @classmethod
@@ -109,12 +317,14 @@ class Episode(HasBeenModified):
             self.title,
             self.link,
             self.media_href,
-            time.strftime('%Y-%m-%d %H:%M:%S', self.published),
+            str(self.timestamp),
             str(self.downloaded),
         ]
 
     def modified_attr(self, key, value):
-        self.podcast.episodes.modified = True
+        if key == 'guid':
+            self.podcast.episodes.guid_changed(self, value)
+        self.podcast.episodes.episode_changed(self)
 
     @staticmethod
     def to_bool(value):
@@ -0,0 +1,170 @@
+import asyncio
+import itertools
+import math
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse
+
+from riley.transfers import AggregateProgress
+
+# Sentinels sort after every episode in the download queue
+_DONE = (math.inf, math.inf, None)
+
+
+class Pipeline:
+    """
+    Fetch feeds and download their new episodes in stages connected by
+    bounded queues, so that the new episodes of a fast feed are downloaded
+    while slow feeds are still being fetched.
+
+    The blocking fetches and downloads run in a thread pool, at most `jobs`
+    of them at a time in total, and of the downloads at most `per_host` go to
+    the same host. The merges and everything else that touches the storage
+    run in the event loop's thread. When the downloads fall behind, the
+    queues fill up and the fetches wait.
+    """
+
+    def __init__(self, fetch, update, download, to_dir, jobs=4, per_host=4,
+                 number=None, on_done=None, on_start=None):
+        """
+        :param fetch: Function that downloads and parses a podcast's feed.
+        :param update: Function that merges a feed into its podcast and
+            returns the episodes to download.
+        :param download: Function with the signature of
+            riley.download.download.
+        :type to_dir: str
+        :type jobs: int
+        :type per_host: int
+        :param number: Maximum number of episodes to download.
+        :type number: int
+        """
+        self.fetch = fetch
+        self.update = update
+        self.download = download
+        self.to_dir = to_dir
+        self.jobs = max(jobs, 1)
+        self.per_host = max(per_host, 1)
+        self.remaining = math.inf if number is None else number
+        self.on_done = on_done
+        self.on_start = on_start
+        self.failed = []
+
+    def run(self, podcasts):
+        """
+        :type podcasts: collections.Iterable[riley.models.Podcast]
+        :return: Episodes that failed to download.
+        :rtype: list
+        """
+        with ThreadPoolExecutor(max_workers=self.jobs) as executor:
+            asyncio.run(self._run(podcasts, executor))
+        return self.failed
+
+    async def _run(self, podcasts, executor):
+        self._executor = executor
+        self._slots = asyncio.Semaphore(self.jobs)
+        self._host_semaphores = {}
+        self._order = itertools.count()
+        self._progress = AggregateProgress()
+
+        podcast_queue = asyncio.Queue()
+        for podcast in podcasts:
+            podcast_queue.put_nowait(podcast)
+        feed_queue = asyncio.Queue(maxsize=self.jobs)
+        episode_queue = asyncio.PriorityQueue(maxsize=self.jobs * 2)
+
+        fetchers = [asyncio.ensure_future(self._fetch_feeds(
+            podcast_queue, feed_queue)) for _ in range(self.jobs)]
+        merger = asyncio.ensure_future(self._merge_feeds(
+            feed_queue, episode_queue))
+        downloaders = [asyncio.ensure_future(self._download_episodes(
+            episode_queue)) for _ in range(self.jobs)]
+
+        async def close():
+            await asyncio.gather(*fetchers)
+            await feed_queue.put(None)
+            await merger
+            for _ in downloaders:
+                await episode_queue.put(_DONE)
+
+        stages = fetchers + [merger] + downloaders
+        stages.append(asyncio.ensure_future(close()))
+        try:
+            await asyncio.gather(*stages)
+        except BaseException:
+            # An unexpected error in one stage cancels the others, instead of
+            # leaving them waiting on full or empty queues
+            for stage in stages:
+                stage.cancel()
+            await asyncio.gather(*stages, return_exceptions=True)
+            raise
+        self._progress.done()
+
+    async def _in_thread(self, function, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        async with self._slots:
+            return await loop.run_in_executor(
+                self._executor, lambda: function(*args, **kwargs))
+
+    async def _fetch_feeds(self, podcast_queue, feed_queue):
+        while not podcast_queue.empty():
+            podcast = podcast_queue.get_nowait()
+            try:
+                feed = await self._in_thread(self.fetch, podcast)
+            except Exception as e:
+                print("Could not fetch '%s': %s" % (podcast.name, e),
+                      file=sys.stderr)
+                continue
+            await feed_queue.put((podcast, feed))
+
+    async def _merge_feeds(self, feed_queue, episode_queue):
+        while True:
+            item = await feed_queue.get()
+            if item is None:
+                return
+            podcast, feed = item
+            print(podcast.name)
+            try:
+                episodes = self.update(podcast, feed)
+            except Exception as e:
+                print("Could not update '%s': %s" % (podcast.name, e),
+                      file=sys.stderr)
+                continue
+            for episode in episodes:
+                if self.remaining <= 0:
+                    break
+                self.remaining -= 1
+                # The best episodes waiting in the queue are downloaded first
+                await episode_queue.put(
+                    (-episode.score, next(self._order), episode))
+
+    def _host_semaphore(self, url):
+        host = urlparse(url).netloc
+        if host not in self._host_semaphores:
+            self._host_semaphores[host] = asyncio.Semaphore(self.per_host)
+        return self._host_semaphores[host]
+
+    async def _download_episodes(self, episode_queue):
+        while True:
+            episode = (await episode_queue.get())[2]
+            if episode is None:
+                return
+            if self.on_start is not None:
+                self.on_start(episode)
+            try:
+                async with self._host_semaphore(episode.media_href):
+                    await self._in_thread(
+                        self.download, episode.media_href, self.to_dir,
+                        episode.published, progress=self._progress)
+            except Exception as e:
+                print("Could not download '%s': %s" % (episode.title, e),
+                      file=sys.stderr)
+                self.failed.append(episode)
+                continue
+            if self.on_done is None:
+                continue
+            try:
+                self.on_done(episode)
+            except Exception as e:
+                print("Could not save '%s': %s" % (episode.title, e),
+                      file=sys.stderr)
+                self.failed.append(episode)
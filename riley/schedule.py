@@ -0,0 +1,76 @@
+import re
+import statistics
+
+# Seconds between fetches of a feed
+MIN_INTERVAL = 15 * 60
+MAX_INTERVAL = 24 * 60 * 60
+# For podcasts with too few episodes to tell how often they publish
+DEFAULT_INTERVAL = 60 * 60
+# A feed is fetched this many times in the typical time between two of its
+# episodes, so that new episodes arrive soon after they're published
+FETCHES_PER_EPISODE = 4
+# Number of latest episodes that the publishing cadence is learnt from
+CADENCE_EPISODES = 11
+
+_max_age = re.compile(r'max-age\s*=\s*(\d+)')
+
+
+def polling_interval(timestamps, ttl=None):
+    """
+    Seconds to wait before fetching a feed again, from how often the podcast
+    publishes episodes. Feeds aren't fetched more often than they ask to be
+    cached for, within the maximum interval.
+
+    :param timestamps: Publish times of the latest episodes, latest first.
+    :type timestamps: list
+    :param ttl: Seconds the feed may be cached for.
+    :type ttl: int
+    :rtype: float
+    """
+    gaps = [a - b for a, b in zip(timestamps, timestamps[1:]) if a > b]
+    if len(gaps) < 2:
+        interval = DEFAULT_INTERVAL
+    else:
+        interval = statistics.median(gaps) / FETCHES_PER_EPISODE
+    interval = min(max(interval, MIN_INTERVAL), MAX_INTERVAL)
+    if ttl is not None:
+        interval = max(interval, min(ttl, MAX_INTERVAL))
+    return interval
+
+
+def feed_ttl(feed):
+    """
+    Seconds a fetched feed may be cached for, from an RSS feed's ttl element
+    or the response's Cache-Control header.
+
+    :type feed: feedparser.FeedParserDict
+    :rtype: int
+    """
+    ttls = []
+    try:
+        # In minutes
+        ttls.append(int((feed.get('feed') or {}).get('ttl')) * 60)
+    except (TypeError, ValueError):
+        pass
+    headers = {key.lower(): value
+               for key, value in (feed.get('headers') or {}).items()}
+    match = _max_age.search(headers.get('cache-control', ''))
+    if match is not None:
+        ttls.append(int(match.group(1)))
+    return max(ttls) if ttls else None
+
+
+def is_due(entry, now):
+    """
+    :param entry: The podcast's time of the last fetch and interval, from
+        Storage.get_schedule, or None if it has never been fetched.
+    :type entry: list
+    :param now: Seconds since the epoch.
+    :type now: float
+    :rtype: bool
+    """
+    if entry is None:
+        return True
+    fetched, interval = entry
+    # A clock which has been set back doesn't delay the fetch
+    return now >= fetched + interval or now < fetched
@@ -0,0 +1,27 @@
+import heapq
+from array import array
+
+from riley.models import Episode
+
+
+def best_candidates(candidates, podcasts, number):
+    """
+    Pick the candidates with the highest scores. The scores are calculated in
+    one pass over flat arrays of timestamps and podcast scores, instead of
+    through each episode's score property.
+
+    :param candidates: (podcast name, GUID, timestamp) of episodes that
+        haven't been downloaded.
+    :type candidates: list
+    :param podcasts: Podcasts by name.
+    :type podcasts: dict
+    :type number: int
+    :return: (podcast name, GUID) of the best candidates, best first.
+    :rtype: list
+    """
+    podcast_scores = {name: podcast.score for name, podcast in podcasts.items()}
+    timestamps = array('d', (c[2] for c in candidates))
+    offsets = array('d', (podcast_scores[c[0]] for c in candidates))
+    scores = array('d', map(Episode.calculate_score, timestamps, offsets))
+    best = heapq.nlargest(number, range(len(scores)), key=scores.__getitem__)
+    return [candidates[i][:2] for i in best]
@@ -1,15 +1,42 @@
+import calendar
+import copy
 import csv
+import heapq
+import io
+import json
+import locale
 import os
+import stat
+import tempfile
+import threading
+import time
 from collections import OrderedDict
-from operator import attrgetter
+from contextlib import contextmanager
+from itertools import chain, islice, takewhile
+from operator import attrgetter, itemgetter
 from os.path import expanduser
 
 import yaml
 from appdirs import user_data_dir
+from riley.lazy import lazy_import
 from riley.models import Podcast, Episode
+from riley.timings import timings
 
+try:
+    import fcntl
+except ImportError:
+    # Windows
+    fcntl = None
 
-def ordered_load(stream, Loader=yaml.Loader, object_pairs_hook=OrderedDict):
+sqlite3 = lazy_import('sqlite3')
+
+
+# Use libyaml's C implementation when PyYAML has been built with it
+SafeLoader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+SafeDumper = getattr(yaml, 'CSafeDumper', yaml.SafeDumper)
+
+
+def ordered_load(stream, Loader=SafeLoader, object_pairs_hook=OrderedDict):
     # Source: http://stackoverflow.com/a/21912744/595990
     class OrderedLoader(Loader):
         pass
@@ -22,7 +49,7 @@ def ordered_load(stream, Loader=yaml.Loader, object_pairs_hook=OrderedDict):
     return yaml.load(stream, OrderedLoader)
 
 
-def ordered_dump(data, stream=None, Dumper=yaml.Dumper, **kwds):
+def ordered_dump(data, stream=None, Dumper=SafeDumper, **kwds):
     # Source: http://stackoverflow.com/a/21912744/595990
     class OrderedDumper(Dumper):
         pass
@@ -35,22 +62,125 @@ def ordered_dump(data, stream=None, Dumper=yaml.Dumper, **kwds):
 
 
 class Storage:
+    # Collects saved podcasts while inside batch()
+    _batch = None
+
+    @property
+    def episode_storage(self):
+        raise NotImplementedError
+
     def get_config(self):
         raise NotImplementedError
 
     def get_podcasts(self):
         raise NotImplementedError
 
+    def iter_latest_episodes(self, limit=None, since=None):
+        """
+        Stream the episodes of all podcasts, latest first. Only one episode
+        per podcast is kept in memory at a time.
+
+        :param limit: Maximum number of episodes.
+        :type limit: int
+        :param since: Only episodes published at this time or later.
+        :type since: time.struct_time
+        """
+        episode_storage = self.episode_storage
+        return islice(heapq.merge(
+            *(episode_storage.iter_episodes(podcast, since=since)
+              for podcast in self.get_podcasts().values()),
+            key=attrgetter('timestamp'), reverse=True), limit)
+
+    def get_download_candidates(self, limit):
+        """
+        Get the episodes which download-best may pick from. Since the
+        episodes of a podcast are scored by publish time, only the latest
+        `limit` episodes that haven't been downloaded are needed from each
+        podcast.
+
+        :type limit: int
+        :return: (podcast name, GUID, timestamp) of the episodes.
+        :rtype: list
+        """
+        episode_storage = self.episode_storage
+        candidates = []
+        for podcast in self.get_podcasts().values():
+            episodes = episode_storage.iter_episodes(podcast)
+            candidates.extend(
+                (podcast.name, guid, timestamp) for guid, timestamp in
+                _latest_not_downloaded(episodes, limit))
+        return candidates
+
     def save_podcasts(self, podcasts):
         for podcast in podcasts:
             if podcast.modified:
                 self.save_podcast(podcast)
 
     def save_podcast(self, podcast):
+        if self._batch is not None:
+            self._batch.add(podcast)
+        else:
+            self._write_podcasts([podcast])
+
+    def _write_podcasts(self, podcasts):
         raise NotImplementedError
 
+    def get_schedule(self):
+        """
+        :return: Time of the last fetch of each podcast's feed and the
+            seconds to wait before the next, by podcast name.
+        :rtype: dict
+        """
+        raise NotImplementedError
+
+    def update_schedule(self, entries):
+        """
+        :param entries: Entries like those of get_schedule to add or replace.
+        :type entries: dict
+        """
+        raise NotImplementedError
+
+    @contextmanager
+    def batch(self, interval=None, size=None):
+        """
+        Collect the podcasts passed to save_podcast and write them once when
+        the block is left. To not lose much on a crash, they can also be
+        written when `interval` seconds have passed since the last write or
+        when `size` saves have been collected.
+
+        :type interval: float
+        :type size: int
+        """
+        if self._batch is not None:
+            # Already collected by an outer batch
+            yield self
+            return
+        self._batch = _Batch(self._write_podcasts, interval, size)
+        try:
+            yield self
+        finally:
+            batch, self._batch = self._batch, None
+            batch.flush()
+
 
 class EpisodeStorage:
+    def get_episodes(self, podcast):
+        raise NotImplementedError
+
+    def iter_episodes(self, podcast, limit=None, since=None):
+        """
+        :param limit: Maximum number of episodes.
+        :type limit: int
+        :param since: Only episodes published at this time or later.
+        :type since: time.struct_time
+        :return: Iterator over the podcast's stored episodes, latest first.
+        """
+        episodes = iter(self.get_episodes(podcast))
+        if since is not None:
+            since = calendar.timegm(since)
+            episodes = takewhile(lambda e: e.timestamp >= since, episodes)
+        return islice(episodes, limit)
+
     def save_episodes(self, podcast):
         raise NotImplementedError
 
@@ -72,8 +202,9 @@ class FileStorage(AbstractFileStorage, Storage):
             ('storage', os.path.join(expanduser("~"), 'Music', 'Riley')),
             ('podcasts', {}),
         ])
-        with open(config_file_path, 'w') as f:
-            f.write(ordered_dump(init_data, default_flow_style=False))
+        with _FileWrites() as writes:
+            with writes.open(config_file_path) as f:
+                f.write(ordered_dump(init_data, default_flow_style=False))
 
     @property
     def _config_file_path(self):
@@ -83,59 +214,860 @@ class FileStorage(AbstractFileStorage, Storage):
             self._init_config_file(config_file_path)
         return config_file_path
 
+    @property
+    def _lock_file_path(self):
+        return os.path.join(self._user_data_dir_path, 'riley.lock')
+
+    def lock(self):
+        """
+        Lock the storage for writing, so that other riley processes don't
+        change it at the same time. The lock is reentrant.
+        """
+        return _locked(self._lock_file_path)
+
+    # Parsed config files by path, along with the inode, modification time
+    # and size they had when they were parsed
+    _config_cache = {}
+
+    @staticmethod
+    def _file_version(path):
+        file_stat = os.stat(path)
+        return file_stat.st_ino, file_stat.st_mtime_ns, file_stat.st_size
+
     def get_config(self):
-        with open(self._config_file_path, 'r') as f:
-            return ordered_load(f.read())
+        path = self._config_file_path
+        version = self._file_version(path)
+        cached = self._config_cache.get(path)
+        if cached is None or cached[0] != version:
+            with timings.phase('load config'), open(path, 'r') as f:
+                data = ordered_load(f.read())
+            cached = version, data
+            self._config_cache[path] = cached
+        # The callers are free to modify the returned config
+        return copy.deepcopy(cached[1])
 
-    def _save_config_data(self, data):
-        with open(self._config_file_path, 'w') as f:
+    def _save_config_data(self, data, writes=None):
+        """
+        :param writes: Write the config as part of these writes instead of
+            on its own.
+        :type writes: _FileWrites
+        """
+        if writes is None:
+            with _FileWrites(data.get('fsync', True)) as writes:
+                self._save_config_data(data, writes)
+            return
+        path = self._config_file_path
+        with writes.open(path) as f:
             f.write(ordered_dump(data, default_flow_style=False))
+        data = copy.deepcopy(data)
+        writes.on_commit(lambda: self._config_cache.__setitem__(
+            path, (self._file_version(path), data)))
 
     def get_podcasts(self):
         file_episode_storage = FileEpisodeStorage()
         return OrderedDict(
             (name, Podcast(name, dict_['feed'], file_episode_storage,
-                           dict_['priority']))
+                           dict_['priority'], dict_.get('etag'),
+                           dict_.get('last_modified')))
             for name, dict_ in self.get_config()['podcasts'].items())
 
-    def save_podcast(self, podcast):
-        config_data = self.get_config()
-        if podcast.name not in config_data['podcasts'] or podcast.modified:
-            config_data['podcasts'][podcast.name] = OrderedDict([
-                ('feed', podcast.feed),
-                ('priority', podcast.priority),
-            ])
-            self._save_config_data(config_data)
+    @property
+    def episode_storage(self):
+        return FileEpisodeStorage()
+
+    @property
+    def _score_index_path(self):
+        return os.path.join(self._user_data_dir_path, 'score_index.json')
+
+    def _load_score_index(self):
+        try:
+            with open(self._score_index_path) as f:
+                index = json.load(f)
+        except (OSError, ValueError):
+            return {}
+        return index if isinstance(index, dict) else {}
+
+    @property
+    def _schedule_path(self):
+        return os.path.join(self._user_data_dir_path, 'schedule.json')
+
+    def get_schedule(self):
+        try:
+            with open(self._schedule_path) as f:
+                schedule = json.load(f)
+        except (OSError, ValueError):
+            return {}
+        return schedule if isinstance(schedule, dict) else {}
+
+    def update_schedule(self, entries):
+        with self.lock():
+            schedule = self.get_schedule()
+            schedule.update(entries)
+            # Losing the schedule only makes every feed due, so it isn't
+            # synced to disk
+            with _FileWrites(fsync=False) as writes:
+                with writes.open(self._schedule_path) as f:
+                    json.dump(schedule, f)
+
+    def get_download_candidates(self, limit):
+        """
+        The candidates of each podcast are kept in an index file along with
+        the modification time and size of the podcast's history file, so
+        that only the histories that have changed since are read again.
+        """
+        episode_storage = self.episode_storage
+        index = self._load_score_index()
+        new_index = {}
+        candidates = []
+        for podcast in self.get_podcasts().values():
+            version = episode_storage.get_version(podcast)
+            entry = index.get(podcast.name)
+            if entry is None or entry.get('version') != version or \
+                    entry.get('limit', 0) < limit:
+                episodes = episode_storage.iter_episodes(podcast)
+                entry = {
+                    'version': version,
+                    'limit': limit,
+                    'episodes': _latest_not_downloaded(episodes, limit),
+                }
+            new_index[podcast.name] = entry
+            candidates.extend(
+                (podcast.name, guid, timestamp)
+                for guid, timestamp in entry['episodes'][:limit])
+        if new_index != index:
+            # The index can always be rebuilt, so it isn't synced to disk
+            with _FileWrites(fsync=False) as writes:
+                with writes.open(self._score_index_path) as f:
+                    json.dump(new_index, f)
+        return candidates
+
+    def _write_podcasts(self, podcasts):
+        """
+        Write the podcasts' config with one rewrite of the config file, and
+        the episode history of each podcast whose episodes were modified.
+        The files are synced to disk together.
+        """
+        with timings.phase('save'), self.lock():
+            config_data = self.get_config()
+            with _FileWrites(config_data.get('fsync', True)) as writes:
+                config_modified = False
+                for podcast in podcasts:
+                    if podcast.name in config_data['podcasts'] and \
+                            not podcast.modified:
+                        continue
+                    podcast_data = OrderedDict([
+                        ('feed', podcast.feed),
+                        ('priority', podcast.priority),
+                    ])
+                    if podcast.etag is not None:
+                        podcast_data['etag'] = podcast.etag
+                    if podcast.last_modified is not None:
+                        podcast_data['last_modified'] = podcast.last_modified
+                    config_data['podcasts'][podcast.name] = podcast_data
+                    config_modified = True
+                if config_modified:
+                    self._save_config_data(config_data, writes)
+                file_episode_storage = FileEpisodeStorage()
+                for podcast in podcasts:
+                    if podcast.episodes_modified:
+                        file_episode_storage.save_episodes(podcast, writes)
+        for podcast in podcasts:
             podcast.modified = False
-        if podcast.episodes.modified:
-            file_episode_storage = FileEpisodeStorage()
-            file_episode_storage.save_episodes(podcast)
-            podcast.episodes.modified = False
+            if podcast.episodes_modified:
+                podcast.episodes.mark_saved()
+
+
+class CachedFileStorage(FileStorage):
+    """
+    File storage which keeps the podcasts and their episodes in memory
+    between commands, for the daemon. A podcast is read again when its files
+    have been changed by another process, and all of them are when the config
+    has.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self._podcasts = None
+        self._config_version = None
+        self._episode_versions = {}
+
+    def get_podcasts(self):
+        config_version = self._file_version(self._config_file_path)
+        if self._podcasts is None or config_version != self._config_version:
+            self._podcasts = super().get_podcasts()
+            self._config_version = config_version
+            self._episode_versions.clear()
+        episode_storage = self.episode_storage
+        for name, podcast in self._podcasts.items():
+            version = episode_storage.get_version(podcast)
+            if self._episode_versions.setdefault(name, version) != version:
+                self._podcasts[name] = Podcast(
+                    name, podcast.feed, episode_storage, podcast.priority,
+                    podcast.etag, podcast.last_modified)
+                self._episode_versions[name] = version
+        return self._podcasts
+
+    def iter_latest_episodes(self, limit=None, since=None):
+        key = attrgetter('timestamp')
+        # The episodes are mostly in order already, so sorting them is cheap
+        episodes = heapq.merge(
+            *(sorted(podcast.episodes, key=key, reverse=True)
+              for podcast in self.get_podcasts().values()),
+            key=key, reverse=True)
+        if since is not None:
+            since = calendar.timegm(since)
+            episodes = takewhile(lambda e: e.timestamp >= since, episodes)
+        return islice(episodes, limit)
+
+    def _write_podcasts(self, podcasts):
+        with self.lock():
+            modified = [p for p in podcasts if p.episodes_modified]
+            super()._write_podcasts(podcasts)
+            if self._podcasts is None or any(
+                    self._podcasts.get(p.name) is not p for p in podcasts):
+                # Podcasts which aren't in memory are read again
+                self._podcasts = None
+                return
+            # The files written here don't have to be read again, but the
+            # episodes in memory are put in the order they'd be read in, so
+            # that episode indices mean the same as without the daemon
+            self._config_version = self._file_version(self._config_file_path)
+            episode_storage = self.episode_storage
+            for podcast in podcasts:
+                self._episode_versions[podcast.name] = \
+                    episode_storage.get_version(podcast)
+            for podcast in modified:
+                podcast.episodes.sort_latest_first()
+
+
+class _FileWrites:
+    """
+    Files are written to temporary files next to them, which replace them on
+    commit. A crash therefore leaves each file either as it was or as it was
+    written, never partly written. Before the files are replaced, they are
+    synced to disk together, and each directory is synced once afterwards.
+
+    Use as a context manager, which commits when the block is left without
+    an exception and otherwise removes the temporary files.
+    """
+
+    def __init__(self, fsync=True):
+        self.fsync = fsync
+        self._replacements = OrderedDict()
+        self._appended = []
+        self._removed = []
+        self._callbacks = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.commit()
+        else:
+            self.rollback()
+
+    def open(self, path, **kwargs):
+        """
+        :return: A file opened for writing in text mode, which will replace
+            `path`.
+        """
+        fd, temp_path = tempfile.mkstemp(
+            dir=os.path.dirname(path), prefix='.%s.' % os.path.basename(path),
+            suffix='.tmp')
+        if os.path.exists(path):
+            os.chmod(temp_path, stat.S_IMODE(os.stat(path).st_mode))
+        self._replacements[path] = temp_path
+        return open(fd, 'w', **kwargs)
+
+    def append(self, path, **kwargs):
+        """
+        :return: `path` opened for appending in text mode. Only the sync is
+            deferred to the commit.
+        """
+        self._appended.append(path)
+        return open(path, 'a', **kwargs)
+
+    def remove(self, path):
+        """
+        Remove `path` after the other files have been replaced.
+        """
+        self._removed.append(path)
+
+    def on_commit(self, callback):
+        self._callbacks.append(callback)
+
+    def commit(self):
+        if self.fsync:
+            for path in chain(self._replacements.values(), self._appended):
+                _fsync(path)
+        for path, temp_path in self._replacements.items():
+            os.replace(temp_path, path)
+        for path in self._removed:
+            if os.path.exists(path):
+                os.remove(path)
+        if self.fsync:
+            directories = {os.path.dirname(path) for path in chain(
+                self._replacements, self._appended, self._removed)}
+            for directory in directories:
+                _fsync(directory)
+        self._replacements.clear()
+        del self._appended[:], self._removed[:]
+        callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            callback()
+
+    def rollback(self):
+        for temp_path in self._replacements.values():
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+        self._replacements.clear()
+        del self._appended[:], self._removed[:], self._callbacks[:]
+
+
+def _fsync(path):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+# Lock files held by this process, which are guarded by _lock_guard so that
+# only one thread at a time holds them
+_lock_guard = threading.RLock()
+_lock_files = {}
+
+
+@contextmanager
+def _locked(path):
+    with _lock_guard:
+        if path in _lock_files:
+            yield
+            return
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'a') as f:
+            if fcntl is not None:
+                fcntl.flock(f, fcntl.LOCK_EX)
+            _lock_files[path] = f
+            try:
+                yield
+            finally:
+                # Closing the file releases the lock
+                del _lock_files[path]
+
+
+class _Batch:
+    def __init__(self, write, interval, size):
+        self._write = write
+        self._interval = interval
+        self._size = size
+        self._podcasts = OrderedDict()
+        self._saves = 0
+        self._last_flush = time.monotonic()
+
+    def add(self, podcast):
+        self._podcasts[podcast.name] = podcast
+        self._saves += 1
+        if (self._size is not None and self._saves >= self._size) or \
+                (self._interval is not None and
+                 time.monotonic() - self._last_flush >= self._interval):
+            self.flush()
+
+    def flush(self):
+        podcasts, self._podcasts = list(self._podcasts.values()), OrderedDict()
+        self._saves = 0
+        self._last_flush = time.monotonic()
+        if len(podcasts) > 0:
+            self._write(podcasts)
 
 
 class FileEpisodeStorage(AbstractFileStorage, EpisodeStorage):
+    """
+    Keeps a podcast's episodes in a history file sorted by publish time, and
+    the changes since the history was last written in a journal file that is
+    only appended to. When the journal has grown to `max_journal_ratio` of
+    the history's size, the two are compacted into a new history.
+
+    A journal record is an episode's row preceded by '+' when it was added or
+    changed, or '-' and the GUID of a removed episode.
+    """
+
+    max_journal_ratio = 0.25
+
     def _get_episode_history_file_path(self, podcast):
         return os.path.join(
             self._user_data_dir_path, '%s_history.csv' % podcast.name)
 
+    def _get_journal_file_path(self, podcast):
+        return os.path.join(
+            self._user_data_dir_path, '%s_journal.csv' % podcast.name)
+
+    def get_version(self, podcast):
+        """
+        :return: Modification times and sizes of the podcast's files, which
+            change whenever its episodes are saved.
+        :rtype: list
+        """
+        paths = [self._get_episode_history_file_path(podcast),
+                 self._get_journal_file_path(podcast)]
+        return [list(FileStorage._file_version(path))
+                if os.path.exists(path) else None for path in paths]
+
     def get_episodes(self, podcast):
+        return self.iter_episodes(podcast)
+
+    def iter_episodes(self, podcast, limit=None, since=None):
+        return islice(self._iter_episodes(podcast, since), limit)
+
+    def _iter_episodes(self, podcast, since, journal=None):
+        if journal is None:
+            journal = self._read_journal(podcast)
+        episodes = self._iter_history(podcast, skip=journal)
+        if journal:
+            journaled = [Episode.from_tuple(podcast, row)
+                         for row in journal.values() if row is not None]
+            journaled.sort(key=attrgetter('timestamp'), reverse=True)
+            episodes = heapq.merge(episodes, journaled,
+                                   key=attrgetter('timestamp'), reverse=True)
+        if since is not None:
+            since = calendar.timegm(since)
+            episodes = takewhile(lambda e: e.timestamp >= since, episodes)
+        yield from episodes
+
+    def _iter_history(self, podcast, skip):
+        # The history file is sorted by publish date, so it's read backwards
+        # and only as far as the rows are needed
         path = self._get_episode_history_file_path(podcast)
-        if not os.path.exists(path):
-            return []
-        with open(path, newline='') as f:
-            rows = list(csv.reader(f))
-            has_header = len(rows) > 0 and rows[0] == Episode.columns
-            if has_header:
-                rows = rows[1:]
-            episodes = reversed([Episode.from_tuple(podcast, e) for e in rows])
-            return episodes
+        read = set()
+        last = None
+        # Publish time of the last episode read before the file was replaced
+        resumed_from = None
+        while os.path.exists(path):
+            try:
+                for row in csv.reader(_reversed_records(path)):
+                    if row == Episode.columns:
+                        # The header is the first record in the file
+                        continue
+                    if row[0] in skip:
+                        # Replaced or removed in the journal
+                        continue
+                    episode = Episode.from_tuple(podcast, row)
+                    if resumed_from is not None:
+                        if row[0] in read or episode.timestamp > resumed_from:
+                            # Read before or newer than what has been read
+                            continue
+                        if episode.timestamp < resumed_from:
+                            resumed_from = None
+                    read.add(row[0])
+                    last = episode
+                    yield episode
+                return
+            except _FileReplaced:
+                # Written anew by another process, so the new file is read
+                # on from where the old one was left
+                if last is not None:
+                    resumed_from = last.timestamp
 
-    def save_episodes(self, podcast):
+    def _read_journal(self, podcast):
+        """
+        Replay the journal.
+
+        :return: The latest row of each GUID in the journal, or None for
+            removed GUIDs.
+        :rtype: dict
+        """
+        journal = {}
+        path = self._get_journal_file_path(podcast)
+        if os.path.exists(path):
+            records, _size = _read_journal_records(path)
+            _replay(journal, records)
+        return journal
+
+    def save_episodes(self, podcast, writes=None):
+        """
+        Append the changes since the episodes were loaded or last saved to
+        the journal. A new history file is written instead if there is none
+        yet, if the journal would grow too large or if there are no tracked
+        changes.
+
+        :param writes: Write the files as part of these writes instead of
+            on their own.
+        :type writes: _FileWrites
+        """
+        if writes is None:
+            with FileStorage().lock(), _FileWrites() as writes:
+                self.save_episodes(podcast, writes)
+            return
+        episodes = podcast.episodes
+        changed = list(episodes.added)
+        added = set(map(id, changed))
+        changed.extend(e for e in episodes.changed if id(e) not in added)
+        records = [['-', guid] for guid in episodes.removed_guids]
+        records.extend(['+'] + e.str_attributes() for e in changed)
+        history_path = self._get_episode_history_file_path(podcast)
+        journal_path = self._get_journal_file_path(podcast)
+        if not records or not os.path.exists(history_path):
+            self.compact(podcast, writes, records)
+            return
+
+        data = io.StringIO(newline='')
+        csv.writer(data).writerows(records)
+        data = data.getvalue()
+        journal_size = 0
+        if os.path.exists(journal_path):
+            _records, journal_size = _read_journal_records(journal_path)
+            if journal_size != os.path.getsize(journal_path):
+                # The last record was only partly written
+                os.truncate(journal_path, journal_size)
+        journal_size += len(data.encode(locale.getpreferredencoding(False)))
+        if journal_size > \
+                os.path.getsize(history_path) * self.max_journal_ratio:
+            self.compact(podcast, writes, records)
+            return
+        with writes.append(journal_path, newline='') as f:
+            f.write(data)
+
+    def compact(self, podcast, writes, records=()):
+        """
+        Write the episodes in the podcast's history and journal, with the
+        journal records `records` added, to a new history file sorted by
+        publish time, and remove the journal. The episodes are read again
+        since another process may have appended to the journal after the
+        podcast's episodes were loaded.
+
+        :type writes: _FileWrites
+        :type records: list
+        """
+        journal = self._read_journal(podcast)
+        _replay(journal, records)
+        episodes = self._iter_episodes(podcast, None, journal)
         path = self._get_episode_history_file_path(podcast)
-        header = Episode.columns
         rows = [e.str_attributes() for e in sorted(
-            podcast.episodes, key=attrgetter('published'))]
-        with open(path, 'w', newline='') as f:
+            episodes, key=attrgetter('timestamp'))]
+        with writes.open(path, newline='') as f:
             writer = csv.writer(f)
-            writer.writerow(header)
+            writer.writerow(Episode.columns)
             writer.writerows(rows)
+        writes.remove(self._get_journal_file_path(podcast))
+
+
+def _replay(journal, records):
+    for record in records:
+        # The GUIDs of the history's rows are strings
+        guid = str(record[1])
+        if record[0] == '-':
+            journal[guid] = None
+        else:
+            journal[guid] = record[1:]
+
+
+def _read_journal_records(path):
+    """
+    Read the records of a journal. A record that was only partly written
+    when riley was interrupted ends the journal.
+
+    :return: The complete records, and the size in bytes of the part of the
+        file they take up.
+    """
+    with open(path, newline='') as f:
+        data = f.read()
+    # Counts the characters of the lines which the CSV reader has read
+    position = 0
+
+    def lines():
+        nonlocal position
+        for line in io.StringIO(data, newline=''):
+            position += len(line)
+            yield line
+
+    records = []
+    end = 0
+    for record in csv.reader(lines()):
+        if data[position - 1] != '\n':
+            break
+        if len(record) == 2 and record[0] == '-':
+            pass
+        elif len(record) != len(Episode.columns) + 1 or record[0] != '+' or \
+                record[-1] not in ('True', 'False'):
+            break
+        records.append(record)
+        end = position
+    encoding = locale.getpreferredencoding(False)
+    return records, len(data[:end].encode(encoding))
+
+
+def _latest_not_downloaded(episodes, limit):
+    """
+    :return: List of (GUID, timestamp) of the `limit` latest episodes that
+        haven't been downloaded.
+    """
+    return heapq.nlargest(
+        limit, ((e.guid, e.timestamp) for e in episodes if not e.downloaded),
+        key=itemgetter(1))
+
+
+class _FileReplaced(Exception):
+    pass
+
+
+def _reversed_lines(path, block_size=16 * 1024):
+    """
+    Read a file's lines from the end, including any carriage returns. The file
+    is only opened while a block is being read, so that many files can be
+    read at the same time.
+
+    :type path: str
+    :rtype: collections.Iterator[bytes]
+    :raise _FileReplaced: If another file has replaced the file at the path
+        between the blocks.
+    """
+    file_stat = os.stat(path)
+    position = file_stat.st_size
+    remainder = b''
+    while position > 0:
+        size = min(block_size, position)
+        position -= size
+        with open(path, 'rb') as f:
+            if not os.path.samestat(os.fstat(f.fileno()), file_stat):
+                raise _FileReplaced(path)
+            f.seek(position)
+            block = f.read(size)
+        lines = (block + remainder).split(b'\n')
+        # The first line may continue in the previous block
+        remainder = lines.pop(0)
+        yield from reversed(lines)
+    yield remainder
+
+
+def _reversed_records(path):
+    """
+    Read the CSV records of a file written by csv.writer from the end. Quoted
+    fields may contain line breaks, so lines are joined until the number of
+    quotes in the record is even. Empty lines are skipped.
+
+    :type path: str
+    :rtype: collections.Iterator[str]
+    """
+    encoding = locale.getpreferredencoding(False)
+    parts = []
+    quotes = 0
+    for line in _reversed_lines(path):
+        parts.append(line)
+        quotes += line.count(b'"')
+        if quotes % 2 == 0:
+            record = b'\n'.join(reversed(parts))
+            parts = []
+            if record.endswith(b'\r'):
+                record = record[:-1]
+            if record:
+                yield record.decode(encoding)
+
+
+class SQLiteStorage(AbstractFileStorage, Storage):
+    """
+    Keeps the podcasts and their episodes in an SQLite database in the config
+    directory. Settings such as the download directory are still read from
+    config.yml.
+    """
+
+    schema = """
+        CREATE TABLE IF NOT EXISTS podcasts (
+            name TEXT PRIMARY KEY,
+            feed TEXT NOT NULL,
+            priority INTEGER NOT NULL,
+            etag TEXT,
+            last_modified TEXT
+        );
+        CREATE TABLE IF NOT EXISTS episodes (
+            podcast TEXT NOT NULL REFERENCES podcasts (name),
+            guid TEXT NOT NULL,
+            title TEXT,
+            link TEXT,
+            media_href TEXT,
+            published INTEGER NOT NULL,
+            downloaded INTEGER NOT NULL,
+            PRIMARY KEY (podcast, guid)
+        );
+        CREATE INDEX IF NOT EXISTS episodes_podcast_published
+            ON episodes (podcast, published);
+        CREATE INDEX IF NOT EXISTS episodes_guid ON episodes (guid);
+        CREATE INDEX IF NOT EXISTS episodes_published
+            ON episodes (published);
+    """
+
+    def __init__(self):
+        self._connection = None
+
+    @property
+    def _database_path(self):
+        return os.path.join(self._user_data_dir_path, 'riley.sqlite3')
+
+    @property
+    def connection(self):
+        if self._connection is None:
+            path = self._database_path
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            self._connection = sqlite3.connect(path)
+            self._create_schema(self._connection)
+        return self._connection
+
+    def _create_schema(self, connection):
+        version = connection.execute('PRAGMA user_version').fetchone()[0]
+        exists = connection.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' "
+            "AND name = 'episodes'").fetchone() is not None
+        if exists and version < 1:
+            # The first version stored publish times as formatted dates
+            connection.executescript("""
+                BEGIN;
+                ALTER TABLE episodes RENAME TO legacy_episodes;
+                DROP INDEX episodes_podcast_published;
+                DROP INDEX episodes_guid;
+                DROP INDEX episodes_published;
+            """ + self.schema + """
+                INSERT INTO episodes SELECT podcast, guid, title, link,
+                    media_href, CAST(strftime('%s', published) AS INTEGER),
+                    downloaded
+                FROM legacy_episodes;
+                DROP TABLE legacy_episodes;
+                PRAGMA user_version = 1;
+                COMMIT;
+            """)
+        else:
+            connection.executescript(self.schema)
+            connection.execute('PRAGMA user_version = 1')
+
+    @property
+    def episode_storage(self):
+        return SQLiteEpisodeStorage(self.connection)
+
+    def get_config(self):
+        return FileStorage().get_config()
+
+    def get_schedule(self):
+        return FileStorage().get_schedule()
+
+    def update_schedule(self, entries):
+        FileStorage().update_schedule(entries)
+
+    def get_podcasts(self):
+        episode_storage = self.episode_storage
+        rows = self.connection.execute(
+            'SELECT name, feed, priority, etag, last_modified FROM podcasts '
+            'ORDER BY rowid')
+        return OrderedDict(
+            (row[0], Podcast(row[0], row[1], episode_storage, *row[2:]))
+            for row in rows)
+
+    def iter_latest_episodes(self, limit=None, since=None):
+        podcasts = self.get_podcasts()
+        query, parameters = SQLiteEpisodeStorage.filter_query(
+            'SELECT podcast, guid, title, link, media_href, published, '
+            'downloaded FROM episodes', limit, since)
+        for row in self.connection.execute(query, parameters):
+            yield Episode(podcasts[row[0]], *row[1:6], bool(row[6]))
+
+    def get_download_candidates(self, limit):
+        rows = self.connection.execute(
+            'SELECT podcast, guid, published FROM ('
+            'SELECT podcast, guid, published, ROW_NUMBER() OVER ('
+            'PARTITION BY podcast ORDER BY published DESC) AS n '
+            'FROM episodes WHERE downloaded = 0) WHERE n <= ?', (limit,))
+        return rows.fetchall()
+
+    def _write_podcasts(self, podcasts):
+        episode_storage = self.episode_storage
+        # Everything is written in one transaction
+        with timings.phase('save'), self.connection as connection:
+            for podcast in podcasts:
+                exists = connection.execute(
+                    'SELECT 1 FROM podcasts WHERE name = ?',
+                    (podcast.name,)).fetchone() is not None
+                if exists and not podcast.modified:
+                    continue
+                connection.execute(
+                    'INSERT INTO podcasts '
+                    '(name, feed, priority, etag, last_modified) '
+                    'VALUES (?, ?, ?, ?, ?) '
+                    'ON CONFLICT (name) DO UPDATE SET feed = excluded.feed, '
+                    'priority = excluded.priority, etag = excluded.etag, '
+                    'last_modified = excluded.last_modified',
+                    (podcast.name, podcast.feed, podcast.priority,
+                     podcast.etag, podcast.last_modified))
+            for podcast in podcasts:
+                if podcast.episodes_modified:
+                    episode_storage.write_episodes(podcast)
+        for podcast in podcasts:
+            podcast.modified = False
+            if podcast.episodes_modified:
+                podcast.episodes.mark_saved()
+
+
+class SQLiteEpisodeStorage(EpisodeStorage):
+    def __init__(self, connection):
+        """
+        :type connection: sqlite3.Connection
+        """
+        self.connection = connection
+
+    def get_episodes(self, podcast):
+        return list(self.iter_episodes(podcast))
+
+    def iter_episodes(self, podcast, limit=None, since=None):
+        query, parameters = self.filter_query(
+            'SELECT guid, title, link, media_href, published, downloaded '
+            'FROM episodes WHERE podcast = ?', limit, since)
+        rows = self.connection.execute(query, [podcast.name] + parameters)
+        for row in rows:
+            yield Episode(podcast, *row[:5], bool(row[5]))
+
+    @staticmethod
+    def filter_query(select, limit, since):
+        """
+        Add the conditions of an episode query to a SELECT statement, whose
+        WHERE clause, if any, comes last.
+
+        :return: The query and its parameters.
+        """
+        parameters = []
+        if since is not None:
+            select += ' AND' if ' WHERE ' in select else ' WHERE'
+            select += ' published >= ?'
+            parameters.append(calendar.timegm(since))
+        select += ' ORDER BY published DESC, rowid DESC'
+        if limit is not None:
+            select += ' LIMIT ?'
+            parameters.append(limit)
+        return select, parameters
+
+    def save_episodes(self, podcast):
+        with self.connection:
+            self.write_episodes(podcast)
+        podcast.episodes.mark_saved()
+
+    def write_episodes(self, podcast):
+        """
+        Only write the episodes which have been added, changed or removed
+        since the podcast's episodes were loaded or last saved. The caller
+        commits the transaction.
+        """
+        episodes = podcast.episodes
+        added = set(map(id, episodes.added))
+        rows = [self._row(podcast, e) for e in episodes.added]
+        rows.extend(self._row(podcast, e) for e in episodes.changed
+                    if id(e) not in added)
+        self.connection.executemany(
+            'DELETE FROM episodes WHERE podcast = ? AND guid = ?',
+            ((podcast.name, guid) for guid in episodes.removed_guids))
+        self.connection.executemany(
+            'INSERT OR REPLACE INTO episodes '
+            '(podcast, guid, title, link, media_href, published, downloaded) '
+            'VALUES (?, ?, ?, ?, ?, ?, ?)', rows)
+        for episode in episodes.changed:
+            episode.modified = False
+
+    @staticmethod
+    def _row(podcast, episode):
+        return (podcast.name, episode.guid, episode.title, episode.link,
+                episode.media_href, episode.timestamp, episode.downloaded)
@@ -0,0 +1,87 @@
+import sys
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+
+class Timings:
+    """
+    Time spent in the phases of a command, such as loading the config or
+    fetching a feed, for the --timings option. Nothing is recorded unless
+    started, and phases may be timed from several threads at once. A phase
+    may contain other phases, like a merge loading the podcast's episodes.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self._lock = threading.Lock()
+        self.phases = OrderedDict()
+        self.transfers = []
+
+    def start(self):
+        with self._lock:
+            self.phases.clear()
+            del self.transfers[:]
+            self.enabled = True
+
+    def stop(self):
+        self.enabled = False
+
+    @contextmanager
+    def phase(self, name, subject=None):
+        """
+        Time the block as part of a phase.
+
+        :type name: str
+        :param subject: What the time is spent on, like a podcast's name.
+        :type subject: str
+        """
+        if not self.enabled:
+            yield
+            return
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - start, subject)
+
+    def add(self, name, seconds, subject=None):
+        """
+        :type name: str
+        :type seconds: float
+        :type subject: str
+        """
+        with self._lock:
+            subjects = self.phases.setdefault(name, OrderedDict())
+            subjects[subject] = subjects.get(subject, 0) + seconds
+
+    def add_transfer(self, url, size, seconds):
+        """
+        :type url: str
+        :param size: Number of bytes.
+        :type size: int
+        :type seconds: float
+        """
+        with self._lock:
+            self.transfers.append((url, size, seconds))
+        self.add('download', seconds)
+
+    def report(self, file=None):
+        if file is None:
+            file = sys.stderr
+        for name, subjects in self.phases.items():
+            print('%-40s %9.3f s' % (name, sum(subjects.values())),
+                  file=file)
+            for subject, seconds in subjects.items():
+                if subject is not None:
+                    print('    %-36s %9.3f s' % (subject, seconds),
+                          file=file)
+        for url, size, seconds in self.transfers:
+            rate = size / seconds if seconds > 0 else 0
+            print('    %s: %d bytes, %.0f bytes/s' % (url, size, rate),
+                  file=file)
+
+
+# Timings of the running command
+timings = Timings()
@@ -0,0 +1,143 @@
+import sys
+import threading
+import time
+from collections import Counter
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from urllib.parse import urlparse
+
+from riley.download import PROGRESS_INTERVAL, progress_bar
+
+
+class AggregateProgress:
+    """
+    A single progress bar for all transfers in a download queue. The expected
+    size grows as the transfers learn their content lengths.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._bar = None
+        self._last_shown = 0
+        self.expected_size = 0
+        self.downloaded = 0
+
+    def add_expected(self, size):
+        """
+        :type size: int
+        """
+        with self._lock:
+            self.expected_size += size
+            self._show()
+
+    def advance(self, size):
+        """
+        :type size: int
+        """
+        with self._lock:
+            self.downloaded += size
+            self._show()
+
+    def _show(self, force=False):
+        if self.expected_size == 0:
+            return
+        now = time.monotonic()
+        if not force and now - self._last_shown < PROGRESS_INTERVAL:
+            return
+        self._last_shown = now
+        if self._bar is None:
+            self._bar = progress_bar(self.expected_size)
+        # Transfers without a content length may exceed the expected size
+        self._bar.show(min(self.downloaded, self.expected_size),
+                       self.expected_size)
+
+    def done(self):
+        with self._lock:
+            self._show(force=True)
+            if self._bar is not None:
+                self._bar.done()
+
+
+class DownloadQueue:
+    """
+    Download episodes with a bounded number of concurrent transfers, of which
+    at most `per_host` go to the same host.
+    """
+
+    def __init__(self, download, jobs=1, per_host=4):
+        """
+        :param download: Function with the signature of
+            riley.download.download.
+        :type jobs: int
+        :type per_host: int
+        """
+        self.download = download
+        self.jobs = max(jobs, 1)
+        self.per_host = max(per_host, 1)
+
+    def run(self, episodes, to_dir, on_done, on_start=None):
+        """
+        Download the episodes' media files. `on_start` and `on_done` are
+        called in the calling thread when an episode's own transfer starts and
+        as soon as it has completed.
+
+        :type episodes: collections.Iterable[riley.models.Episode]
+        :type to_dir: str
+        :return: Episodes that failed to download.
+        """
+        failed = []
+        if self.jobs == 1:
+            # Download one at a time with one progress bar per file
+            for episode in episodes:
+                if on_start is not None:
+                    on_start(episode)
+                try:
+                    self.download(episode.media_href, to_dir,
+                                  episode.published)
+                except Exception as e:
+                    print("Could not download '%s': %s" % (episode.title, e),
+                          file=sys.stderr)
+                    failed.append(episode)
+                else:
+                    on_done(episode)
+            return failed
+
+        progress = AggregateProgress()
+        queued = list(episodes)
+        running = {}
+        transfers_by_host = Counter()
+        with ThreadPoolExecutor(max_workers=self.jobs) as executor:
+            while queued or running:
+                # Start the first queued episodes whose hosts are below the
+                # limit, so that a busy host doesn't hold up the others
+                waiting = []
+                for i, episode in enumerate(queued):
+                    if len(running) == self.jobs:
+                        waiting.extend(queued[i:])
+                        break
+                    host = urlparse(episode.media_href).netloc
+                    if transfers_by_host[host] == self.per_host:
+                        waiting.append(episode)
+                        continue
+                    transfers_by_host[host] += 1
+                    if on_start is not None:
+                        on_start(episode)
+                    future = executor.submit(
+                        self.download, episode.media_href, to_dir,
+                        episode.published, progress=progress)
+                    running[future] = episode
+                queued = waiting
+
+                done, _pending = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    episode = running.pop(future)
+                    transfers_by_host[urlparse(episode.media_href).netloc] -= 1
+                    try:
+                        future.result()
+                    except Exception as e:
+                        print("Could not download '%s': %s" % (
+                            episode.title, e), file=sys.stderr)
+                        failed.append(episode)
+                    else:
+                        on_done(episode)
+        progress.done()
+        return failed
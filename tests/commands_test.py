@@ -1,12 +1,17 @@
 import os
+import pstats
 import re
+import threading
 import time
 from itertools import chain
 from unittest.mock import MagicMock, call
 
 from pytest import raises
 from riley.commands import WhereIsConfig, DownloadEpisodes, ListPodcasts, \
-    Insert, ListEpisodes, FetchEpisodes, DownloadBest
+    Insert, ListEpisodes, FetchEpisodes, DownloadBest, MigrateToSQLite, \
+    Upgrade, Sync, get_storage
+from riley.download import TIMEOUT
+from riley.storage import SQLiteStorage
 
 
 def test_where_is_config(capsys, monkeypatch):
@@ -103,6 +108,8 @@ def test_fetch_episodes(tmpdir, monkeypatch):
     feedparser, feed, entry1, entry2, enclosure1, enclosure2 = [
         MagicMock() for _ in range(6)]
     feedparser.parse.return_value = feed
+    # The server didn't send any status code or cache validators
+    feed.get.return_value = None
     feed.entries = [entry1, entry2]
     entry1.enclosures = [enclosure1]
     entry2.enclosures = [enclosure2]
@@ -118,13 +125,20 @@ def test_fetch_episodes(tmpdir, monkeypatch):
         (2015, 12, 12, 12, 12, 12, 5, 346, -1))
     entry2.published_parsed = time.struct_time(
         (2015, 12, 12, 12, 12, 12, 5, 346, -1))
-    monkeypatch.setattr('riley.commands.feedparser', feedparser)
+    monkeypatch.setattr('riley.feeds.feedparser', feedparser)
+    session = MagicMock()
+    session.get.return_value.status_code = 200
+    session.get.return_value.headers = {}
+    monkeypatch.setattr('riley.commands.download.get_session', lambda: session)
 
     # Fetch new episodes
     FetchEpisodes().handle()
 
     # There should be two episodes in the file, since one was a duplicate (it
-    # had already been fetched previously)
+    # had already been fetched previously). The publish times are rewritten
+    # as seconds since the epoch.
+    for data in expected_data:
+        data[4] = '1449922332'
     expected_read = """guid,title,link,media_href,published,downloaded
 {},{},{},{},{},{}
 {},{},{},{},{},{}\n""".format(*chain(*expected_data))
@@ -145,8 +159,6 @@ def test_fetch_feed_without_enclosure(monkeypatch):
         return_value = [podcast]
     monkeypatch.setattr('riley.commands.FileStorage', file_storage_mock)
 
-    monkeypatch.setattr('riley.commands.FileEpisodeStorage', MagicMock())
-
     FetchEpisodes().handle()
 
     # The episode without an enclosure is not saved
@@ -172,8 +184,6 @@ def test_fetch_feed_without_links(monkeypatch):
         return_value = [podcast]
     monkeypatch.setattr('riley.commands.FileStorage', file_storage_mock)
 
-    monkeypatch.setattr('riley.commands.FileEpisodeStorage', MagicMock())
-
     FetchEpisodes().handle()
 
     # The episode without any links was not saved
@@ -215,10 +225,43 @@ abc,def,ghi,jkl,2012-12-12 10:10:10,False"""
         ),
     ]
     expected_read = """guid,title,link,media_href,published,downloaded
-abc,def,ghi,jkl,2012-12-12 10:10:10,True\n"""
+abc,def,ghi,jkl,1355307010,True\n"""
     assert history_path.read() == expected_read
 
 
+def test_download_episodes_failure(tmpdir, monkeypatch, capsys):
+    tmpdir.join('config.yml').write('\n'.join([
+        'storage: ~/downloads',
+        'podcasts:',
+        '  kalle:',
+        '    feed: http://anka.se',
+        '    priority: 5',
+    ]))
+    history_path = tmpdir.join('kalle_history.csv')
+    history_path.write("""guid,title,link,media_href,published,downloaded
+abc,def,ghi,http://a.se/1.mp3,2012-12-12 10:10:10,False
+mno,pqr,stu,http://b.se/2.mp3,2012-12-11 10:10:10,False""")
+    monkeypatch.setattr(
+        'riley.storage.user_data_dir', lambda x, y: tmpdir.strpath)
+
+    def download(url, to_dir, datetime, progress):
+        if url == 'http://b.se/2.mp3':
+            raise OSError('connection reset')
+    download_mock = MagicMock()
+    download_mock.download = download
+    monkeypatch.setattr('riley.commands.download', download_mock)
+
+    with raises(SystemExit) as exception:
+        DownloadEpisodes().handle(['kalle', '0-1'], jobs=2)
+
+    assert exception.value.code == \
+        '1 of the episodes could not be downloaded.'
+    assert "Could not download 'pqr'" in capsys.readouterr().err
+    # The other episode was still marked as downloaded
+    assert 'abc,def,ghi,http://a.se/1.mp3,1355307010,True' in \
+        history_path.read()
+
+
 def test_download_invalid_podcast(monkeypatch):
     file_storage_mock = MagicMock()
     monkeypatch.setattr('riley.commands.FileStorage', file_storage_mock)
@@ -298,3 +341,363 @@ f,f,f,f,2013-12-13 10:00:00,False"""
             time.strptime('2013-12-13 10:00:00', '%Y-%m-%d %H:%M:%S')
         ),
     ]
+
+
+def test_fetch_episodes_concurrently(capsys, monkeypatch):
+    feeds_dir = os.path.join(os.path.dirname(__file__), 'feeds')
+    podcasts = []
+    for name in ['frihetsfaxen', 'broken', 'fightingforthefaith']:
+        podcast = MagicMock()
+        podcast.name = name
+        podcast.episodes = []
+        podcast.feed = os.path.join(feeds_dir, '%s.xml' % name)
+        podcasts.append(podcast)
+
+    file_storage_mock = MagicMock()
+    file_storage_mock.return_value.get_podcasts.return_value.values. \
+        return_value = podcasts
+    monkeypatch.setattr('riley.commands.FileStorage', file_storage_mock)
+
+    parse = FetchEpisodes.fetch
+
+    def fetch(podcast, **kwargs):
+        if podcast.name == 'broken':
+            raise OSError('connection reset')
+        return parse(podcast, **kwargs)
+    monkeypatch.setattr(FetchEpisodes, 'fetch', staticmethod(fetch))
+
+    FetchEpisodes().handle(jobs=3)
+
+    # The podcasts are reported in order and the broken feed doesn't stop the
+    # other ones from being saved
+    out, err = capsys.readouterr()
+    assert out == 'frihetsfaxen\nbroken\nfightingforthefaith\n'
+    assert err == "Could not fetch 'broken': connection reset\n"
+    assert len(podcasts[0].episodes) == 1
+    assert len(podcasts[1].episodes) == 0
+    assert len(podcasts[2].episodes) == 1
+    assert file_storage_mock.return_value.save_podcast.call_args_list == [
+        call(podcasts[0]), call(podcasts[2])]
+
+
+def test_fetch_unchanged_feed(capsys, tmpdir, monkeypatch):
+    config = '\n'.join([
+        'podcasts:',
+        '    kalle:',
+        '        feed: http://anka.se',
+        '        priority: 5',
+        '        etag: abc',
+        '        last_modified: Mon, 14 Mar 2016 10:00:00 GMT',
+    ])
+    config_path = tmpdir.join('config.yml')
+    config_path.write(config)
+    monkeypatch.setattr(
+        'riley.storage.user_data_dir', lambda x, y: tmpdir.strpath)
+
+    session = MagicMock()
+    session.get.return_value.status_code = 304
+    monkeypatch.setattr('riley.commands.download.get_session', lambda: session)
+
+    FetchEpisodes().handle()
+
+    # The cache validators were sent along with the request
+    assert session.get.call_args_list == [call('http://anka.se', headers={
+        'If-None-Match': 'abc',
+        'If-Modified-Since': 'Mon, 14 Mar 2016 10:00:00 GMT'},
+        timeout=TIMEOUT)]
+    # Nothing was written since the feed hadn't changed
+    assert config_path.read() == config
+    assert not tmpdir.join('kalle_history.csv').exists()
+    out, _err = capsys.readouterr()
+    assert out == 'kalle\n1 of 1 feeds unchanged.\n'
+
+
+def test_download_best_episodes_concurrently(tmpdir, monkeypatch):
+    config = '\n'.join([
+        'storage: ~/downloads',
+        'podcasts:',
+        '    kalle:',
+        '        feed: http://kalle.se',
+        '        priority: 5',
+    ])
+    history = """guid,title,link,media_href,published,downloaded
+a,a,a,http://kalle.se/a.mp3,2014-12-12 10:00:00,False
+b,b,b,http://kalle.se/b.mp3,2012-12-12 10:00:00,False
+c,c,c,http://kalle.se/c.mp3,2013-12-12 10:00:00,False"""
+    tmpdir.join('config.yml').write(config)
+    history_path = tmpdir.join('kalle_history.csv')
+    history_path.write(history)
+    monkeypatch.setattr(
+        'riley.storage.user_data_dir', lambda x, y: tmpdir.strpath)
+
+    download_class_mock = MagicMock()
+    monkeypatch.setattr('riley.commands.download', download_class_mock)
+
+    DownloadBest().handle(2, jobs=2)
+
+    urls = sorted(c[0][0] for c in
+                  download_class_mock.download.call_args_list)
+    assert urls == ['http://kalle.se/a.mp3', 'http://kalle.se/c.mp3']
+    assert history_path.read() == \
+        """guid,title,link,media_href,published,downloaded
+b,b,b,http://kalle.se/b.mp3,1355306400,False
+c,c,c,http://kalle.se/c.mp3,1386842400,True
+a,a,a,http://kalle.se/a.mp3,1418378400,True\n"""
+
+
+def test_migrate_to_sqlite(capsys, tmpdir, monkeypatch):
+    config = """podcasts:
+    kalle:
+        feed: http://anka.se
+        priority: 5"""
+    history = """guid,title,link,media_href,published,downloaded
+abc,def,ghi,jkl,2012-12-12 10:10:10,True
+bcd,efg,hij,klm,2013-12-12 10:10:10,False"""
+    tmpdir.join('config.yml').write(config)
+    tmpdir.join('kalle_history.csv').write(history)
+    monkeypatch.setattr(
+        'riley.storage.user_data_dir', lambda x, y: tmpdir.strpath)
+
+    MigrateToSQLite().handle()
+    # Migrating twice doesn't duplicate anything
+    MigrateToSQLite().handle()
+    # The history file is no longer used
+    tmpdir.join('kalle_history.csv').remove()
+    capsys.readouterr()
+
+    assert isinstance(get_storage(), SQLiteStorage)
+    ListPodcasts().handle()
+    ListEpisodes().handle()
+    Insert().handle('nisse', 'http://nisse.se')
+    ListPodcasts().handle()
+    out, _err = capsys.readouterr()
+    assert out == 'kalle http://anka.se\n' \
+                  'efg klm\n' \
+                  'def jkl\n' \
+                  'kalle http://anka.se\n' \
+                  'nisse http://nisse.se\n'
+
+
+def test_list_latest_episodes(capsys, tmpdir, monkeypatch):
+    config = """podcasts:
+    kalle:
+        feed: http://anka.se
+        priority: 5"""
+    history = """guid,title,link,media_href,published,downloaded
+a,a,a,a,2012-12-12 10:10:10,True
+b,b,b,b,2013-12-12 10:10:10,True
+c,c,c,c,2014-12-12 10:10:10,True"""
+    tmpdir.join('config.yml').write(config)
+    tmpdir.join('kalle_history.csv').write(history)
+    monkeypatch.setattr(
+        'riley.storage.user_data_dir', lambda x, y: tmpdir.strpath)
+
+    ListEpisodes().execute(['riley', 'list', '-n', '2'])
+    ListEpisodes().execute(['riley', 'list', 'kalle', '--since', '2013-12-12'])
+    out, _err = capsys.readouterr()
+    assert out == 'c c\nb b\nc c\nb b\n'
+
+
+def test_upgrade(capsys, tmpdir, monkeypatch):
+    config = """podcasts:
+    kalle:
+        feed: http://anka.se
+        priority: 5"""
+    history_path = tmpdir.join('kalle_history.csv')
+    history_path.write("""guid,title,link,media_href,published,downloaded
+abc,def,ghi,jkl,2012-12-12 10:10:10,True""")
+    tmpdir.join('config.yml').write(config)
+    monkeypatch.setattr(
+        'riley.storage.user_data_dir', lambda x, y: tmpdir.strpath)
+
+    Upgrade().handle()
+
+    out, _err = capsys.readouterr()
+    assert out == 'kalle\n'
+    assert history_path.read() == \
+        """guid,title,link,media_href,published,downloaded
+abc,def,ghi,jkl,1355307010,True\n"""
+
+
+def test_fetch_only_new_entries(capsys, tmpdir, monkeypatch):
+    items = ''.join("""
+        <item>
+            <title>{0}</title>
+            <guid>{0}</guid>
+            <pubDate>{1} Dec 2015 12:00:00 +0000</pubDate>
+            <enclosure url="http://kalle.se/{0}.mp3" type="audio/mpeg"/>
+        </item>""".format(guid, day) for guid, day in
+        [('b', 13), ('a', 12), ('c', 11)])
+    items = '<item><title>Notes</title><guid>n</guid></item>' + items
+    feed_path = tmpdir.join('feed.xml')
+    feed_path.write('<rss version="2.0"><channel>%s</channel></rss>' % items)
+    tmpdir.join('config.yml').write("""podcasts:
+    kalle:
+        feed: %s
+        priority: 5""" % feed_path.strpath)
+    history = """guid,title,link,media_href,published,downloaded
+a,a,,http://kalle.se/a.mp3,1449921600,False"""
+    history_path = tmpdir.join('kalle_history.csv')
+    history_path.write(history)
+    monkeypatch.setattr(
+        'riley.storage.user_data_dir', lambda x, y: tmpdir.strpath)
+
+    # Entry 'c' is older than the latest stored episode, so it isn't checked,
+    # and undated entries without media are skipped
+    FetchEpisodes().handle()
+    episodes = get_storage().get_podcasts()['kalle'].episodes
+    assert [e.guid for e in episodes] == ['b', 'a']
+
+    FetchEpisodes().handle(full=True)
+    episodes = get_storage().get_podcasts()['kalle'].episodes
+    assert [e.guid for e in episodes] == ['b', 'a', 'c']
+
+
+def test_sync(capsys, tmpdir, monkeypatch):
+    config = ['storage: ~/downloads', 'podcasts:']
+    for name, guid in [('slow', 'y'), ('fast', 'b')]:
+        feed_path = tmpdir.join('%s.xml' % name)
+        feed_path.write("""<rss version="2.0"><channel><item>
+            <title>{0}</title>
+            <guid>{0}</guid>
+            <pubDate>13 Dec 2015 12:00:00 +0000</pubDate>
+            <enclosure url="http://{1}.se/{0}.mp3" type="audio/mpeg"/>
+        </item></channel></rss>""".format(guid, name))
+        config += ['    %s:' % name, '        feed: %s' % feed_path.strpath,
+                   '        priority: 5']
+        tmpdir.join('%s_history.csv' % name).write(
+            'guid,title,link,media_href,published,downloaded\n'
+            'a,a,,http://%s.se/a.mp3,1449921600,True' % name)
+    tmpdir.join('config.yml').write('\n'.join(config))
+    monkeypatch.setattr(
+        'riley.storage.user_data_dir', lambda x, y: tmpdir.strpath)
+
+    download_started = threading.Event()
+    download_mock = MagicMock()
+    download_mock.download.side_effect = \
+        lambda *args, **kwargs: download_started.set()
+    monkeypatch.setattr('riley.commands.download', download_mock)
+
+    fetch = FetchEpisodes.fetch
+
+    def slow_fetch(podcast, **kwargs):
+        if podcast.name == 'slow':
+            # The fast podcast's episode is downloaded before this returns
+            assert download_started.wait(5)
+        return fetch(podcast, **kwargs)
+    monkeypatch.setattr(FetchEpisodes, 'fetch', staticmethod(slow_fetch))
+
+    Sync().handle(jobs=2)
+
+    urls = [c[0][0] for c in download_mock.download.call_args_list]
+    assert urls == ['http://fast.se/b.mp3', 'http://slow.se/y.mp3']
+    podcasts = get_storage().get_podcasts()
+    for name in ['slow', 'fast']:
+        assert [e.downloaded for e in podcasts[name].episodes] == \
+            [True, True]
+    out, err = capsys.readouterr()
+    assert err == ''
+    assert "Downloading 'b' from 'fast'." in out
+
+    # Only the new episodes are downloaded, and feeds without new entries
+    # don't load the histories
+    monkeypatch.setattr('riley.storage.FileEpisodeStorage.get_episodes',
+                        None)
+    Sync().handle(jobs=2)
+    _out, err = capsys.readouterr()
+    assert err == ''
+    assert len(download_mock.download.call_args_list) == 2
+
+
+def test_sync_download_failure(capsys, tmpdir, monkeypatch):
+    feed_path = tmpdir.join('kalle.xml')
+    feed_path.write("""<rss version="2.0"><channel><item>
+        <title>b</title>
+        <guid>b</guid>
+        <pubDate>13 Dec 2015 12:00:00 +0000</pubDate>
+        <enclosure url="http://kalle.se/b.mp3" type="audio/mpeg"/>
+    </item></channel></rss>""")
+    tmpdir.join('config.yml').write('\n'.join([
+        'storage: ~/downloads', 'podcasts:', '    kalle:',
+        '        feed: %s' % feed_path.strpath, '        priority: 5']))
+    tmpdir.join('kalle_history.csv').write(
+        'guid,title,link,media_href,published,downloaded\n'
+        'a,a,,http://kalle.se/a.mp3,1449921600,True')
+    monkeypatch.setattr(
+        'riley.storage.user_data_dir', lambda x, y: tmpdir.strpath)
+    download_mock = MagicMock()
+    download_mock.download.side_effect = OSError('connection reset')
+    monkeypatch.setattr('riley.commands.download', download_mock)
+
+    with raises(SystemExit) as exception:
+        Sync().handle(jobs=2)
+
+    assert exception.value.code == \
+        '1 of the episodes could not be downloaded.'
+    assert "Could not download 'b'" in capsys.readouterr().err
+    episodes = get_storage().get_podcasts()['kalle'].episodes
+    assert [e.downloaded for e in episodes] == [False, True]
+
+
+def test_timings_and_profile(capsys, tmpdir, monkeypatch):
+    feed_path = os.path.join(
+        os.path.dirname(__file__), 'feeds', 'frihetsfaxen.xml')
+    tmpdir.join('config.yml').write("""podcasts:
+    kalle:
+        feed: %s
+        priority: 5""" % feed_path)
+    monkeypatch.setattr(
+        'riley.storage.user_data_dir', lambda x, y: tmpdir.strpath)
+    profile_path = tmpdir.join('fetch.prof').strpath
+
+    FetchEpisodes().execute(
+        ['riley', 'fetch', '--timings', '--profile', profile_path])
+
+    _out, err = capsys.readouterr()
+    phases = [line[:40].strip() for line in err.splitlines()
+              if not line.startswith(' ')]
+    assert phases == ['load config', 'fetch feed', 'parse feed',
+                      'load episodes', 'merge', 'save', 'total']
+    assert '    kalle ' in err
+    assert pstats.Stats(profile_path).total_calls > 0
+
+
+def test_fetch_due_feeds(capsys, tmpdir, monkeypatch):
+    items = ''.join("""
+        <item>
+            <title>{0}</title>
+            <guid>{0}</guid>
+            <pubDate>{0} Dec 2015 12:00:00 +0000</pubDate>
+            <enclosure url="http://kalle.se/{0}.mp3" type="audio/mpeg"/>
+        </item>""".format(day) for day in range(14, 9, -1))
+    config = ['podcasts:']
+    for name in ['daily', 'other']:
+        feed_path = tmpdir.join('%s.xml' % name)
+        feed_path.write(
+            '<rss version="2.0"><channel>%s</channel></rss>' % items)
+        config += ['    %s:' % name, '        feed: %s' % feed_path.strpath,
+                   '        priority: 5']
+    tmpdir.join('config.yml').write('\n'.join(config))
+    monkeypatch.setattr(
+        'riley.storage.user_data_dir', lambda x, y: tmpdir.strpath)
+    now = time.time()
+
+    FetchEpisodes().handle('daily', due=True)
+    schedule = get_storage().get_schedule()
+    assert list(schedule) == ['daily']
+    assert now <= schedule['daily'][0] <= time.time()
+    # A daily podcast is fetched four times a day
+    assert schedule['daily'][1] == 6 * 60 * 60
+
+    # Only the feeds that haven't been fetched since are due
+    capsys.readouterr()
+    FetchEpisodes().handle(due=True)
+    out, _err = capsys.readouterr()
+    assert out == 'other\n'
+    FetchEpisodes().handle(due=True)
+    out, _err = capsys.readouterr()
+    assert out == ''
+    monkeypatch.setattr('riley.commands.time.time', lambda: now + 7 * 3600)
+    FetchEpisodes().handle(due=True)
+    out, _err = capsys.readouterr()
+    assert out == 'daily\nother\n'
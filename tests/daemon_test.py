@@ -0,0 +1,123 @@
+import socket
+import threading
+from unittest.mock import MagicMock
+
+from pytest import fixture
+from riley import daemon
+from riley.main import ManagementUtility
+from riley.storage import CachedFileStorage
+
+
+@fixture
+def server(tmpdir, monkeypatch):
+    feed_path = tmpdir.join('feed.xml')
+    feed_path.write("""<rss version="2.0"><channel><item>
+        <title>b</title>
+        <guid>b</guid>
+        <pubDate>13 Dec 2015 12:00:00 +0000</pubDate>
+        <enclosure url="http://kalle.se/b.mp3" type="audio/mpeg"/>
+    </item></channel></rss>""")
+    tmpdir.join('config.yml').write("""storage: %s
+podcasts:
+    kalle:
+        feed: %s
+        priority: 5""" % (tmpdir.join('music').strpath, feed_path.strpath))
+    tmpdir.join('kalle_history.csv').write(
+        'guid,title,link,media_href,published,downloaded\n'
+        'a,a,,http://kalle.se/a.mp3,1449921600,False')
+    monkeypatch.setattr(
+        'riley.storage.user_data_dir', lambda x, y: tmpdir.strpath)
+
+    server = daemon.Daemon(daemon.get_socket_path(), CachedFileStorage())
+    thread = threading.Thread(target=server.serve_forever)
+    thread.start()
+    yield server
+    server.shutdown()
+    thread.join()
+    server.server_close()
+
+
+def test_daemon_runs_commands(server, capsys):
+    path = daemon.get_socket_path()
+    assert daemon.is_running(path)
+
+    assert daemon.call(['riley', 'list'], path) == 0
+    out, err = capsys.readouterr()
+    assert out == 'a http://kalle.se/a.mp3\n'
+    assert err == ''
+    # The episodes are kept in memory
+    assert server.storage._podcasts['kalle'].episodes_modified is False
+
+    assert daemon.call(['riley', 'list', 'anka'], path) == 1
+    out, err = capsys.readouterr()
+    assert out == ''
+    assert "KeyError: 'anka'" in err
+
+    # The CLI lets the daemon run the command
+    ManagementUtility().execute(['riley', 'fetch'])
+    out, err = capsys.readouterr()
+    assert out == 'kalle\n'
+    assert [e.guid for e in server.storage._podcasts['kalle'].episodes] == \
+        ['b', 'a']
+
+
+def test_daemon_downloads_listed_episode(server, capsys, monkeypatch):
+    download = MagicMock()
+    monkeypatch.setattr('riley.commands.download.download', download)
+    path = daemon.get_socket_path()
+    assert daemon.call(['riley', 'list', 'kalle'], path) == 0
+    assert daemon.call(['riley', 'fetch'], path) == 0
+    assert daemon.call(['riley', 'list', 'kalle'], path) == 0
+    out, _err = capsys.readouterr()
+    assert out.splitlines()[-2:] == [
+        'b http://kalle.se/b.mp3', 'a http://kalle.se/a.mp3']
+
+    # The episodes in memory have the indices that were listed
+    assert daemon.call(['riley', 'download', 'kalle', '0'], path) == 0
+    assert download.call_args[0][0] == 'http://kalle.se/b.mp3'
+
+
+def test_daemon_fetches_periodically(server, capsys):
+    server._next_fetch = 0
+    server.interval = 60
+    server.service_actions()
+    server._fetch_thread.join()
+    episodes = server.storage.get_podcasts()['kalle'].episodes
+    assert [e.guid for e in episodes] == ['b', 'a']
+    assert server._next_fetch > 0
+
+
+def test_profiled_command_runs_without_daemon(server, tmpdir, monkeypatch):
+    call = MagicMock()
+    monkeypatch.setattr('riley.daemon.call', call)
+    monkeypatch.chdir(tmpdir.mkdir('work'))
+    ManagementUtility().execute(
+        ['riley', 'podcasts', '--profile', 'podcasts.prof'])
+    assert not call.called
+    assert tmpdir.join('work', 'podcasts.prof').exists()
+
+
+def test_busy_daemon_turns_commands_away(server, monkeypatch):
+    monkeypatch.setattr('riley.daemon.BUSY_TIMEOUT', 0.1)
+    path = daemon.get_socket_path()
+    # As if the daemon were running a long command
+    with server.running:
+        assert daemon.call(['riley', 'list'], path) is None
+    assert daemon.call(['riley', 'list'], path) == 0
+
+
+def test_daemon_drops_stalled_client(server, capsys, monkeypatch):
+    monkeypatch.setattr('riley.daemon._Handler.timeout', 0.1)
+    path = daemon.get_socket_path()
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as stalled:
+        stalled.connect(path)
+        assert daemon.call(['riley', 'list'], path) == 0
+    out, err = capsys.readouterr()
+    assert out == 'a http://kalle.se/a.mp3\n'
+    assert err == ''
+
+
+def test_daemon_not_running(tmpdir):
+    path = tmpdir.join('riley.sock').strpath
+    assert not daemon.is_running(path)
+    assert daemon.call(['riley', 'list'], path) is None
@@ -1,7 +1,13 @@
+import io
 import os
 import time
+from contextlib import redirect_stderr
 from unittest.mock import MagicMock
-from riley.download import get_file_name, download
+
+import requests
+from pytest import raises
+from riley.download import get_file_name, download, configure_session, \
+    get_session, progress_bar, _iter_blocks
 
 
 def test_get_file_name_from_header():
@@ -46,6 +52,12 @@ def test_prefer_name_from_headers():
     assert get_file_name(response) == 'def.mp3'
 
 
+def patch_session(monkeypatch, get):
+    session = MagicMock()
+    session.get = get
+    monkeypatch.setattr('riley.download.get_session', lambda: session)
+
+
 def dummy_download(*args):
     for b in [b'a', b'b', b'c']:
         yield b
@@ -59,8 +71,7 @@ def test_download_url(tmpdir, monkeypatch):
     response.headers.get.return_value = None
     # The header 'content-length' is missing, which was the case with
     # http://www.linuxvoice.com/podcast_opus.rss
-    monkeypatch.setattr(
-        'riley.download.requests.get', lambda x, stream: response)
+    patch_session(monkeypatch, lambda x, stream, timeout: response)
 
     time_struct = time.strptime('2015-11-12 01:02:03', '%Y-%m-%d %H:%M:%S')
 
@@ -69,3 +80,198 @@ def test_download_url(tmpdir, monkeypatch):
     file = tmpdir.join('123.mp3')
     assert file.read() == 'abc'
     assert os.stat(file.strpath).st_mtime == time.mktime(time_struct)
+
+
+def test_download_with_shared_progress(tmpdir, monkeypatch):
+    response = MagicMock()
+    response.url = 'http://example.com/123.mp3'
+    response.headers = {'content-length': '3'}
+    response.iter_content.return_value = [b'a', b'bc']
+    patch_session(monkeypatch, lambda x, stream, timeout: response)
+    progress = MagicMock()
+
+    download(response.url, tmpdir.strpath, progress=progress)
+
+    assert tmpdir.join('123.mp3').read() == 'abc'
+    progress.add_expected.assert_called_once_with(3)
+    assert progress.advance.call_count == 2
+
+
+def make_response(url, headers, blocks, status_code=200):
+    response = MagicMock()
+    response.url = url
+    response.status_code = status_code
+    response.headers = headers
+    response.iter_content.return_value = blocks
+    if status_code >= 400:
+        response.raise_for_status.side_effect = requests.HTTPError(
+            '%d Error' % status_code, response=response)
+    return response
+
+
+def test_download_resumes_part_file(tmpdir, monkeypatch):
+    url = 'http://example.com/123.mp3'
+    headers = {'content-length': '6', 'etag': '"v1"'}
+    requests_made = []
+
+    def get(url, stream, timeout, headers=None):
+        requests_made.append(headers)
+        if headers is None:
+            return make_response(url, {'content-length': '6', 'etag': '"v1"'},
+                                 [b'abc', b'def'])
+        return make_response(url, {
+            'content-length': '3', 'etag': '"v1"',
+            'content-range': 'bytes 3-5/6'}, [b'def'], 206)
+    patch_session(monkeypatch, get)
+
+    # The first attempt was interrupted after three bytes
+    tmpdir.join('123.mp3.part').write('abc')
+    tmpdir.join('123.mp3.part.json').write(
+        '{"etag": "\\"v1\\"", "last_modified": null, "content_length": 6}')
+
+    download(url, tmpdir.strpath)
+
+    assert requests_made == [
+        None, {'Range': 'bytes=3-', 'If-Range': '"v1"'}]
+    assert tmpdir.join('123.mp3').read() == 'abcdef'
+    assert not tmpdir.join('123.mp3.part').exists()
+    assert not tmpdir.join('123.mp3.part.json').exists()
+
+
+def test_download_restarts_when_file_changed(tmpdir, monkeypatch):
+    url = 'http://example.com/123.mp3'
+    requests_made = []
+
+    def get(url, stream, timeout, headers=None):
+        requests_made.append(headers)
+        return make_response(url, {'content-length': '6', 'etag': '"v2"'},
+                             [b'ghijkl'])
+    patch_session(monkeypatch, get)
+
+    tmpdir.join('123.mp3.part').write('abc')
+    tmpdir.join('123.mp3.part.json').write(
+        '{"etag": "\\"v1\\"", "last_modified": null, "content_length": 6}')
+
+    download(url, tmpdir.strpath)
+
+    # The ETag didn't match, so the partial file couldn't be resumed
+    assert requests_made == [None]
+    assert tmpdir.join('123.mp3').read() == 'ghijkl'
+
+
+def test_download_error_isnt_saved(tmpdir, monkeypatch):
+    url = 'http://example.com/missing.mp3'
+    patch_session(monkeypatch, lambda url, stream, timeout: make_response(
+        url, {'content-length': '9'}, [b'Not Found'], 404))
+
+    with raises(requests.HTTPError):
+        download(url, tmpdir.strpath)
+
+    assert tmpdir.listdir() == []
+
+
+def test_download_restarts_when_range_not_satisfiable(tmpdir, monkeypatch):
+    url = 'http://example.com/123.mp3'
+    requests_made = []
+
+    def get(url, stream, timeout, headers=None):
+        requests_made.append(headers)
+        if headers is None:
+            # Without a content length to compare the partial file to
+            return make_response(url, {'etag': '"v1"'}, [b'abcdef'])
+        return make_response(url, {}, [], 416)
+    patch_session(monkeypatch, get)
+
+    # The partial file is longer than the file on the server
+    tmpdir.join('123.mp3.part').write('abcdefg')
+    tmpdir.join('123.mp3.part.json').write(
+        '{"etag": "\\"v1\\"", "last_modified": null, "content_length": null}')
+
+    download(url, tmpdir.strpath)
+
+    assert requests_made == [
+        None, {'Range': 'bytes=7-', 'If-Range': '"v1"'}, None]
+    assert tmpdir.join('123.mp3').read() == 'abcdef'
+
+
+def test_download_retries_after_connection_error(tmpdir, monkeypatch):
+    url = 'http://example.com/123.mp3'
+    requests_made = []
+
+    def interrupted():
+        yield b'abc'
+        raise requests.ConnectionError
+
+    def get(url, stream, timeout, headers=None):
+        requests_made.append(headers)
+        if len(requests_made) == 1:
+            return make_response(url, {'content-length': '6', 'etag': '"v1"'},
+                                 interrupted())
+        if headers is None:
+            return make_response(url, {'content-length': '6', 'etag': '"v1"'},
+                                 [b'abcdef'])
+        return make_response(url, {
+            'content-length': '3', 'etag': '"v1"',
+            'content-range': 'bytes 3-5/6'}, [b'def'], 206)
+    patch_session(monkeypatch, get)
+
+    download(url, tmpdir.strpath)
+
+    assert requests_made == [
+        None, None, {'Range': 'bytes=3-', 'If-Range': '"v1"'}]
+    assert tmpdir.join('123.mp3').read() == 'abcdef'
+
+
+def test_progress_bar_hidden_when_redirected(monkeypatch):
+    terminal = MagicMock()
+    terminal.isatty.return_value = True
+    monkeypatch.setattr('riley.download.clint_progress.STREAM', terminal)
+    monkeypatch.setattr('sys.stderr', terminal)
+    assert not progress_bar(100).hide
+
+    # Such as in the daemon, where the output goes to the client
+    with redirect_stderr(io.StringIO()):
+        bar = progress_bar(100)
+        bar.show(50)
+        bar.done()
+    assert bar.hide
+    # Only the first bar was drawn
+    assert terminal.write.call_count == 1
+
+
+def test_shared_session():
+    session = configure_session(20)
+    assert get_session() is session
+    adapter = session.get_adapter('https://example.com')
+    assert adapter._pool_maxsize == 20
+    # Connections to the same host are pooled by the same session
+    assert get_session() is get_session()
+
+
+def test_read_blocks_into_growing_buffer():
+    data = bytes(range(256)) * 40000
+    response = MagicMock()
+    response.headers = {}
+    response.raw = io.BytesIO(data)
+
+    sizes = []
+    read = bytearray()
+    for block in _iter_blocks(response, 64 * 1024):
+        sizes.append(len(block))
+        read += block
+
+    assert read == data
+    # The reads grow until they reach the maximum size
+    assert sizes[:5] == [64 * 1024, 128 * 1024, 256 * 1024, 512 * 1024,
+                         1024 * 1024]
+    assert max(sizes) == 1024 * 1024
+
+
+def test_read_compressed_blocks_through_requests():
+    response = MagicMock()
+    response.headers = {'content-encoding': 'gzip'}
+    response.raw = io.BytesIO(b'compressed')
+    response.iter_content.return_value = [b'abc', b'def']
+
+    assert list(_iter_blocks(response, 1024)) == [b'abc', b'def']
+    response.iter_content.assert_called_once_with(1024)
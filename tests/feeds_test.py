@@ -0,0 +1,105 @@
+import io
+import os
+import time
+
+import feedparser
+from pytest import raises
+from riley import feeds
+
+feeds_dir = os.path.join(os.path.dirname(__file__), 'feeds')
+
+atom = b"""<?xml version="1.0" encoding="utf-8"?>
+<feed xmlns="http://www.w3.org/2005/Atom">
+    <title>Kalle</title>
+    <entry>
+        <title>Episode 2</title>
+        <id>urn:kalle:2</id>
+        <link href="http://kalle.se/2"/>
+        <link rel="enclosure" href="http://kalle.se/2.mp3"/>
+        <published>2016-01-14T07:55:18+01:00</published>
+    </entry>
+    <entry>
+        <title type="text">Episode 1</title>
+        <id>urn:kalle:1</id>
+        <link rel="alternate" href="http://kalle.se/1"/>
+        <link rel="enclosure" href="http://kalle.se/1.mp3"/>
+        <updated>2016-01-07T07:55:18Z</updated>
+    </entry>
+</feed>"""
+
+
+def fields(entry):
+    return (
+        entry.get('guid'),
+        entry.get('title'),
+        entry.get('link'),
+        [enclosure.href for enclosure in entry.get('enclosures', [])][:1],
+        entry.get('published_parsed'),
+    )
+
+
+def test_same_entries_as_feedparser():
+    for name in os.listdir(feeds_dir):
+        with open(os.path.join(feeds_dir, name), 'rb') as f:
+            data = f.read()
+        expected = [fields(e) for e in feedparser.parse(data).entries]
+        entries = feeds.iter_entries(io.BytesIO(data))
+        assert [fields(e) for e in entries] == expected
+
+    expected = [fields(e) for e in feedparser.parse(atom).entries]
+    entries = feeds.iter_entries(io.BytesIO(atom))
+    assert [fields(e) for e in entries] == expected
+
+
+def test_parse_large_feeds_streaming(monkeypatch):
+    with open(os.path.join(feeds_dir, 'frihetsfaxen.xml'), 'rb') as f:
+        data = f.read()
+    parse = feedparser.parse
+    monkeypatch.setattr('riley.feeds.feedparser.parse', None)
+
+    monkeypatch.setattr('riley.feeds.STREAMING_THRESHOLD', len(data))
+    feed = feeds.parse(data)
+    assert [e.title for e in feed.entries] == [
+        'Avsnitt 78 – #DNgate', 'Hannas nyårskrönika']
+    assert feed.entries[0].enclosures[0].href == \
+        'http://www.frihetsfaxen.se/mp3/frihetsfaxen78.mp3'
+    assert not hasattr(feed.entries[1], 'enclosures') or \
+        feed.entries[1].enclosures == []
+
+    monkeypatch.setattr('riley.feeds.feedparser.parse', parse)
+    monkeypatch.setattr('riley.feeds.STREAMING_THRESHOLD', len(data) + 1)
+    assert feeds.parse(data).entries == feedparser.parse(data).entries
+
+
+def test_channel_ttl():
+    data = b"""<rss version="2.0"><channel>
+        <title>Kalle</title><ttl>60</ttl>
+        <item><title>a</title><guid>a</guid><ttl>5</ttl></item>
+    </channel></rss>"""
+    for parser in ['feedparser', 'streaming']:
+        feed = feeds.parse(data, parser, {'cache-control': 'max-age=300'})
+        assert feed.feed.ttl == '60'
+        assert feed.headers == {'cache-control': 'max-age=300'}
+
+
+def test_malformed_feed_falls_back_to_feedparser():
+    data = b"""<rss><channel><item>
+        <title>Caf&eacute;</title><guid>a</guid>
+    </item></channel></rss>"""
+    with raises(feeds.MalformedFeed):
+        list(feeds.iter_entries(io.BytesIO(data)))
+    feed = feeds.parse(data, 'streaming')
+    assert feed.entries[0].title == 'Café'
+
+    with raises(feeds.MalformedFeed):
+        list(feeds.iter_entries(io.BytesIO(b'<html></html>')))
+
+
+def test_parse_date():
+    expected = time.gmtime(1452758118)
+    assert feeds.parse_date('Thu, 14 Jan 2016 07:55:18 +0000') == expected
+    assert feeds.parse_date('Thu, 14 Jan 2016 01:55:18 -0600') == expected
+    assert feeds.parse_date('2016-01-14T07:55:18Z') == expected
+    assert feeds.parse_date('2016-01-14T08:55:18.5+01:00') == expected
+    with raises(feeds.MalformedFeed):
+        feeds.parse_date('yesterday')
@@ -1,4 +1,5 @@
 from time import struct_time
+from unittest.mock import MagicMock
 
 from riley.models import HasBeenModified, Podcast, Episode
 from riley.storage import EpisodeStorage
@@ -100,7 +101,7 @@ def test_calculate_time_based_score():
     new_score = episode.score
     assert new_score - score == 1
     score = episode.score
-    episode.published = '2016-04-04 11:00:00'
+    episode.published = '2016-04-04 10:00:00'
     new_score = episode.score
     assert new_score - score == 31
 
@@ -129,3 +130,76 @@ def test_score_podcast_priority():
     # Episode 3 was published between 2 and 1
     assert e3.score > e2.score > e1.score
     # Episode 3 still gets a higher score due to its podcast's score
+
+
+def test_episode_list_guid_index():
+    podcast = Podcast('name', 'feed', DummyEpisodeStorage())
+    episodes = podcast.episodes
+    e1, e2 = episodes
+    e3 = Episode(podcast, 11, 12, 13, 14, '2012-12-12 12:12:12', True)
+    e4 = Episode(podcast, 16, 17, 18, 19, '2012-12-13 12:12:12', True)
+
+    # Loaded from the storage
+    assert e1 in episodes
+    assert episodes.get_by_guid(6) is e2
+    assert e3 not in episodes
+    assert episodes.get_by_guid(11) is None
+
+    episodes.append(e3)
+    assert e3 in episodes
+    episodes.extend([e4])
+    assert episodes.get_by_guid(16) is e4
+
+    del episodes[0]
+    assert e1 not in episodes
+    episodes[0:2] = [e1]
+    assert e1 in episodes
+    assert e2 not in episodes
+    assert e3 not in episodes
+    episodes.remove(e1)
+    assert e1 not in episodes
+    assert episodes.pop() is e4
+    assert e4 not in episodes
+    assert len(episodes) == 0
+
+    # The index follows the episodes' GUIDs
+    episodes.append(e1)
+    e1.guid = 20
+    assert episodes.get_by_guid(1) is None
+    assert episodes.get_by_guid(20) is e1
+
+
+def test_episode_list_tracks_changes():
+    podcast = Podcast('name', 'feed', DummyEpisodeStorage())
+    episodes = podcast.episodes
+    e1, e2 = episodes
+    e3 = Episode(podcast, 11, 12, 13, 14, '2012-12-12 12:12:12', True)
+
+    assert episodes.added == []
+    episodes.append(e3)
+    e2.downloaded = True
+    del episodes[0]
+    assert episodes.added == [e3]
+    assert episodes.changed == {e2}
+    assert episodes.removed_guids == {1}
+
+    episodes.mark_saved()
+    assert not episodes.modified
+    assert episodes.added == []
+    assert episodes.changed == set()
+    assert episodes.removed_guids == set()
+
+
+def test_episode_change_tracking():
+    podcast = MagicMock()
+    episode = Episode(podcast, 1, 2, 3, 4, '2012-05-06 07:08:09', False)
+    # Creating an episode isn't tracked
+    assert not hasattr(episode, '__dict__')
+    assert not episode.modified
+    assert not podcast.episodes.episode_changed.called
+
+    episode.downloaded = False
+    assert not episode.modified
+    episode.downloaded = True
+    assert episode.modified
+    podcast.episodes.episode_changed.assert_called_once_with(episode)
@@ -0,0 +1,61 @@
+from unittest.mock import MagicMock
+
+from pytest import raises
+from riley.pipeline import Pipeline
+
+
+def make_podcasts(number):
+    podcasts = []
+    for i in range(number):
+        podcast = MagicMock()
+        podcast.name = 'p%d' % i
+        podcasts.append(podcast)
+    return podcasts
+
+
+def make_episode(podcast):
+    episode = MagicMock()
+    episode.title = podcast.name
+    episode.score = 1
+    episode.media_href = 'http://%s.se/a.mp3' % podcast.name
+    return episode
+
+
+def test_failed_merge_doesnt_stop_the_other_feeds(capsys):
+    def update(podcast, feed):
+        if podcast.name == 'p0':
+            raise ValueError('no guid')
+        return [make_episode(podcast)]
+
+    download = MagicMock()
+    pipeline = Pipeline(lambda podcast: None, update, download, 'dir',
+                        jobs=2)
+    assert pipeline.run(make_podcasts(20)) == []
+    assert download.call_count == 19
+    _out, err = capsys.readouterr()
+    assert err == "Could not update 'p0': no guid\n"
+
+
+def test_failed_save_is_reported(capsys):
+    def on_done(episode):
+        raise OSError('disk full')
+
+    podcasts = make_podcasts(3)
+    pipeline = Pipeline(lambda podcast: None,
+                        lambda podcast, feed: [make_episode(podcast)],
+                        MagicMock(), 'dir', jobs=2, on_done=on_done)
+    assert sorted(e.title for e in pipeline.run(podcasts)) == \
+        ['p0', 'p1', 'p2']
+    _out, err = capsys.readouterr()
+    assert err.count("Could not save") == 3
+
+
+def test_unexpected_error_ends_the_run():
+    def on_start(episode):
+        raise RuntimeError('unexpected')
+
+    pipeline = Pipeline(lambda podcast: None,
+                        lambda podcast, feed: [make_episode(podcast)],
+                        MagicMock(), 'dir', jobs=2, on_start=on_start)
+    with raises(RuntimeError):
+        pipeline.run(make_podcasts(20))
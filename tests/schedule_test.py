@@ -0,0 +1,44 @@
+from feedparser import FeedParserDict
+from riley import schedule
+
+DAY = 24 * 60 * 60
+
+
+def test_polling_interval():
+    daily = [1449921600 - i * DAY for i in range(11)]
+    assert schedule.polling_interval(daily) == DAY / 4
+    weekly = [1449921600 - i * 7 * DAY for i in range(11)]
+    assert schedule.polling_interval(weekly) == schedule.MAX_INTERVAL
+    hourly = [1449921600 - i * 3600 for i in range(11)]
+    assert schedule.polling_interval(hourly) == schedule.MIN_INTERVAL
+    # One late episode doesn't change the cadence
+    assert schedule.polling_interval([daily[0] + 30 * DAY] + daily) == \
+        DAY / 4
+    assert schedule.polling_interval(daily[:2]) == \
+        schedule.DEFAULT_INTERVAL
+
+    # The feed isn't fetched more often than it may be cached for
+    assert schedule.polling_interval(daily, ttl=DAY / 2) == DAY / 2
+    assert schedule.polling_interval(daily, ttl=60) == DAY / 4
+    assert schedule.polling_interval(daily, ttl=30 * DAY) == \
+        schedule.MAX_INTERVAL
+
+
+def test_feed_ttl():
+    assert schedule.feed_ttl(FeedParserDict()) is None
+    assert schedule.feed_ttl(FeedParserDict(
+        feed=FeedParserDict(ttl='60'))) == 3600
+    assert schedule.feed_ttl(FeedParserDict(
+        headers={'Cache-Control': 'public, max-age=600'})) == 600
+    assert schedule.feed_ttl(FeedParserDict(
+        feed=FeedParserDict(ttl='1'),
+        headers={'cache-control': 'max-age=600'})) == 600
+    assert schedule.feed_ttl(FeedParserDict(
+        feed=FeedParserDict(ttl='soon'))) is None
+
+
+def test_is_due():
+    assert schedule.is_due(None, 1000)
+    assert not schedule.is_due([1000, 600], 1599)
+    assert schedule.is_due([1000, 600], 1600)
+    assert schedule.is_due([1000, 600], 900)
@@ -0,0 +1,23 @@
+from unittest.mock import MagicMock
+
+from riley.scoring import best_candidates
+
+
+def test_best_candidates():
+    kalle = MagicMock()
+    kalle.score = 0
+    anka = MagicMock()
+    anka.score = 30
+    podcasts = {'kalle': kalle, 'anka': anka}
+    day = 60 * 60 * 24
+    candidates = [
+        ('kalle', 'a', 100 * day),
+        ('kalle', 'b', 120 * day),
+        ('anka', 'c', 80 * day),
+        ('anka', 'd', 95 * day),
+    ]
+
+    assert best_candidates(candidates, podcasts, 3) == [
+        ('anka', 'd'), ('kalle', 'b'), ('anka', 'c')]
+    assert best_candidates(candidates, podcasts, 0) == []
+    assert best_candidates([], podcasts, 3) == []
@@ -0,0 +1,55 @@
+import os
+import subprocess
+import sys
+
+from pytest import mark
+
+root_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Seconds that riley's own imports may take for a trivial command
+STARTUP_BUDGET = 0.25
+HEAVY_MODULES = {'feedparser', 'requests', 'clint', 'asyncio', 'sqlite3'}
+# Runs riley with its data, including the daemon's socket, in the directory
+# given as the first argument, on every platform
+RUN_RILEY = """
+import sys
+import riley.storage
+data_dir = sys.argv.pop(1)
+riley.storage.user_data_dir = lambda appname, appauthor: data_dir
+from riley.main import main
+main()
+"""
+
+
+def import_times(subcommand, data_dir):
+    """
+    Run riley with -X importtime.
+
+    :return: Cumulative import time in microseconds by module, and the
+        names of the modules imported at the top level.
+    :rtype: tuple
+    """
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', RUN_RILEY, data_dir,
+         subcommand],
+        cwd=root_dir, stdout=subprocess.DEVNULL,
+        stderr=subprocess.PIPE, universal_newlines=True, check=True)
+    times = {}
+    top_level = set()
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _self, cumulative, name = line[len('import time:'):].split('|')
+        times[name.strip()] = int(cumulative)
+        if not name.startswith('  '):
+            top_level.add(name.strip())
+    return times, top_level
+
+
+@mark.parametrize('subcommand', ['config', 'podcasts', 'list'])
+def test_startup(subcommand, tmpdir):
+    times, top_level = import_times(subcommand, tmpdir.strpath)
+    # The dependencies of fetching and downloading aren't imported
+    assert HEAVY_MODULES.isdisjoint(times)
+    own = sum(times[name] for name in top_level if name.startswith('riley'))
+    assert own / 1e6 < STARTUP_BUDGET
@@ -1,9 +1,18 @@
+import fcntl
+import os
+import resource
+import sqlite3
+import time
 from time import strptime, struct_time
 from unittest.mock import MagicMock
 
 import yaml
+from pytest import raises
+from riley import storage
+from riley.commands import ListEpisodes, MigrateToSQLite
 from riley.models import Podcast, Episode
-from riley.storage import FileStorage, FileEpisodeStorage
+from riley.storage import CachedFileStorage, FileStorage, \
+    FileEpisodeStorage, SQLiteStorage
 
 config = """podcasts:
     kalle:
@@ -82,3 +91,562 @@ def test_dont_save_podcast_if_not_modified(tmpdir, monkeypatch):
     file_storage.save_podcast(podcast)
     # Since the podcast hasn't been modified it wasn't rewritten to disc
     assert file_storage._save_config_data.call_count == 1
+
+
+def test_save_podcast_cache_validators(tmpdir, monkeypatch):
+    monkeypatch.setattr(
+        'riley.storage.user_data_dir', lambda x, y: tmpdir.strpath)
+
+    podcast = Podcast('abc', 'def', MagicMock())
+    FileStorage().save_podcast(podcast)
+    podcast.etag = '"123"'
+    podcast.last_modified = 'Mon, 14 Mar 2016 10:00:00 GMT'
+    FileStorage().save_podcast(podcast)
+
+    podcast = FileStorage().get_podcasts()['abc']
+    assert podcast.etag == '"123"'
+    assert podcast.last_modified == 'Mon, 14 Mar 2016 10:00:00 GMT'
+
+
+def test_batch_save_podcasts(tmpdir, monkeypatch):
+    monkeypatch.setattr(
+        'riley.storage.user_data_dir', lambda x, y: tmpdir.strpath)
+    save_episodes = MagicMock()
+    monkeypatch.setattr(
+        'riley.storage.FileEpisodeStorage.save_episodes', save_episodes)
+
+    file_storage = FileStorage()
+    save_config_data = MagicMock(side_effect=file_storage._save_config_data)
+    file_storage._save_config_data = save_config_data
+
+    podcasts = [Podcast(name, 'feed', FileEpisodeStorage())
+                for name in ['a', 'b']]
+    with file_storage.batch():
+        for i in range(3):
+            for podcast in podcasts:
+                podcast.episodes.append(Episode(
+                    podcast, i, 2, 3, 4, '2015-11-12 01:02:03', False))
+                file_storage.save_podcast(podcast)
+        # Nothing has been written yet
+        assert save_config_data.call_count == 0
+        assert save_episodes.call_count == 0
+
+    # The config and each history were written once
+    assert save_config_data.call_count == 1
+    assert save_episodes.call_count == 2
+    assert list(file_storage.get_podcasts().keys()) == ['a', 'b']
+
+
+def test_batch_flushes_after_size(tmpdir, monkeypatch):
+    monkeypatch.setattr(
+        'riley.storage.user_data_dir', lambda x, y: tmpdir.strpath)
+
+    file_storage = FileStorage()
+    save_config_data = MagicMock(side_effect=file_storage._save_config_data)
+    file_storage._save_config_data = save_config_data
+
+    with file_storage.batch(size=2):
+        file_storage.save_podcast(Podcast('a', 'feed', MagicMock()))
+        assert save_config_data.call_count == 0
+        file_storage.save_podcast(Podcast('b', 'feed', MagicMock()))
+        assert save_config_data.call_count == 1
+        file_storage.save_podcast(Podcast('c', 'feed', MagicMock()))
+        assert save_config_data.call_count == 1
+    assert save_config_data.call_count == 2
+
+
+def test_config_is_parsed_once(tmpdir, monkeypatch):
+    config_path = tmpdir.join('config.yml')
+    config_path.write(config)
+    monkeypatch.setattr(
+        'riley.storage.user_data_dir', lambda x, y: tmpdir.strpath)
+    ordered_load = MagicMock(side_effect=storage.ordered_load)
+    monkeypatch.setattr('riley.storage.ordered_load', ordered_load)
+
+    FileStorage().get_config()
+    FileStorage().get_podcasts()
+    # Modifying the returned config doesn't change the cached one
+    FileStorage().get_config()['podcasts'].clear()
+    assert list(FileStorage().get_podcasts().keys()) == ['kalle']
+    assert ordered_load.call_count == 1
+
+    # Our own writes don't need to be parsed again
+    FileStorage().save_podcast(Podcast('abc', 'def', MagicMock()))
+    assert list(FileStorage().get_podcasts().keys()) == ['kalle', 'abc']
+    assert ordered_load.call_count == 1
+
+    # But changes by someone else do
+    config_path.write(config.replace('kalle', 'nisse'))
+    assert list(FileStorage().get_podcasts().keys()) == ['nisse']
+    assert ordered_load.call_count == 2
+
+
+def test_sqlite_storage(tmpdir, monkeypatch):
+    monkeypatch.setattr(
+        'riley.storage.user_data_dir', lambda x, y: tmpdir.strpath)
+
+    sqlite_storage = SQLiteStorage()
+    for name in ['b', 'a']:
+        podcast = Podcast(name, 'http://%s.se' % name,
+                          sqlite_storage.episode_storage, 6, etag='"1"')
+        podcast.episodes.extend([
+            Episode(podcast, 'x', 'old', 'l', 'm', '2015-11-12 01:02:03',
+                    False),
+            Episode(podcast, 'y', 'new', 'l', 'm', '2015-12-12 01:02:03',
+                    True),
+        ])
+        sqlite_storage.save_podcast(podcast)
+
+    podcasts = SQLiteStorage().get_podcasts()
+    # The podcasts are kept in the order they were added
+    assert list(podcasts.keys()) == ['b', 'a']
+    podcast = podcasts['a']
+    assert podcast.feed == 'http://a.se'
+    assert podcast.priority == 6
+    assert podcast.etag == '"1"'
+    assert podcast.last_modified is None
+    # The latest episode comes first
+    assert [(e.guid, e.title, e.downloaded) for e in podcast.episodes] == [
+        ('y', 'new', True), ('x', 'old', False)]
+    assert podcast.episodes[0].published == struct_time((
+        2015, 12, 12, 1, 2, 3, 5, 346, 0))
+
+
+def test_sqlite_storage_writes_only_changes(tmpdir, monkeypatch):
+    monkeypatch.setattr(
+        'riley.storage.user_data_dir', lambda x, y: tmpdir.strpath)
+
+    sqlite_storage = SQLiteStorage()
+    podcast = Podcast('a', 'feed', sqlite_storage.episode_storage)
+    podcast.episodes.extend(
+        Episode(podcast, str(i), 't', 'l', 'm', '2015-11-12 01:02:03', False)
+        for i in range(100))
+    sqlite_storage.save_podcast(podcast)
+
+    sqlite_storage = SQLiteStorage()
+    podcast = sqlite_storage.get_podcasts()['a']
+    statements = []
+    sqlite_storage.connection.set_trace_callback(statements.append)
+    podcast.episodes.get_by_guid('42').downloaded = True
+    del podcast.episodes[0]
+    sqlite_storage.save_podcast(podcast)
+
+    # Only the changed and the removed episode were written
+    writes = [s for s in statements if s.startswith(('INSERT', 'DELETE'))]
+    assert len(writes) == 2
+    assert not podcast.episodes.modified
+    assert not podcast.episodes.get_by_guid('42').modified
+
+    episodes = SQLiteStorage().get_podcasts()['a'].episodes
+    assert len(episodes) == 99
+    assert [e.guid for e in episodes if e.downloaded] == ['42']
+
+    # Saving a new ETag doesn't load the episodes
+    podcast = sqlite_storage.get_podcasts()['a']
+    podcast.etag = '"2"'
+    sqlite_storage.save_podcast(podcast)
+    assert not hasattr(podcast, '_episodes')
+    assert SQLiteStorage().get_podcasts()['a'].etag == '"2"'
+
+
+def test_iter_episodes_backwards(tmpdir, monkeypatch):
+    monkeypatch.setattr(
+        'riley.storage.user_data_dir', lambda x, y: tmpdir.strpath)
+
+    podcast = Podcast('abc', 'def', FileEpisodeStorage())
+    titles = ['plain', 'with "quotes"', 'two\nlines', 'crlf\r\n', '"\n"']
+    for i, title in enumerate(titles):
+        podcast.episodes.append(Episode(
+            podcast, i, title, 'link', 'media',
+            '2015-11-%02d 01:02:03' % (i + 1), False))
+    FileStorage().save_podcast(podcast)
+
+    episodes = FileEpisodeStorage().iter_episodes(podcast)
+    assert [e.title for e in episodes] == list(reversed(titles))
+
+
+def test_iter_latest_episodes(tmpdir, monkeypatch):
+    tmpdir.join('config.yml').write("""podcasts:
+    kalle:
+        feed: http://kalle.se
+        priority: 5
+    anka:
+        feed: http://anka.se
+        priority: 5""")
+    tmpdir.join('kalle_history.csv').write(
+        """guid,title,link,media_href,published,downloaded
+a,a,a,a,2012-12-12 10:00:00,False
+c,c,c,c,2013-12-12 10:00:00,False
+e,e,e,e,2014-12-12 10:00:00,False""")
+    tmpdir.join('anka_history.csv').write(
+        """guid,title,link,media_href,published,downloaded
+b,b,b,b,2012-12-13 10:00:00,False
+d,d,d,d,2013-12-13 10:00:00,False""")
+    monkeypatch.setattr(
+        'riley.storage.user_data_dir', lambda x, y: tmpdir.strpath)
+
+    episodes = FileStorage().iter_latest_episodes()
+    assert [(e.guid, e.podcast.name) for e in episodes] == [
+        ('e', 'kalle'), ('d', 'anka'), ('c', 'kalle'), ('b', 'anka'),
+        ('a', 'kalle')]
+
+    MigrateToSQLite().handle()
+    episodes = SQLiteStorage().iter_latest_episodes()
+    assert [(e.guid, e.podcast.name) for e in episodes] == [
+        ('e', 'kalle'), ('d', 'anka'), ('c', 'kalle'), ('b', 'anka'),
+        ('a', 'kalle')]
+
+
+def test_query_latest_episodes(tmpdir, monkeypatch):
+    monkeypatch.setattr(
+        'riley.storage.user_data_dir', lambda x, y: tmpdir.strpath)
+
+    for storage_class in [FileStorage, SQLiteStorage]:
+        storage = storage_class()
+        podcast = Podcast(storage_class.__name__, 'def',
+                          storage.episode_storage)
+        for i in range(1, 10):
+            podcast.episodes.append(Episode(
+                podcast, i, i, 'link', 'media', '2015-11-0%d 01:02:03' % i,
+                False))
+        storage.save_podcast(podcast)
+
+        episode_storage = storage.episode_storage
+        episodes = episode_storage.iter_episodes(podcast, limit=3)
+        assert [e.guid for e in episodes] in ([9, 8, 7], ['9', '8', '7'])
+        since = strptime('2015-11-06', '%Y-%m-%d')
+        episodes = episode_storage.iter_episodes(podcast, since=since)
+        assert len(list(episodes)) == 4
+        episodes = storage.iter_latest_episodes(limit=2, since=since)
+        assert len(list(episodes)) == 2
+
+
+def test_published_is_parsed_when_needed(tmpdir, monkeypatch):
+    tmpdir.join('kalle_history.csv').write(history)
+    monkeypatch.setattr(
+        'riley.storage.user_data_dir', lambda x, y: tmpdir.strpath)
+
+    podcast = Podcast('kalle', 'feed', FileEpisodeStorage())
+    episode = podcast.episodes[0]
+    assert isinstance(episode._published, str)
+    # Old histories have formatted dates, which are saved as timestamps
+    assert episode.str_attributes()[4] == '1355314332'
+    assert episode.published == struct_time((
+        2012, 12, 12, 12, 12, 12, 2, 347, -1))
+    assert not episode.modified
+
+
+def test_timestamps_are_not_parsed_as_dates(tmpdir, monkeypatch):
+    tmpdir.join('kalle_history.csv').write(
+        """guid,title,link,media_href,published,downloaded
+abc,def,ghi,jkl,1355314332,True""")
+    monkeypatch.setattr(
+        'riley.storage.user_data_dir', lambda x, y: tmpdir.strpath)
+    strptime = MagicMock()
+    monkeypatch.setattr('riley.models.time.strptime', strptime)
+
+    podcast = Podcast('kalle', 'feed', FileEpisodeStorage())
+    episode = podcast.episodes[0]
+    assert episode.timestamp == 1355314332
+    assert episode.str_attributes()[4] == '1355314332'
+    assert episode.published == struct_time((
+        2012, 12, 12, 12, 12, 12, 2, 347, 0))
+    assert not strptime.called
+    assert not episode.modified
+
+
+def test_download_candidates(tmpdir, monkeypatch):
+    tmpdir.join('config.yml').write(config)
+    history_path = tmpdir.join('kalle_history.csv')
+    history_path.write("""guid,title,link,media_href,published,downloaded
+a,a,a,a,2012-12-12 10:00:00,False
+b,b,b,b,2013-12-12 10:00:00,False
+c,c,c,c,2014-12-12 10:00:00,True""")
+    monkeypatch.setattr(
+        'riley.storage.user_data_dir', lambda x, y: tmpdir.strpath)
+    b_timestamp = time.mktime(strptime('2013-12-12 10:00:00',
+                                       '%Y-%m-%d %H:%M:%S'))
+
+    assert FileStorage().get_download_candidates(1) == [
+        ('kalle', 'b', b_timestamp)]
+    assert tmpdir.join('score_index.json').check()
+
+    # The index is used as long as the history is unchanged
+    iter_episodes = MagicMock()
+    monkeypatch.setattr(FileEpisodeStorage, 'iter_episodes', iter_episodes)
+    assert FileStorage().get_download_candidates(1) == [
+        ('kalle', 'b', b_timestamp)]
+    assert not iter_episodes.called
+    monkeypatch.undo()
+    monkeypatch.setattr(
+        'riley.storage.user_data_dir', lambda x, y: tmpdir.strpath)
+
+    history_path.write(history_path.read().replace(
+        '2013-12-12 10:00:00,False', '2013-12-12 10:00:00,True'))
+    assert [c[1] for c in FileStorage().get_download_candidates(2)] == ['a']
+
+    MigrateToSQLite().handle()
+    assert [c[1] for c in SQLiteStorage().get_download_candidates(2)] == ['a']
+    assert SQLiteStorage().get_download_candidates(2) == \
+        FileStorage().get_download_candidates(2)
+
+
+def test_upgrade_sqlite_dates(tmpdir, monkeypatch):
+    monkeypatch.setattr(
+        'riley.storage.user_data_dir', lambda x, y: tmpdir.strpath)
+    connection = sqlite3.connect(tmpdir.join('riley.sqlite3').strpath)
+    connection.executescript(
+        SQLiteStorage.schema.replace('published INTEGER', 'published TEXT'))
+    connection.executescript("""
+        INSERT INTO podcasts VALUES ('kalle', 'http://kalle.se', 5, NULL, NULL);
+        INSERT INTO episodes VALUES
+            ('kalle', 'abc', 'def', 'ghi', 'jkl', '2012-12-12 12:12:12', 0);
+    """)
+    connection.close()
+
+    podcast = SQLiteStorage().get_podcasts()['kalle']
+    assert [e.timestamp for e in podcast.episodes] == [1355314332]
+    connection = SQLiteStorage().connection
+    assert connection.execute('PRAGMA user_version').fetchone() == (1,)
+    assert connection.execute(
+        'SELECT typeof(published) FROM episodes').fetchone() == ('integer',)
+
+
+def test_journal(tmpdir, monkeypatch):
+    tmpdir.join('config.yml').write(config)
+    monkeypatch.setattr(
+        'riley.storage.user_data_dir', lambda x, y: tmpdir.strpath)
+    monkeypatch.setattr(FileEpisodeStorage, 'max_journal_ratio', 10)
+    history_path = tmpdir.join('kalle_history.csv')
+    journal_path = tmpdir.join('kalle_journal.csv')
+
+    file_storage = FileStorage()
+    podcast = file_storage.get_podcasts()['kalle']
+    for guid, published in [('a', 100), ('b', 300)]:
+        podcast.episodes.append(Episode(
+            podcast, guid, guid, 'link', 'media', published, False))
+    file_storage.save_podcast(podcast)
+    # There was no history to append to
+    history = history_path.read()
+    assert not journal_path.check()
+
+    podcast = file_storage.get_podcasts()['kalle']
+    podcast.episodes[1].downloaded = True
+    podcast.episodes.append(Episode(
+        podcast, 'c', 'c', 'link', 'media', 200, False))
+    file_storage.save_podcast(podcast)
+    assert history_path.read() == history
+    assert journal_path.read() == '+,c,c,link,media,200,False\n' \
+                                  '+,a,a,link,media,100,True\n'
+
+    podcast = file_storage.get_podcasts()['kalle']
+    assert [(e.guid, e.downloaded) for e in podcast.episodes] == [
+        ('b', False), ('c', False), ('a', True)]
+    del podcast.episodes[0]
+    file_storage.save_podcast(podcast)
+    # A record which was cut off is ignored
+    journal_path.write('+,d,d,link', mode='a')
+
+    podcast = file_storage.get_podcasts()['kalle']
+    assert [e.guid for e in podcast.episodes] == ['c', 'a']
+    podcast.episodes[0].title = 'new'
+    file_storage.save_podcast(podcast)
+    # The cut off record is removed before the journal is appended to
+    assert journal_path.read().endswith('-,b\n+,c,new,link,media,200,False\n')
+
+    assert history_path.read() == history
+    with storage._FileWrites() as writes:
+        file_storage.episode_storage.compact(podcast, writes)
+    assert not journal_path.check()
+    assert history_path.read() == \
+        """guid,title,link,media_href,published,downloaded
+a,a,link,media,100,True
+c,new,link,media,200,False\n"""
+
+
+def test_journal_is_compacted(tmpdir, monkeypatch):
+    tmpdir.join('config.yml').write(config)
+    monkeypatch.setattr(
+        'riley.storage.user_data_dir', lambda x, y: tmpdir.strpath)
+
+    file_storage = FileStorage()
+    podcast = file_storage.get_podcasts()['kalle']
+    for i in range(20):
+        podcast.episodes.append(Episode(
+            podcast, str(i), 'title', 'link', 'media', i, False))
+    file_storage.save_podcast(podcast)
+    compactions = 0
+    for i in range(20):
+        podcast.episodes[i].downloaded = True
+        file_storage.save_podcast(podcast)
+        if not tmpdir.join('kalle_journal.csv').check():
+            compactions += 1
+    assert 0 < compactions < 5
+    podcast = file_storage.get_podcasts()['kalle']
+    assert all(e.downloaded for e in podcast.episodes)
+
+
+def test_failed_write_keeps_file(tmpdir, monkeypatch):
+    tmpdir.join('config.yml').write(config)
+    monkeypatch.setattr(
+        'riley.storage.user_data_dir', lambda x, y: tmpdir.strpath)
+
+    def ordered_dump(*args, **kwargs):
+        raise KeyboardInterrupt
+    monkeypatch.setattr('riley.storage.ordered_dump', ordered_dump)
+
+    file_storage = FileStorage()
+    with raises(KeyboardInterrupt):
+        file_storage.save_podcast(Podcast('anka', 'feed', MagicMock()))
+    assert tmpdir.join('config.yml').read() == config
+    assert sorted(os.listdir(tmpdir.strpath)) == ['config.yml', 'riley.lock']
+
+
+def test_writes_are_synced_together(tmpdir, monkeypatch):
+    tmpdir.join('config.yml').write(config)
+    monkeypatch.setattr(
+        'riley.storage.user_data_dir', lambda x, y: tmpdir.strpath)
+    synced = []
+    monkeypatch.setattr('riley.storage._fsync', synced.append)
+
+    file_storage = FileStorage()
+    with file_storage.batch():
+        for name in ['a', 'b']:
+            podcast = Podcast(name, 'feed', file_storage.episode_storage)
+            podcast.episodes.append(Episode(
+                podcast, 'guid', 'title', 'link', 'media', 0, False))
+            file_storage.save_podcast(podcast)
+            assert synced == []
+    # The config, the two histories and then the directory
+    assert len(synced) == 4
+    assert synced[-1] == tmpdir.strpath
+
+    tmpdir.join('config.yml').write('fsync: false\n', mode='a')
+    del synced[:]
+    podcast.episodes[0].downloaded = True
+    file_storage.save_podcast(podcast)
+    assert synced == []
+
+
+def test_lock(tmpdir, monkeypatch):
+    monkeypatch.setattr(
+        'riley.storage.user_data_dir', lambda x, y: tmpdir.strpath)
+
+    file_storage = FileStorage()
+    with file_storage.lock():
+        with file_storage.lock():
+            pass
+        # Another process can't take the lock
+        with open(tmpdir.join('riley.lock').strpath) as f:
+            with raises(BlockingIOError):
+                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    with open(tmpdir.join('riley.lock').strpath) as f:
+        fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+
+
+def test_history_replaced_while_read(tmpdir, monkeypatch):
+    path = tmpdir.join('history.csv')
+    path.write('a\nb\nc\n')
+
+    lines = storage._reversed_lines(path.strpath, block_size=2)
+    assert next(lines) == b''
+    path.rename(tmpdir.join('old.csv'))
+    path.write('d\ne\nf\n')
+    with raises(storage._FileReplaced):
+        list(lines)
+
+
+def test_episodes_read_on_after_history_replaced(tmpdir, monkeypatch):
+    monkeypatch.setattr(
+        'riley.storage.user_data_dir', lambda x, y: tmpdir.strpath)
+    reversed_lines = storage._reversed_lines
+    monkeypatch.setattr(
+        'riley.storage._reversed_lines',
+        lambda path: reversed_lines(path, block_size=8))
+    header = 'guid,title,link,media_href,published,downloaded\n'
+    history_path = tmpdir.join('kalle_history.csv')
+    history_path.write(header + ''.join(
+        '%s,%s,,,%d,False\n' % (guid, guid, timestamp)
+        for guid, timestamp in [('a', 1), ('b', 2), ('c', 2), ('d', 3)]))
+    podcast = Podcast('kalle', 'feed', FileEpisodeStorage())
+
+    episodes = FileEpisodeStorage().iter_episodes(podcast)
+    assert [next(episodes).guid for _ in range(2)] == ['d', 'c']
+    # Another process adds an episode
+    history_path.rename(tmpdir.join('old.csv'))
+    history_path.write(header + ''.join(
+        '%s,%s,,,%d,False\n' % (guid, guid, timestamp)
+        for guid, timestamp in
+        [('a', 1), ('b', 2), ('c', 2), ('d', 3), ('e', 4)]))
+    assert [e.guid for e in episodes] == ['b', 'a']
+
+
+def test_list_more_histories_than_open_files(tmpdir, monkeypatch, capsys):
+    monkeypatch.setattr(
+        'riley.storage.user_data_dir', lambda x, y: tmpdir.strpath)
+    names = ['podcast%d' % i for i in range(200)]
+    tmpdir.join('config.yml').write('podcasts:\n' + ''.join(
+        '    %s:\n        feed: http://%s.se\n        priority: 5\n'
+        % (name, name) for name in names))
+    for i, name in enumerate(names):
+        tmpdir.join('%s_history.csv' % name).write(
+            'guid,title,link,media_href,published,downloaded\n'
+            '%s,%s,,,%d,False\n' % (name, name, i))
+
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (100, hard))
+    try:
+        ListEpisodes().execute(['riley', 'list', '-n', '3'])
+    finally:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (soft, hard))
+    out, _err = capsys.readouterr()
+    assert out == 'podcast199 \npodcast198 \npodcast197 \n'
+
+
+def test_save_episodes_locks(tmpdir, monkeypatch):
+    monkeypatch.setattr(
+        'riley.storage.user_data_dir', lambda x, y: tmpdir.strpath)
+    locked = []
+
+    def write_podcast(self, podcast, writes, records=()):
+        with open(tmpdir.join('riley.lock').strpath) as f:
+            with raises(BlockingIOError):
+                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        locked.append(podcast)
+    monkeypatch.setattr(
+        'riley.storage.FileEpisodeStorage.compact', write_podcast)
+
+    podcast = Podcast('abc', 'def', FileEpisodeStorage())
+    podcast.episodes.append(Episode(
+        podcast, 'guid', 'title', 'link', 'media', '2015-11-01 01:02:03',
+        False))
+    FileEpisodeStorage().save_episodes(podcast)
+    assert locked == [podcast]
+
+
+def test_cached_file_storage(tmpdir, monkeypatch):
+    config_path = tmpdir.join('config.yml')
+    config_path.write(config)
+    history_path = tmpdir.join('kalle_history.csv')
+    history_path.write(history)
+    monkeypatch.setattr(
+        'riley.storage.user_data_dir', lambda x, y: tmpdir.strpath)
+    cached_storage = CachedFileStorage()
+
+    podcast = cached_storage.get_podcasts()['kalle']
+    episode = podcast.episodes[0]
+    assert cached_storage.get_podcasts()['kalle'] is podcast
+    assert list(cached_storage.iter_latest_episodes()) == [episode]
+
+    # What the storage itself saves isn't read again
+    episode.downloaded = False
+    cached_storage.save_podcast(podcast)
+    assert cached_storage.get_podcasts()['kalle'] is podcast
+    assert 'False' in history_path.read()
+
+    # Files changed by other processes are
+    history_path.write(history + '\nxyz,a,b,c,1449921600,False')
+    podcast = cached_storage.get_podcasts()['kalle']
+    assert [e.guid for e in podcast.episodes] == ['xyz', 'abc']
+    config_path.write(config.replace('anka', 'kalle'))
+    assert cached_storage.get_podcasts()['kalle'].feed == 'http://kalle.se'
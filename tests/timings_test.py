@@ -0,0 +1,35 @@
+import io
+
+from riley.timings import Timings
+
+
+def test_phases():
+    timings = Timings()
+    with timings.phase('merge', 'kalle'):
+        pass
+    assert timings.phases == {}
+
+    timings.start()
+    with timings.phase('merge', 'kalle'):
+        pass
+    with timings.phase('merge', 'anka'):
+        pass
+    timings.add('merge', 2, 'kalle')
+    timings.add('save', 1)
+    timings.add_transfer('http://kalle.se/a.mp3', 1000, 0.5)
+    timings.stop()
+    assert list(timings.phases) == ['merge', 'save', 'download']
+    assert list(timings.phases['merge']) == ['kalle', 'anka']
+    assert 2 < timings.phases['merge']['kalle'] < 3
+
+    out = io.StringIO()
+    timings.report(out)
+    lines = out.getvalue().splitlines()
+    assert lines[0].startswith('merge ')
+    assert lines[1].split() == ['kalle', lines[1].split()[1], 's']
+    assert lines[3].split() == ['save', '1.000', 's']
+    assert lines[5] == '    http://kalle.se/a.mp3: 1000 bytes, 2000 bytes/s'
+
+    timings.start()
+    assert timings.phases == {}
+    assert timings.transfers == []
@@ -0,0 +1,120 @@
+import threading
+import time
+from unittest.mock import MagicMock
+
+from riley.transfers import AggregateProgress, DownloadQueue
+
+
+def make_episode(title, media_href):
+    episode = MagicMock()
+    episode.title = title
+    episode.media_href = media_href
+    return episode
+
+
+def test_download_sequentially():
+    download = MagicMock()
+    episodes = [make_episode('a', 'http://a.com/1.mp3'),
+                make_episode('b', 'http://a.com/2.mp3')]
+    events = []
+
+    DownloadQueue(download).run(
+        episodes, '/music', lambda e: events.append(('done', e.title)),
+        lambda e: events.append(('start', e.title)))
+
+    assert events == [('start', 'a'), ('done', 'a'),
+                      ('start', 'b'), ('done', 'b')]
+    assert [c[0][0] for c in download.call_args_list] == [
+        'http://a.com/1.mp3', 'http://a.com/2.mp3']
+
+
+def test_download_sequentially_after_failure(capsys):
+    def download(url, to_dir, datetime):
+        if url.endswith('broken.mp3'):
+            raise OSError('connection reset')
+
+    broken = make_episode('broken', 'http://a.com/broken.mp3')
+    episodes = [broken, make_episode('b', 'http://a.com/2.mp3')]
+    done = []
+
+    failed = DownloadQueue(download).run(episodes, '/music', done.append)
+
+    # The episode after the broken one was still downloaded
+    assert failed == [broken]
+    assert done == episodes[1:]
+    assert "Could not download 'broken': connection reset" in \
+        capsys.readouterr().err
+
+
+def test_download_concurrently_with_host_limit():
+    lock = threading.Lock()
+    running = {}
+    max_running = {}
+
+    def download(url, to_dir, datetime, progress):
+        host = url.split('/')[2]
+        with lock:
+            running[host] = running.get(host, 0) + 1
+            max_running[host] = max(max_running.get(host, 0), running[host])
+        time.sleep(0.02)
+        with lock:
+            running[host] -= 1
+        if url.endswith('broken.mp3'):
+            raise OSError('connection reset')
+
+    episodes = [make_episode(str(i), 'http://a.com/%d.mp3' % i)
+                for i in range(6)]
+    episodes += [make_episode(str(i), 'http://b.com/%d.mp3' % i)
+                 for i in range(6)]
+    broken = make_episode('broken', 'http://c.com/broken.mp3')
+    episodes.append(broken)
+    done = []
+
+    failed = DownloadQueue(download, jobs=8, per_host=2).run(
+        episodes, '/music', done.append)
+
+    assert max_running == {'a.com': 2, 'b.com': 2, 'c.com': 1}
+    # Every episode except the broken one was reported as done
+    assert failed == [broken]
+    assert len(done) == 12
+    assert broken not in done
+
+
+def test_busy_host_doesnt_hold_up_others():
+    events = []
+
+    def download(url, to_dir, datetime, progress):
+        if url == 'http://a.com/1.mp3':
+            # Finishes only after b.com's episode, which was queued behind
+            # another episode from a.com
+            time.sleep(0.05)
+        events.append(('downloaded', url))
+
+    episodes = [make_episode('a1', 'http://a.com/1.mp3'),
+                make_episode('a2', 'http://a.com/2.mp3'),
+                make_episode('b1', 'http://b.com/1.mp3')]
+
+    failed = DownloadQueue(download, jobs=2, per_host=1).run(
+        episodes, '/music', lambda e: events.append(('done', e.title)),
+        lambda e: events.append(('start', e.title)))
+
+    assert failed == []
+    # a2 only starts once a1 is done, and b1 doesn't wait for it
+    assert events.index(('start', 'a2')) > events.index(('done', 'a1'))
+    assert events.index(('done', 'b1')) < events.index(('done', 'a1'))
+
+
+def test_aggregate_progress(monkeypatch):
+    bar = MagicMock()
+    monkeypatch.setattr('riley.transfers.progress_bar', bar)
+
+    progress = AggregateProgress()
+    progress.add_expected(100)
+    progress.add_expected(50)
+    progress.advance(30)
+    progress.advance(45)
+    progress.done()
+
+    assert bar.call_count == 1
+    assert bar.return_value.show.call_args[0] == (75, 150)
+    assert bar.return_value.done.called